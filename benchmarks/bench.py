@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+@author: Andre Poley
+@contact: andre.poley@mailbox.org
+@copyright: (c) 2019 by Andre Poley, Berkeley
+@license: MIT
+@version: 0.0.5
+@summary: Benchmarks of the acquisition cycle on the simulated bus and of the sinks. Writes json.
+'''
+import os
+import sys
+import json
+import shutil
+import timeit
+import argparse
+import platform
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'sht21pi'))
+
+import binlog  # noqa: E402
+import datalog  # noqa: E402
+import deadband  # noqa: E402
+import helpers  # noqa: E402
+import i2c  # noqa: E402
+import latest  # noqa: E402
+import readings  # noqa: E402
+import scheduler  # noqa: E402
+import simbus  # noqa: E402
+
+try:
+    import influx
+except ImportError:  # requests is not installed
+    influx = None
+
+_SENSOR_COUNTS = (1, 2, 4, 8, 16)
+_BUS_COUNTS = (1, 2, 4)
+_CYCLES = 20
+_ROWS = 16 * 8640  # a day of 16 sensors every 10s
+_DEADBAND_CYCLES = 360  # an hour every 10s
+
+
+def _timer():
+    """Real time, the simulated bus keeps its own"""
+    return timeit.default_timer()
+
+
+def _batch(rows):
+    batch = readings.ReadingBatch()
+    for i in range(rows):
+        batch.append(1600000000 + i // 16 * 10, i % 16 + 1, (0x6000 + 37 * i) & 0xfffc, (0x7000 + 11 * i) & 0xfffc)
+    return batch
+
+
+def _read_buses(buses, sensors, cycles, polling, resolution):
+    """Cycles on simulated buses with the given number of sensors each, several buses are read
+    at the same time by a scheduler.MultiBusScheduler
+    @return: dict of per cycle averages
+    """
+    i2c._READY_POLLING = polling
+    i2c.set_resolution(resolution)
+    schedulers = []
+    for seed in range(buses):
+        bus = simbus.SimulatedBus(present=(1 << sensors) - 1, seed=seed)
+        schedulers.append(scheduler.PipelinedScheduler(bus, range(1, sensors + 1), 0x70, 0x71, offset=16 * seed))
+    acquisition = schedulers[0] if buses == 1 else scheduler.MultiBusScheduler(schedulers)
+    acquisition.configure_resolution(resolution)
+    start = [(cycle.bus.transactions, cycle.bus.busy_time, cycle.clock.slept, cycle.clock.monotonic())
+             for cycle in schedulers]
+    cycle_times = []
+    readings_count = 0
+    started = _timer()
+    for _ in range(cycles):
+        readings_count += len(acquisition.read_all())
+        cycle_times.append(acquisition.last_cycle_time)
+    cpu = _timer() - started
+    if buses > 1:
+        acquisition.close()
+    transactions = sum(cycle.bus.transactions - s[0] for cycle, s in zip(schedulers, start))
+    busy = sum(cycle.bus.busy_time - s[1] for cycle, s in zip(schedulers, start))
+    slept = sum(cycle.clock.slept - s[2] for cycle, s in zip(schedulers, start))
+    return {
+        'buses': buses,
+        'sensors': sensors * buses,
+        'ready_polling': polling,
+        'resolution': '{}/{}'.format(*resolution),
+        'cycle_time': sum(cycle_times) / cycles,
+        'max_cycle_time': max(cycle_times),
+        'cpu_time': cpu / cycles,
+        'transactions_per_sensor': transactions / float(cycles * sensors * buses),
+        'transfer_time': busy / cycles,
+        'sleep_time': slept / cycles,
+        'readings': readings_count,
+        'mux_writes': sum(cycle.mux.writes for cycle in schedulers),
+    }
+
+
+def bench_cycle(cycles=_CYCLES):
+    """Cycle time over the number of sensors on one bus, with fixed waits and ready polling.
+    cycle_time is the time the cycle takes on the bus (virtual), cpu_time the real time spent in python."""
+    results = []
+    for polling in (False, True):
+        for sensors in _SENSOR_COUNTS:
+            results.append(_read_buses(1, sensors, cycles, polling, (14, 12)))
+    return results
+
+
+def bench_buses(cycles=_CYCLES):
+    """Cycle time over the number of buses with 16 sensors each"""
+    return [_read_buses(buses, 16, cycles, True, (14, 12)) for buses in _BUS_COUNTS]
+
+
+def bench_resolution(cycles=_CYCLES):
+    """Cycle time of 16 sensors over the resolution"""
+    return [_read_buses(1, 16, cycles, True, resolution) for resolution in sorted(i2c._RESOLUTIONS)]
+
+
+def _throughput(function, rows, repeat=3):
+    """Best of repeat runs
+    @return: dict with seconds and rows per second
+    """
+    best = None
+    for _ in range(repeat):
+        started = _timer()
+        function()
+        elapsed = _timer() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return {'rows': rows, 'seconds': best, 'rows_per_second': rows / best if best else None}
+
+
+def bench_sinks(rows=_ROWS):
+    """Encoding and writing throughput of the sinks for a day of readings"""
+    batch = _batch(rows)
+    listed = [list(row) for row in batch]
+    results = {}
+    results['convert'] = _throughput(lambda: readings.ReadingBatch.from_list(batch.to_list()).temperatures(), rows)
+    if influx is not None:
+        influx._INFLUX_DATABASE = 'sht21'
+        writer = influx.InfluxWriter('localhost:8086', 'sht21', 'user', 'password')
+        results['influx_prepare_data'] = _throughput(lambda: influx.prepare_data(listed), rows)
+        results['influx_encode'] = _throughput(lambda: writer.encode(batch), rows)
+        results['influx_gzip'] = _throughput(lambda: influx._gzip('\n'.join(writer.encode(batch))), rows)
+        writer.session.close()
+    directory = tempfile.mkdtemp()
+    try:
+        logfile = os.path.join(directory, 'data.log')
+
+        def write_text():
+            if os.path.exists(logfile):
+                os.remove(logfile)
+            helpers.write_log(logfile, batch)
+
+        def write_binary():
+            shutil.rmtree(os.path.join(directory, 'binary'), ignore_errors=True)
+            writer = binlog.BinaryLogWriter(os.path.join(directory, 'binary'))
+            writer.write(batch)
+            writer.close()
+        cycles = [listed[i:i + 16] for i in range(0, len(listed), 16)]
+
+        def append_cycles():  # Opened and closed every cycle
+            if os.path.exists(logfile):
+                os.remove(logfile)
+            for rows_of_cycle in cycles:
+                helpers.write_log(logfile, rows_of_cycle)
+
+        def write_cycles():  # Kept open and rotated, compression runs on its own thread and is left out
+            shutil.rmtree(os.path.join(directory, 'datalog'), ignore_errors=True)
+            writer = datalog.DataLogWriter(os.path.join(directory, 'datalog', 'data.log'), compress=False)
+            for rows_of_cycle in cycles:
+                writer.write(rows_of_cycle)
+            writer.close()
+        results['text_log_write'] = _throughput(write_text, rows)
+        results['binary_log_write'] = _throughput(write_binary, rows)
+        results['text_log_append_per_cycle'] = _throughput(append_cycles, rows)
+        results['text_log_kept_open'] = _throughput(write_cycles, rows)
+        results['text_log_size'] = os.path.getsize(logfile)
+        results['binary_log_size'] = sum(os.path.getsize(os.path.join(directory, 'binary', name))
+                                         for name in os.listdir(os.path.join(directory, 'binary')))
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+
+def bench_deadband(cycles=_DEADBAND_CYCLES):
+    """Readings and data log bytes with and without the deadband, 16 sensors read every 10s"""
+    i2c._READY_POLLING = True
+    i2c.set_resolution((14, 12))
+    bus = simbus.SimulatedBus()
+    cycle = scheduler.PipelinedScheduler(bus, range(1, 17), 0x70, 0x71)
+    cycle.configure_resolution((14, 12))
+    band = deadband.Deadband()
+    rows = reported = logged = reported_logged = 0
+    for _ in range(cycles):
+        batch = cycle.read_all()
+        kept = band.filter(batch)
+        rows += len(batch)
+        reported += len(kept)
+        logged += len(helpers.format_log(batch))
+        reported_logged += len(helpers.format_log(kept))
+        bus.clock.sleep(10. - cycle.last_cycle_time)
+    return {
+        'temperature': deadband._DEADBAND_TEMPERATURE,
+        'humidity': deadband._DEADBAND_HUMIDITY,
+        'heartbeat': deadband._DEADBAND_HEARTBEAT,
+        'readings': rows,
+        'reported': reported,
+        'log_bytes': logged,
+        'reported_log_bytes': reported_logged,
+        'reduction': rows / float(reported) if reported else None,
+    }
+
+
+def bench_latest(rows=_ROWS):
+    """Publishing to and polling the latest readings table, 16 sensors"""
+    directory = tempfile.mkdtemp()
+    try:
+        writer = latest.LatestWriter(os.path.join(directory, 'latest'))
+        reader = latest.LatestReader(os.path.join(directory, 'latest'))
+        batch = _batch(16)
+        results = {
+            'write': _throughput(lambda: [writer.write(batch) for _ in range(rows // 16)], rows),
+            'read': _throughput(lambda: [reader.read(i % 16 + 1) for i in range(rows)], rows),
+        }
+        reader.close()
+        writer.close()
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+
+BENCHMARKS = {
+    'cycle': bench_cycle,
+    'buses': bench_buses,
+    'resolution': bench_resolution,
+    'sinks': bench_sinks,
+    'deadband': bench_deadband,
+    'latest': bench_latest,
+}
+
+
+def _compare(old, new, path=''):
+    """Ratios new/old of the numbers of two results
+    @return: [(path, old, new, ratio)]
+    """
+    rows = []
+    if isinstance(old, dict) and isinstance(new, dict):
+        for key in sorted(set(old) & set(new)):
+            rows.extend(_compare(old[key], new[key], '{}.{}'.format(path, key) if path else key))
+    elif isinstance(old, list) and isinstance(new, list):
+        for i, (a, b) in enumerate(zip(old, new)):
+            rows.extend(_compare(a, b, '{}[{}]'.format(path, i)))
+    elif isinstance(old, (int, float)) and isinstance(new, (int, float)) and not isinstance(old, bool):
+        rows.append((path, old, new, new / float(old) if old else None))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='sht21pi benchmarks on the simulated bus')
+    parser.add_argument('benchmarks', nargs='*', metavar='benchmark',
+                        help='benchmarks to run: {}, all if none is given'.format(', '.join(sorted(BENCHMARKS))))
+    parser.add_argument('-o', '--output', help='write the json result to this file instead of stdout')
+    parser.add_argument('--compare', help='json result of an earlier run to compare with')
+    parser.add_argument('--cycles', type=int, default=_CYCLES, help='cycles per measurement')
+    args = parser.parse_args(argv)
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark '{}'".format(name))
+    result = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+    }
+    for name in args.benchmarks or sorted(BENCHMARKS):
+        if name in ('sinks', 'deadband', 'latest'):
+            result[name] = BENCHMARKS[name]()
+        else:
+            result[name] = BENCHMARKS[name](args.cycles)
+    text = json.dumps(result, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            fp.write(text + '\n')
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare) as fp:
+            old = json.load(fp)
+        for path, before, after, ratio in _compare(old, result):
+            sys.stderr.write('{:<55} {:>14.6g} {:>14.6g} {}\n'.format(
+                path, before, after, '{:.2f}x'.format(ratio) if ratio is not None else '-'))
+
+
+if __name__ == "__main__":
+    main()
+
+# vim: fileencoding=utf-8 filetype=python ts=4 expandtab
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+@author: Andre Poley
+@contact: andre.poley@mailbox.org
+@copyright: (c) 2019 by Andre Poley, Berkeley
+@license: MIT
+@version: 0.0.5
+@summary: Rolling min/max/mean of every sensor over fixed windows, e.g. 1 min, 15 min and 1 h.
+'''
+import logging
+import collections
+
+_AGGREGATE_ENABLED = False
+_AGGREGATE_WINDOWS = (60, 900, 3600)  # seconds
+_AGGREGATE_RAW_UPSTREAM = True        # False: influx only gets the aggregates, the data log keeps the readings
+_AGGREGATE_LOG_FILE = ''
+
+Aggregate = collections.namedtuple('Aggregate', (
+    'window', 'start', 'addr', 'count',
+    'temperature_min', 'temperature_mean', 'temperature_max',
+    'humidity_min', 'humidity_mean', 'humidity_max'))
+
+
+def window_name(window):
+    """Short name of a window used in measurement names, 60 -> 1m, 3600 -> 1h
+    @param window: length in seconds
+    @type window: int
+    @return: str
+    """
+    for unit, seconds in (('d', 86400), ('h', 3600), ('m', 60)):
+        if window % seconds == 0:
+            return '{}{}'.format(window // seconds, unit)
+    return '{}s'.format(window)
+
+
+def _temperature(word):
+    """Same formula as readings.temperature, for a mean of masked words"""
+    return -46.85 + 175.72 * word / float(1 << 16)
+
+
+def _humidity(word):
+    """Same formula as readings.humidity, for a mean of masked words"""
+    return -6.0 + 125.0 * word / float(1 << 16)
+
+
+class Aggregator(object):
+    """
+    Keeps count, sum, min and max of the raw words of every sensor and window, so the
+    memory does not grow with the number of readings. Windows are aligned to the epoch,
+    a 15 min window starts at :00, :15, :30 and :45. A window is finished by the first
+    reading at or after its end.
+    """
+
+    def __init__(self, windows=None):
+        """
+        @param windows: Window lengths in seconds, _AGGREGATE_WINDOWS if None
+        @type windows: (int)
+        """
+        self.windows = tuple(sorted(windows if windows is not None else _AGGREGATE_WINDOWS))
+        self._open = {}  # {(window, addr): [start, count, t_sum, t_min, t_max, rh_sum, rh_min, rh_max]}
+        self.emitted = dict((window, 0) for window in self.windows)
+
+    def add(self, batch):
+        """Add the readings of a batch
+        @param batch: readings of one cycle
+        @type batch: readings.ReadingBatch
+        @return: [Aggregate] of the windows that finished
+        """
+        finished = []
+        latest = None
+        for epoch, addr, t_raw, rh_raw in zip(batch.epochs, batch.addrs, batch.temperature_raw, batch.humidity_raw):
+            t_raw &= 0xfffc
+            rh_raw &= 0xfffc
+            latest = epoch if latest is None else max(latest, epoch)
+            for window in self.windows:
+                start = epoch - epoch % window
+                state = self._open.get((window, addr))
+                if state is not None and state[0] != start:
+                    finished.append(self._finish(window, addr, state))
+                    state = None
+                if state is None:
+                    self._open[(window, addr)] = [start, 1, t_raw, t_raw, t_raw, rh_raw, rh_raw, rh_raw]
+                    continue
+                state[1] += 1
+                state[2] += t_raw
+                state[3] = min(state[3], t_raw)
+                state[4] = max(state[4], t_raw)
+                state[5] += rh_raw
+                state[6] = min(state[6], rh_raw)
+                state[7] = max(state[7], rh_raw)
+        if latest is not None:  # Sensors that did not report since their window ended
+            for (window, addr), state in list(self._open.items()):
+                if state[0] + window <= latest:
+                    finished.append(self._finish(window, addr, state))
+        finished.sort()
+        return finished
+
+    def discard(self):
+        """Drop the open windows, e.g. at shutdown. They are only partly filled, after a restart
+        the same window start would be written again and overwrite the earlier point.
+        @return: number of dropped windows
+        """
+        dropped = len(self._open)
+        self._open.clear()
+        return dropped
+
+    def _finish(self, window, addr, state):
+        del self._open[(window, addr)]
+        self.emitted[window] += 1
+        start, count, t_sum, t_min, t_max, rh_sum, rh_min, rh_max = state
+        return Aggregate(window, start, addr, count,
+                         _temperature(t_min), _temperature(t_sum / float(count)), _temperature(t_max),
+                         _humidity(rh_min), _humidity(rh_sum / float(count)), _humidity(rh_max))
+
+
+def format_log(aggregates):
+    """Format aggregates as lines of the aggregate log
+    @param aggregates: finished windows
+    @type aggregates: [Aggregate]
+    @return: str
+    """
+    return ''.join(["{}, {}, {}, {}, {}, {}, {}, {}, {}, {}\n".format(window_name(row.window), *row[1:])
+                    for row in aggregates])
+
+
+def write_log(logfile, aggregates):
+    """Append aggregates to the aggregate log
+    @param logfile: path of the aggregate log
+    @type logfile: str
+    @param aggregates: finished windows
+    @type aggregates: [Aggregate]
+    """
+    with open(logfile, 'a') as fp:
+        fp.write(format_log(aggregates))
+
+
+def debug():
+    logging.getLogger().debug("_AGGREGATE_ENABLED\t\t{}".format(_AGGREGATE_ENABLED))
+    logging.getLogger().debug("_AGGREGATE_WINDOWS\t\t{}".format(', '.join(window_name(w) for w in _AGGREGATE_WINDOWS)))
+    logging.getLogger().debug("_AGGREGATE_RAW_UPSTREAM\t{}".format(_AGGREGATE_RAW_UPSTREAM))
+    logging.getLogger().debug("_AGGREGATE_LOG_FILE\t\t{}".format(_AGGREGATE_LOG_FILE))
+
+# vim: fileencoding=utf-8 filetype=python ts=4 expandtab
@@ -0,0 +1,395 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+@author: Andre Poley
+@contact: andre.poley@mailbox.org
+@copyright: (c) 2019 by Andre Poley, Berkeley
+@license: MIT
+@version: 0.0.5
+@summary: asyncio engine: awaited conversions on every bus and the sinks as tasks. Needs python 3.5 or later.
+'''
+import signal
+import asyncio
+import logging
+import collections
+import concurrent.futures
+
+import helpers
+import pipeline
+import readings
+import scheduler
+
+
+class AsyncBusDriver(object):
+    """
+    Drives the cycle generator of a scheduler.PipelinedScheduler. The bus transfers
+    between two waits run on a single executor thread of the bus, the waits for
+    the conversions are awaited timers. On a simulated bus the wait passes on its
+    virtual clock instead.
+    """
+
+    def __init__(self, cycle):
+        """
+        @param cycle: Scheduler of the bus
+        @type cycle: scheduler.PipelinedScheduler
+        """
+        self.cycle = cycle
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    async def read_all(self, loop):
+        """Read all sensors of the bus once
+        @return: readings.ReadingBatch
+        """
+        batch = readings.ReadingBatch()
+        clock = self.cycle.clock
+        started = clock.monotonic()
+        steps = self.cycle._cycle(batch)
+        while True:
+            delay = await loop.run_in_executor(self.executor, next, steps, None)
+            if delay is None:
+                break
+            if clock is helpers.CLOCK:
+                await asyncio.sleep(delay)
+            else:
+                clock.sleep(delay)
+                await asyncio.sleep(0)
+        self.cycle._finish(batch, started)
+        return batch
+
+    def close(self):
+        self.executor.shutdown()
+
+
+class AsyncSinkWorker(object):
+    """
+    Feeds batches to one sink from an asyncio task, with the overflow policies of
+    pipeline.SinkWorker. The sinks keep their blocking clients, handle() runs on a
+    executor thread of the sink so the loop never waits for a post or a write.
+    """
+
+    def __init__(self, name, sink, maxsize=100, overflow=pipeline.DROP_OLDEST, spill=None, close_sink=True):
+        """
+        @param name: Name of the sink used in logs and stats
+        @type name: str
+        @param sink: Object with handle(batch) and close()
+        @type sink: sinks.Sink
+        @param maxsize: Batches kept in memory
+        @type maxsize: int
+        @param overflow: One of pipeline.OVERFLOW_POLICIES
+        @type overflow: str
+        @param spill: Spool for the spill policy
+        @type spill: spool.Spool
+        @param close_sink: Close the sink when the worker ends, False if its owner keeps using it
+        @type close_sink: bool
+        """
+        if overflow not in pipeline.OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy '{}', use one of {}".format(
+                overflow, ', '.join(pipeline.OVERFLOW_POLICIES)))
+        if overflow == pipeline.SPILL and spill is None:
+            raise ValueError("Overflow policy spill needs a spool")
+        self.sink_name = name
+        self.sink = sink
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.spill = spill
+        self.close_sink = close_sink
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._queue = collections.deque()
+        self._spilled = len(spill) if spill is not None else 0
+        self._changed = asyncio.Event()
+        self._closing = False
+        self.task = None
+        self.handled = 0
+        self.dropped = 0
+        self.errors = 0
+        self.last_latency = 0.
+        self.max_latency = 0.
+        self.total_latency = 0.
+        self.last_delay = 0.
+
+    def start(self, loop):
+        self.task = loop.create_task(self.run(loop))
+
+    def _notify(self):
+        self._changed.set()
+
+    async def _wait(self):
+        self._changed.clear()
+        await self._changed.wait()
+
+    async def put(self, batch):
+        """Queue a batch for the sink, waits only with the block policy
+        @param batch: readings of one cycle
+        @type batch: readings.ReadingBatch
+        """
+        if self._spilled or len(self._queue) >= self.maxsize:
+            if self.overflow == pipeline.SPILL:  # Keep the order, spill until the spool is empty again
+                self.spill.append([pipeline._dumps(batch)])
+                self._spilled += 1
+                self._notify()
+                return
+            if self.overflow == pipeline.BLOCK:
+                while len(self._queue) >= self.maxsize and not self._closing:
+                    await self._wait()
+            else:
+                self._queue.popleft()
+                self.dropped += 1
+                logging.getLogger().warning("Sink {} is behind, dropped the oldest batch".format(self.sink_name))
+        self._queue.append((helpers.monotonic(), batch))
+        self._notify()
+
+    async def _take(self):
+        """Wait for the next batch
+        @return: (queued at, batch, spool id to ack once handled or None), None once closed and empty
+        """
+        while not self._queue and not self._spilled and not self._closing:
+            await self._wait()
+        if self._queue:
+            queued, batch = self._queue.popleft()
+            self._notify()
+            return queued, batch, None
+        if not self._spilled:
+            return None
+        last_id, lines = self.spill.peek(1)  # The memory queue is empty, continue with the spool
+        if last_id is None:
+            self._spilled = 0
+            return await self._take()
+        return None, pipeline._loads(lines[0]), last_id
+
+    async def run(self, loop):
+        while True:
+            item = await self._take()
+            if item is None:
+                break
+            queued, batch, spooled = item
+            started = helpers.monotonic()
+            try:
+                await loop.run_in_executor(self.executor, self.sink.handle, batch)
+            except Exception:
+                self.errors += 1
+                logging.getLogger().error("Sink {} failed".format(self.sink_name), exc_info=True)
+            if spooled is not None:  # Only now, a stop while the sink handled it must not lose the batch
+                self.spill.ack(spooled)
+                self._spilled -= 1
+            latency = helpers.monotonic() - started
+            self.handled += 1
+            self.last_latency = latency
+            self.max_latency = max(self.max_latency, latency)
+            self.total_latency += latency
+            if queued is not None:
+                self.last_delay = started - queued
+        if self.close_sink:
+            try:
+                await loop.run_in_executor(self.executor, self.sink.close)
+            except Exception:
+                logging.getLogger().error("Cannot close sink {}".format(self.sink_name), exc_info=True)
+        self.executor.shutdown()
+
+    async def close(self):
+        """Handle the queued batches, close the sink and end the task"""
+        self._closing = True
+        self._notify()
+        if self.task is not None:
+            await self.task
+
+    def backlog(self):
+        return len(self._queue) + self._spilled
+
+    stats = pipeline.SinkWorker.stats
+
+
+class AsyncSinkPipeline(pipeline.SinkPipeline):
+    """pipeline.SinkPipeline with the sinks as asyncio tasks, create it inside the running loop"""
+
+    def __init__(self, loop, maxsize=100, overflow=pipeline.DROP_OLDEST, spill_directory=None, close_sinks=True):
+        pipeline.SinkPipeline.__init__(self, maxsize, overflow, spill_directory)
+        self.loop = loop
+        self.close_sinks = close_sinks
+
+    def add(self, name, sink, overflow=None):
+        overflow = overflow or self.overflow
+        worker = AsyncSinkWorker(name, sink, self.maxsize, overflow, self._spill(name, overflow), self.close_sinks)
+        worker.start(self.loop)
+        self.workers.append(worker)
+        return worker
+
+    async def publish(self, batch):
+        for worker in self.workers:
+            await worker.put(batch)
+
+    async def close(self):
+        for worker in self.workers:
+            await worker.close()
+            if worker.spill is not None:
+                worker.spill.close()
+
+
+class AsyncEngine(object):
+    """
+    Runs the acquisition of all buses and the sinks in one event loop. Every bus
+    has an AsyncBusDriver, their cycles run at the same time and are merged into
+    one batch like scheduler.MultiBusScheduler does with threads.
+    """
+
+    def __init__(self, acquisition, sink_pipeline):
+        """
+        @param acquisition: Scheduler of one bus or of several buses
+        @type acquisition: scheduler.PipelinedScheduler or scheduler.MultiBusScheduler
+        @param sink_pipeline: Pipeline to publish the readings to
+        @type sink_pipeline: AsyncSinkPipeline
+        """
+        self.acquisition = acquisition
+        self.schedulers = getattr(acquisition, 'schedulers', [acquisition])
+        self.drivers = [AsyncBusDriver(cycle) for cycle in self.schedulers]
+        self.pipeline = sink_pipeline
+        self.clock = self.schedulers[0].clock
+
+    async def read_all(self, loop):
+        """Read all buses once, at the same time
+        @return: readings.ReadingBatch
+        """
+        scheduler.align_clocks(self.schedulers)
+        parts = await asyncio.gather(*[driver.read_all(loop) for driver in self.drivers], return_exceptions=True)
+        scheduler.align_clocks(self.schedulers)
+        batch = readings.ReadingBatch()
+        for cycle, part in zip(self.schedulers, parts):
+            if isinstance(part, Exception):
+                logging.getLogger().error("Bus of sensors {}-{} failed: {}".format(
+                    cycle.offset + 1, cycle.offset + scheduler._SENSORS_PER_BUS, part))
+                continue
+            batch.extend(part)
+        if len(self.schedulers) > 1:
+            self.acquisition.last_cycle_time = max(cycle.last_cycle_time or 0. for cycle in self.schedulers)
+            self.acquisition.last_batch = batch
+            if self.acquisition.cycle_histogram is not None:
+                self.acquisition.cycle_histogram.observe(self.acquisition.last_cycle_time)
+        return batch
+
+    async def run_forever(self, loop, interval, stop, cycles=None):
+        """Cycles on a fixed schedule like StorageHumidityMonitor.run_forever
+        @param interval: Seconds between the start of two cycles
+        @type interval: float
+        @param stop: Event to end the loop
+        @type stop: asyncio.Event
+        @param cycles: Number of cycles to run, None to run until stopped
+        @type cycles: int
+        """
+        deadline = self.clock.monotonic()
+        while not stop.is_set():
+            await self.pipeline.publish(await self.read_all(loop))
+            self.pipeline.debug()
+            if cycles is not None:
+                cycles -= 1
+                if cycles <= 0:
+                    break
+            deadline += interval
+            now = self.clock.monotonic()
+            if now > deadline:
+                missed = int((now - deadline) // interval) + 1
+                logging.getLogger().warning("Cycle overran by {:.3f}s, skipping {} slot(s)".format(
+                    now - deadline, missed))
+                deadline += missed * interval
+            if self.clock is helpers.CLOCK:
+                try:
+                    await asyncio.wait_for(stop.wait(), deadline - now)
+                except asyncio.TimeoutError:
+                    pass
+            else:
+                self.clock.sleep(deadline - now)
+
+    def close(self):
+        for driver in self.drivers:
+            driver.close()
+
+
+def run(monitor, interval, stop=None, cycles=None, keep_sinks=False):
+    """Run a monitor on the asyncio engine until stop is set or SIGTERM/SIGINT arrive
+    @param monitor: Configured monitor, its sinks are moved to an AsyncSinkPipeline and closed at the end
+    @type monitor: sht21pi.StorageHumidityMonitor
+    @param interval: Seconds between the start of two cycles
+    @type interval: float
+    @param stop: Event to end the loop from another thread
+    @type stop: threading.Event
+    @param cycles: Number of cycles to run, None to run until stopped
+    @type cycles: int
+    @param keep_sinks: Leave the sinks open with the monitor, e.g. for single cycles of monitor.run().
+    Every call runs its own pipeline, it is not added to the metrics.
+    @type keep_sinks: bool
+    """
+    if keep_sinks:
+        run_engine(monitor._scheduler, monitor._sinks, interval, stop, cycles,
+                   maxsize=monitor._QUEUE_SIZE, overflow=monitor._OVERFLOW, spill_directory=monitor._SPILL_DIRECTORY,
+                   sink_overflow=monitor._SINK_OVERFLOW, close_sinks=False)
+        return
+    named_sinks, monitor._sinks = monitor._sinks, []  # Closed by the pipeline
+    run_engine(monitor._scheduler, named_sinks, interval, stop, cycles,
+               maxsize=monitor._QUEUE_SIZE, overflow=monitor._OVERFLOW, spill_directory=monitor._SPILL_DIRECTORY,
+               sink_overflow=monitor._SINK_OVERFLOW, registry=monitor._metrics)
+
+
+def run_engine(acquisition, named_sinks, interval, stop=None, cycles=None, maxsize=100,
+               overflow=pipeline.DROP_OLDEST, spill_directory=None, sink_overflow=None, registry=None,
+               close_sinks=True):
+    """Run the acquisition and the sinks in a new event loop
+    @param acquisition: Scheduler of one bus or of several buses
+    @type acquisition: scheduler.PipelinedScheduler or scheduler.MultiBusScheduler
+    @param named_sinks: Sinks to run as tasks, closed at the end if close_sinks is set
+    @type named_sinks: [(str, sinks.Sink)]
+    @param sink_overflow: Overflow policy per sink name, see pipeline.SinkPipeline
+    @type sink_overflow: dict
+    @param registry: Metrics to add the sink pipeline to
+    @type registry: metrics.Metrics
+    @return: stats of the sinks at the end, see pipeline.SinkWorker.stats
+    @rtype: {str: dict}
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(_run(
+            loop, acquisition, named_sinks, interval, stop, cycles,
+            (maxsize, overflow, spill_directory, close_sinks), sink_overflow or {}, registry))
+    finally:
+        loop.close()
+
+
+async def _run(loop, acquisition, named_sinks, interval, stop, cycles, pipeline_args, sink_overflow, registry):
+    stopped = asyncio.Event()
+    signals = []
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(signum, _stop, stopped, stop)
+            signals.append(signum)
+        except (RuntimeError, ValueError, NotImplementedError):  # Not the main thread
+            pass
+    sink_pipeline = AsyncSinkPipeline(loop, *pipeline_args)
+    for name, sink in named_sinks:
+        sink_pipeline.add(name, sink, sink_overflow.get(name))
+    if registry is not None:
+        registry.add_pipeline(sink_pipeline)
+    engine = AsyncEngine(acquisition, sink_pipeline)
+    watcher = loop.create_task(_watch(stop, stopped)) if stop is not None else None
+    try:
+        if stop is None or not stop.is_set():
+            await engine.run_forever(loop, interval, stopped, cycles)
+    finally:
+        if watcher is not None:
+            watcher.cancel()
+        await sink_pipeline.close()
+        engine.close()
+        for signum in signals:
+            loop.remove_signal_handler(signum)
+    return sink_pipeline.stats()
+
+
+def _stop(stopped, stop):
+    stopped.set()
+    if stop is not None:
+        stop.set()
+
+
+async def _watch(stop, stopped):
+    """Pass a threading.Event set by another thread on to the loop"""
+    while not stop.is_set():
+        await asyncio.sleep(0.2)
+    stopped.set()
+
+# vim: fileencoding=utf-8 filetype=python ts=4 expandtab
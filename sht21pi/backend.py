@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+@author: Andre Poley
+@contact: andre.poley@mailbox.org
+@copyright: (c) 2019 by Andre Poley, Berkeley
+@license: MIT
+@version: 0.0.5
+@summary: Bus connection used by the i2c module. Wraps smbus and adds plain reads of several bytes.
+'''
+import os
+import fcntl
+
+_I2C_SLAVE = 0x0703  # ioctl from linux/i2c-dev.h
+
+
+class SMBusBackend(object):
+    """
+    smbus has no plain read of several bytes, its block reads always send a command
+    byte first, which would start a new conversion on the sht21. Byte transfers go
+    through smbus, block reads through the i2c-dev file of the same bus.
+    """
+
+    def __init__(self, bus_nr):
+        """
+        @param bus_nr: Bus number, opens /dev/i2c-<bus_nr>
+        @type bus_nr: int
+        """
+        import smbus
+        self.bus_nr = bus_nr
+        self._smbus = smbus.SMBus(bus_nr)
+        try:
+            self._fd = os.open('/dev/i2c-{}'.format(bus_nr), os.O_RDWR)
+        except OSError as err:
+            self._smbus.close()
+            raise IOError(err.errno, err.strerror)
+        self._slave = None
+
+    def write_byte(self, addr, value):
+        self._smbus.write_byte(addr, value)
+
+    def read_byte(self, addr):
+        return self._smbus.read_byte(addr)
+
+    def write_byte_data(self, addr, register, value):
+        self._smbus.write_byte_data(addr, register, value)
+
+    def read_byte_data(self, addr, register):
+        return self._smbus.read_byte_data(addr, register)
+
+    def read_block(self, addr, length):
+        """Read length bytes in a single transaction
+        @param addr: I2C address of the device
+        @type addr: int
+        @param length: Number of bytes to read
+        @type length: int
+        @return: bytearray
+        """
+        try:
+            if self._slave != addr:
+                fcntl.ioctl(self._fd, _I2C_SLAVE, addr)
+                self._slave = addr
+            data = os.read(self._fd, length)
+        except OSError as err:  # python2 raises OSError, keep the IOError of smbus
+            raise IOError(err.errno, err.strerror)
+        if len(data) != length:
+            raise IOError("Short read from {}: {} of {} bytes".format(hex(addr), len(data), length))
+        return bytearray(data)
+
+    def close(self):
+        """Closes the i2c connection"""
+        self._smbus.close()
+        os.close(self._fd)
+
+# vim: fileencoding=utf-8 filetype=python ts=4 expandtab
@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+@author: Andre Poley
+@contact: andre.poley@mailbox.org
+@copyright: (c) 2019 by Andre Poley, Berkeley
+@license: MIT
+@version: 0.0.5
+@summary: Binary data log. Fixed width records in one segment per day with a sparse time index.
+'''
+import os
+import sys
+import time
+import struct
+import bisect
+import logging
+
+import i2c
+import readings
+
+# Segment: header, then records. The header keeps the layout so old segments stay readable.
+_MAGIC = b'SHT21BL\x00'
+_VERSION = 1
+_HEADER = struct.Struct('<8sHHII12x')  # magic, version, record size, index interval, created
+# Record: epoch, sensor address, status, raw temperature word, raw humidity word
+_RECORD = struct.Struct('<IBBHH')
+# Index entry every index_every records: epoch, record number
+_INDEX = struct.Struct('<II')
+_SEGMENT_SUFFIX = '.sbl'
+_INDEX_SUFFIX = '.idx'
+_INDEX_EVERY = 256
+
+RECORD_DTYPE = [('epoch', '<u4'), ('addr', 'u1'), ('status', 'u1'),
+                ('temperature_raw', '<u2'), ('humidity_raw', '<u2')]
+
+
+def _segment_name(epoch):
+    """Segments are partitioned by UTC day: YYYYMMDD"""
+    return time.strftime('%Y%m%d', time.gmtime(epoch))
+
+
+class BinaryLogWriter(object):
+    """
+    Appends readings as fixed width records. The segment of the current day is
+    kept open, every index_every-th record is added to the sparse index next to it.
+    Temperature and humidity are stored as the raw 16 bit words of the sensor.
+    Failed sensors are stored with their status (see readings.STATUS_NAMES) and no values.
+    """
+
+    def __init__(self, directory, index_every=_INDEX_EVERY):
+        """
+        @param directory: Directory of the segments, created if missing
+        @type directory: str
+        @param index_every: Records between two index entries of a new segment
+        @type index_every: int
+        """
+        self.directory = directory
+        self.index_every = index_every
+        self._name = None
+        self._fp = None
+        self._index = None
+        self._count = 0
+        self._segment_index_every = index_every
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _open(self, name):
+        """Open the segment of a day for appending, write the header if it is new"""
+        self.close()
+        path = os.path.join(self.directory, name + _SEGMENT_SUFFIX)
+        index_path = os.path.join(self.directory, name + _INDEX_SUFFIX)
+        self._fp = open(path, 'ab')
+        self._index = open(index_path, 'ab')
+        if self._fp.tell() == 0:
+            self._fp.write(_HEADER.pack(_MAGIC, _VERSION, _RECORD.size, self.index_every, int(time.time())))
+            self._segment_index_every = self.index_every
+            self._count = 0
+        else:
+            header = _read_header(path)
+            self._segment_index_every = header[3]
+            size = self._fp.tell() - _HEADER.size
+            self._count = size // _RECORD.size
+            if size % _RECORD.size:  # Cut a record torn by a crash
+                self._fp.truncate(_HEADER.size + self._count * _RECORD.size)
+                self._fp.seek(0, os.SEEK_END)
+            self._trim_index(index_path)
+        self._name = name
+
+    def _trim_index(self, index_path):
+        """Drop the index entries of records a crash did not leave in the segment, and a torn entry"""
+        with open(index_path, 'rb') as fp:
+            data = fp.read()
+        size = 0
+        for offset in range(0, len(data) - _INDEX.size + 1, _INDEX.size):
+            if _INDEX.unpack_from(data, offset)[1] >= self._count:
+                break
+            size = offset + _INDEX.size
+        if size != len(data):
+            self._index.truncate(size)
+            self._index.seek(0, os.SEEK_END)
+
+    def write(self, batch):
+        """Append readings
+        @param batch: readings, rows optionally with a status as fifth value
+        @type batch: readings.ReadingBatch or [[int, int, float, float]]
+        """
+        if isinstance(batch, readings.ReadingBatch):  # Raw words are stored as they are
+            rows = zip(batch.epochs, batch.addrs, batch.temperature_raw, batch.humidity_raw)
+            records = [(epoch, addr, readings.STATUS_OK, t_raw, rh_raw) for epoch, addr, t_raw, rh_raw in rows]
+            if batch.failures:  # Status records without values, in time order with the readings
+                records.extend((epoch, addr, status, 0, 0) for epoch, addr, status in batch.failures)
+                records.sort(key=lambda record: record[0])
+            self._write_raw(records)
+            return
+        self._write_raw(
+            (int(row[0]), int(row[1]), int(row[4]) if len(row) > 4 else 0,
+             i2c._get_raw_from_temperature(row[2]), i2c._get_raw_from_humidity(row[3])) for row in batch)
+
+    def _write_raw(self, records):
+        """Append records (epoch, address, status, temperature word, humidity word)"""
+        for record in records:
+            epoch = record[0]
+            name = _segment_name(epoch)
+            if name != self._name:
+                self._open(name)
+            if self._count % self._segment_index_every == 0:
+                self._index.write(_INDEX.pack(epoch, self._count))
+            self._fp.write(_RECORD.pack(*record))
+            self._count += 1
+
+    def flush(self):
+        if self._fp is not None:
+            self._fp.flush()
+            self._index.flush()
+
+    def close(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._index.close()
+            self._fp = None
+            self._index = None
+            self._name = None
+
+
+def _read_header(path):
+    with open(path, 'rb') as fp:
+        header = _HEADER.unpack(fp.read(_HEADER.size))
+    if header[0] != _MAGIC or header[2] != _RECORD.size:
+        raise IOError("{} is not a binary log segment of version {}".format(path, _VERSION))
+    return header
+
+
+class BinaryLogReader(object):
+    """
+    Reads time ranges from the segments without parsing. Segments are memory
+    mapped with numpy, the sparse index limits the search to the records of the
+    range. Records of a segment are expected in time order, as the writer appends them.
+    """
+
+    def __init__(self, directory):
+        """
+        @param directory: Directory of the segments
+        @type directory: str
+        """
+        import numpy
+        self._np = numpy
+        self.directory = directory
+
+    def segments(self, start=None, end=None):
+        """Segments that may hold records between start and end
+        @return: [str] paths in time order
+        """
+        first = _segment_name(start) if start is not None else ''
+        last = _segment_name(end) if end is not None else '99999999'
+        names = sorted(name[:-len(_SEGMENT_SUFFIX)] for name in os.listdir(self.directory)
+                       if name.endswith(_SEGMENT_SUFFIX))
+        return [os.path.join(self.directory, name + _SEGMENT_SUFFIX) for name in names if first <= name <= last]
+
+    def _records(self, path):
+        """Memory map the complete records of a segment"""
+        _read_header(path)
+        count = (os.path.getsize(path) - _HEADER.size) // _RECORD.size
+        if count == 0:
+            return self._np.zeros(0, dtype=RECORD_DTYPE)
+        return self._np.memmap(path, dtype=RECORD_DTYPE, mode='r', offset=_HEADER.size, shape=(count,))
+
+    def _bounds(self, path, count, start, end):
+        """Narrow the records to search with the sparse index
+        @return: (first, last) record numbers
+        """
+        index_path = path[:-len(_SEGMENT_SUFFIX)] + _INDEX_SUFFIX
+        if not os.path.exists(index_path):
+            return 0, count
+        with open(index_path, 'rb') as fp:
+            data = fp.read()
+        entries = [_INDEX.unpack_from(data, offset) for offset in range(0, len(data) - _INDEX.size + 1, _INDEX.size)]
+        entries = [entry for entry in entries if entry[1] < count]  # Until the writer trims it after a crash
+        if not entries:
+            return 0, count
+        epochs = [entry[0] for entry in entries]
+        first, last = 0, count
+        if start is not None:
+            i = bisect.bisect_left(epochs, start) - 1
+            if i >= 0:
+                first = entries[i][1]
+        if end is not None:
+            i = bisect.bisect_right(epochs, end)
+            if i < len(entries):
+                last = min(count, entries[i][1])
+        return first, last
+
+    def read_range(self, start=None, end=None):
+        """Records with start <= epoch <= end
+        @param start: First epoch, None for the beginning
+        @type start: int
+        @param end: Last epoch, None for the end
+        @type end: int
+        @return: structured array with the fields of RECORD_DTYPE
+        @rtype: numpy.ndarray
+        """
+        np = self._np
+        parts = []
+        for path in self.segments(start, end):
+            records = self._records(path)
+            first, last = self._bounds(path, len(records), start, end)
+            records = records[first:last]
+            epochs = records['epoch']
+            lo = np.searchsorted(epochs, start, 'left') if start is not None else 0
+            hi = np.searchsorted(epochs, end, 'right') if end is not None else len(records)
+            parts.append(np.array(records[lo:hi]))
+        if not parts:
+            return np.zeros(0, dtype=RECORD_DTYPE)
+        return np.concatenate(parts)
+
+    def read_physical(self, start=None, end=None):
+        """Like read_range, with temperature in C and humidity in percent.
+        Records with a status other than readings.STATUS_OK have no values.
+        @return: dict of arrays: epoch, addr, status, temperature, humidity
+        """
+        records = self.read_range(start, end)
+        return {
+            'epoch': records['epoch'],
+            'addr': records['addr'],
+            'status': records['status'],
+            'temperature': readings.temperature(records['temperature_raw']),
+            'humidity': readings.humidity(records['humidity_raw']),
+        }
+
+
+def convert_csv(logfile, directory):
+    """Convert a text data log as written by helpers.write_log
+    @param logfile: text log with lines 'epoch, address, temperature, humidity'
+    @type logfile: str
+    @param directory: Directory of the segments
+    @type directory: str
+    @return: number of converted readings
+    """
+    writer = BinaryLogWriter(directory)
+    count = 0
+    batch = []
+    try:
+        with open(logfile) as fp:
+            for number, line in enumerate(fp, 1):
+                fields = line.split(',')
+                if len(fields) != 4:
+                    logging.getLogger().warning("{}:{}: skipping '{}'".format(logfile, number, line.strip()))
+                    continue
+                batch.append([int(fields[0]), int(fields[1]), float(fields[2]), float(fields[3])])
+                if len(batch) >= 10000:
+                    writer.write(batch)
+                    count += len(batch)
+                    batch = []
+        writer.write(batch)
+        count += len(batch)
+    finally:
+        writer.close()
+    return count
+
+
+def main(argv=None):
+    import argparse  # Only the command line needs it, not the monitor importing this module
+    parser = argparse.ArgumentParser(prog='python -m sht21pi.binlog', description='Binary data log tools')
+    commands = parser.add_subparsers(dest='command')
+    query = commands.add_parser('query', help='print readings of a time range as text')
+    query.add_argument('directory')
+    query.add_argument('start', type=int, nargs='?', help='first epoch')
+    query.add_argument('end', type=int, nargs='?', help='last epoch')
+    convert = commands.add_parser('convert', help='convert a text data log')
+    convert.add_argument('logfile')
+    convert.add_argument('directory')
+    args = parser.parse_args(argv)
+    if args.command == 'query':
+        data = BinaryLogReader(args.directory).read_physical(args.start, args.end)
+        for i in range(len(data['epoch'])):
+            if data['status'][i] != readings.STATUS_OK:  # The text log has no failures
+                continue
+            sys.stdout.write("{}, {}, {}, {}\n".format(
+                data['epoch'][i], data['addr'][i], data['temperature'][i], data['humidity'][i]))
+    elif args.command == 'convert':
+        print("Converted {} readings".format(convert_csv(args.logfile, args.directory)))
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
+
+# vim: fileencoding=utf-8 filetype=python ts=4 expandtab
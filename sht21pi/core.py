@@ -8,15 +8,77 @@
 @version: 0.0.3
 @summary: Core component to run the argospi2c module
 '''
+import sys
+import signal
+import getopt
+import logging
+import threading
 
-import sht21pi
+import helpers
+
+_STARTED = helpers.monotonic()
+import sht21pi  # noqa: E402
+_IMPORTED = helpers.monotonic()
+
+_DEFAULT_INTERVAL = 10.
+
+
+def _get_options():
+    """Read the options handled by the core module, -c is read by the monitor itself.
+    @return: tuple with daemon flag, interval in seconds and profile flag
+    """
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "c:", ["daemon", "interval=", "profile-startup"])
+    except getopt.GetoptError as e:
+        print("Usage: python -m sht21pi.core -c <configfile> [--daemon] [--interval <seconds>] "
+              "[--profile-startup] ({})".format(e))
+        sys.exit(1)
+    daemon = False
+    interval = _DEFAULT_INTERVAL
+    profile = False
+    for opt, arg in opts:
+        if opt == '--daemon':
+            daemon = True
+        elif opt == '--interval':
+            interval = float(arg)
+        elif opt == '--profile-startup':
+            profile = True
+    if interval <= 0:
+        print("Usage: --interval must be greater than 0")
+        sys.exit(1)
+    return daemon, interval, profile
 
 
 def main():
+    daemon, interval, profile = _get_options()
+    startup = helpers.StartupProfile()
+    startup.add('import sht21pi', _IMPORTED - _STARTED)
     try:
-        sht21pi.StorageHumidityMonitor(1).run()
+        monitor = sht21pi.StorageHumidityMonitor(1, profile=startup)
     except IOError as e:
         raise IOError('\nCannot create connection to i2c. Permission denied. {}'.format(e))
+    startup.add('total', helpers.monotonic() - _STARTED)
+    logging.getLogger().info("Startup\n{}".format(startup.report()))
+    if profile:
+        sys.stderr.write(startup.report() + '\n')
+    if not daemon:
+        try:
+            monitor.run()
+        finally:
+            monitor.close()
+        return
+    stop = threading.Event()
+
+    def _shutdown(signum, frame):
+        logging.getLogger().info("Received signal {}, shutting down".format(signum))
+        stop.set()
+
+    signal.signal(signal.SIGTERM, _shutdown)
+    signal.signal(signal.SIGINT, _shutdown)
+    try:
+        monitor.run_forever(interval, stop)
+    finally:
+        monitor.close()
 
 
 if __name__ == "__main__":
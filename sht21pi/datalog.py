@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+@author: Andre Poley
+@contact: andre.poley@mailbox.org
+@copyright: (c) 2019 by Andre Poley, Berkeley
+@license: MIT
+@version: 0.0.5
+@summary: Text data log kept open, rotated by size or day, compressed and bounded in size, with a segment index.
+'''
+import os
+import re
+import sys
+import gzip
+import json
+import time
+import shutil
+import logging
+import threading
+import collections
+
+import helpers
+import readings
+
+_DATALOG_MAX_BYTES = 16 << 20      # Rotate when the data log reaches this size, 0 to rotate only daily
+_DATALOG_DAILY = True              # Rotate when a new UTC day starts
+_DATALOG_COMPRESS = True           # gzip rotated segments
+_DATALOG_QUOTA = 512 << 20         # Bytes of the data log and all its segments, 0 for no limit
+_DATALOG_FSYNC_INTERVAL = 60.      # Seconds between two fsyncs, 0 to fsync every write
+_BUFFER_SIZE = 64 << 10
+_INDEX_SUFFIX = '.index'
+_GZIP_SUFFIX = '.gz'
+_TAIL = 4096  # Bytes read from the end of the data log to find its last reading
+
+
+def _day(epoch):
+    """Segments are rotated by UTC day, like binlog"""
+    return time.strftime('%Y%m%d', time.gmtime(epoch))
+
+
+def _epoch(line):
+    """Epoch of a line of the data log, None if it is no reading"""
+    try:
+        return int(line.split(b',', 1)[0])
+    except ValueError:
+        return None
+
+
+def _epochs(path):
+    """First and last epoch of a segment, plain or compressed
+    @return: (first, last), None for both if there is no reading
+    """
+    first = last = None
+    with (gzip.open if path.endswith(_GZIP_SUFFIX) else open)(path, 'rb') as fp:
+        for line in fp:
+            epoch = _epoch(line)
+            if epoch is not None:
+                first = epoch if first is None else first
+                last = epoch
+    return first, last
+
+
+def _first_last(path):
+    """First and last epoch of the data log, without reading all of it
+    @return: (first, last), None for both if there is no reading
+    """
+    with open(path, 'rb') as fp:
+        first = _epoch(fp.readline())
+        size = os.fstat(fp.fileno()).st_size
+        fp.seek(max(0, size - _TAIL))
+        lines = fp.read().splitlines()
+    if size > _TAIL:  # The first line may be cut
+        lines = lines[1:]
+    epochs = [epoch for epoch in (_epoch(line) for line in lines) if epoch is not None]
+    return first, epochs[-1] if epochs else first
+
+
+def load_index(path):
+    """Index of the segments of a data log
+    @param path: The data log
+    @type path: str
+    @return: [{'name': file name, 'first': epoch, 'last': epoch, 'size': bytes}] oldest first,
+    empty if there is no readable index
+    """
+    try:
+        with open(path + _INDEX_SUFFIX) as fp:
+            return json.load(fp)
+    except (IOError, OSError, ValueError):
+        return []
+
+
+def save_index(path, index):
+    """Replace the index of a data log"""
+    with open(path + _INDEX_SUFFIX + '.tmp', 'w') as fp:
+        json.dump(index, fp, indent=1, sort_keys=True)
+    os.rename(path + _INDEX_SUFFIX + '.tmp', path + _INDEX_SUFFIX)
+
+
+class DataLogWriter(object):
+    """
+    Appends readings to the data log through a buffered handle that stays open, the
+    buffer is written and synced to the card every fsync_interval seconds. The data
+    log is rotated when it reaches max_bytes or the readings of a new UTC day arrive:
+    it is renamed after its first reading, e.g. sht21pi.log.20190526-000003, and
+    added to the index with the time range it holds. A housekeeping thread compresses
+    rotated segments and removes the oldest once the data log and its segments take
+    more than quota bytes.
+    """
+
+    def __init__(self, path, max_bytes=None, daily=None, compress=None, quota=None, fsync_interval=None):
+        """
+        @param path: The data log, its directory is created if missing
+        @type path: str
+        @param max_bytes: Size that starts a new segment, _DATALOG_MAX_BYTES if None
+        @type max_bytes: int
+        @param daily: Start a new segment every UTC day, _DATALOG_DAILY if None
+        @type daily: bool
+        @param compress: gzip rotated segments, _DATALOG_COMPRESS if None
+        @type compress: bool
+        @param quota: Bytes kept on disk, _DATALOG_QUOTA if None
+        @type quota: int
+        @param fsync_interval: Seconds between two fsyncs, _DATALOG_FSYNC_INTERVAL if None
+        @type fsync_interval: float
+        """
+        self.path = path
+        self.directory = os.path.dirname(path) or '.'
+        self.max_bytes = max_bytes if max_bytes is not None else _DATALOG_MAX_BYTES
+        self.daily = daily if daily is not None else _DATALOG_DAILY
+        self.compress = compress if compress is not None else _DATALOG_COMPRESS
+        self.quota = quota if quota is not None else _DATALOG_QUOTA
+        self.fsync_interval = fsync_interval if fsync_interval is not None else _DATALOG_FSYNC_INTERVAL
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.rotations = 0
+        self.syncs = 0
+        self.compressed = 0
+        self.removed = 0
+        self._lock = threading.Lock()  # The index is shared with the housekeeping thread
+        self._index = load_index(path)
+        self._jobs = collections.deque()
+        self._cond = threading.Condition()
+        self._closing = False
+        self._adopt()
+        self._fp = open(path, 'ab', _BUFFER_SIZE)
+        self._size = self._fp.tell()
+        self._first, self._last = _first_last(path) if self._size else (None, None)
+        self._synced = helpers.monotonic()
+        self._thread = threading.Thread(target=self._housekeeping, name='datalog')
+        self._thread.daemon = True
+        self._thread.start()
+        for entry in self._index:  # Left uncompressed by the last run
+            if self.compress and not entry['name'].endswith(_GZIP_SUFFIX):
+                self._queue(entry['name'])
+        self._queue(None)
+
+    def _adopt(self):
+        """Index segments that are missing in it, e.g. after the index was lost"""
+        pattern = re.compile(re.escape(os.path.basename(self.path)) + r'\.\d{8}-\d{6}(-\d+)?(\.gz)?(\.tmp)?$')
+        known = set(entry['name'] for entry in self._index)
+        self._index = [entry for entry in self._index if os.path.exists(os.path.join(self.directory, entry['name']))]
+        adopted = len(self._index) != len(known)
+        for name in sorted(os.listdir(self.directory)):
+            if not pattern.match(name) or name in known:
+                continue
+            segment = os.path.join(self.directory, name)
+            if name.endswith('.tmp'):  # Compression was interrupted, the segment is compressed again
+                os.remove(segment)
+                continue
+            compressing = name.endswith(_GZIP_SUFFIX) and name[:-len(_GZIP_SUFFIX)] in known
+            if compressing or name + _GZIP_SUFFIX in known:
+                os.remove(segment)  # The last run stopped while it compressed the segment
+                continue
+            first, last = _epochs(segment)
+            if first is None:
+                continue
+            self._index.append({'name': name, 'first': first, 'last': last, 'size': os.path.getsize(segment)})
+            adopted = True
+        if adopted:
+            self._index.sort(key=lambda entry: entry['first'])
+            save_index(self.path, self._index)
+
+    def write(self, batch):
+        """Append readings, the data log is rotated first if they are due in a new segment
+        @param batch: readings
+        @type batch: readings.ReadingBatch or [[int, int, float, float]]
+        """
+        epochs = list(batch.epochs) if isinstance(batch, readings.ReadingBatch) else [row[0] for row in batch]
+        if not epochs:
+            return
+        if self._size and self._due(epochs[0]):
+            self.rotate()
+        data = helpers.format_log(batch).encode('utf-8')
+        self._fp.write(data)
+        self._size += len(data)
+        self._first = epochs[0] if self._first is None else self._first
+        self._last = max(epochs) if self._last is None else max(self._last, max(epochs))
+        if helpers.monotonic() - self._synced >= self.fsync_interval:
+            self.sync()
+
+    def _due(self, epoch):
+        if self.max_bytes and self._size >= self.max_bytes:
+            return True
+        return self.daily and self._first is not None and _day(epoch) != _day(self._first)
+
+    def sync(self):
+        """Write the buffer and sync the data log to the card"""
+        self._fp.flush()
+        os.fsync(self._fp.fileno())
+        self._synced = helpers.monotonic()
+        self.syncs += 1
+
+    def rotate(self):
+        """Close the data log as a segment and start a new one"""
+        self.sync()
+        self._fp.close()
+        first = self._first if self._first is not None else int(time.time())
+        name = '{}.{}'.format(os.path.basename(self.path), time.strftime('%Y%m%d-%H%M%S', time.gmtime(first)))
+        taken = set(entry['name'] for entry in self._index)
+        unique, number = name, 1
+        while unique in taken or unique + _GZIP_SUFFIX in taken:
+            unique = '{}-{}'.format(name, number)
+            number += 1
+        os.rename(self.path, os.path.join(self.directory, unique))
+        with self._lock:
+            self._index.append({'name': unique, 'first': first, 'last': self._last or first, 'size': self._size})
+            self._index.sort(key=lambda entry: entry['first'])
+            save_index(self.path, self._index)
+        self._fp = open(self.path, 'ab', _BUFFER_SIZE)
+        self._size = 0
+        self._first = self._last = None
+        self.rotations += 1
+        logging.getLogger().info("Rotated the data log to {}".format(unique))
+        self._queue(unique if self.compress else None)
+
+    def _queue(self, name):
+        """Hand a segment to compress, or None to only check the quota, to the housekeeping thread"""
+        with self._cond:
+            self._jobs.append(name)
+            self._cond.notify_all()
+
+    def _housekeeping(self):
+        while True:
+            with self._cond:
+                while not self._jobs and not self._closing:
+                    self._cond.wait()
+                if not self._jobs:
+                    return
+                name = self._jobs.popleft()
+            try:
+                if name is not None:
+                    self._compress(name)
+                self._enforce_quota()
+            except (IOError, OSError):
+                logging.getLogger().error("Data log housekeeping failed", exc_info=True)
+
+    def _compress(self, name):
+        """Replace a segment by its gzip file"""
+        source = os.path.join(self.directory, name)
+        target = source + _GZIP_SUFFIX
+        with self._lock:
+            if not any(entry['name'] == name for entry in self._index):  # Removed over the quota
+                return
+        with open(source, 'rb') as src:
+            out = gzip.open(target + '.tmp', 'wb')
+            try:
+                shutil.copyfileobj(src, out)
+            finally:
+                out.close()
+        os.rename(target + '.tmp', target)
+        with self._lock:
+            entries = [entry for entry in self._index if entry['name'] == name]
+            if entries:
+                entries[0]['name'] = name + _GZIP_SUFFIX
+                entries[0]['size'] = os.path.getsize(target)
+                save_index(self.path, self._index)
+        if not entries:  # Removed over the quota while it was compressed
+            os.remove(target)
+            return
+        os.remove(source)
+        self.compressed += 1
+
+    def _enforce_quota(self):
+        """Remove the oldest segments until the data log and its segments fit in the quota"""
+        if not self.quota:
+            return
+        removed = []
+        with self._lock:
+            total = self._size + sum(entry['size'] for entry in self._index)
+            while self._index and total > self.quota:
+                entry = self._index.pop(0)
+                total -= entry['size']
+                removed.append(entry['name'])
+            if removed:
+                save_index(self.path, self._index)
+        for name in removed:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            self.removed += 1
+        if removed:
+            logging.getLogger().warning("Data log over its quota of {} bytes, removed {}".format(
+                self.quota, ', '.join(removed)))
+
+    def index(self):
+        """@return: copy of the segment index, see load_index"""
+        with self._lock:
+            return [dict(entry) for entry in self._index]
+
+    def close(self):
+        """Sync the data log and wait for the housekeeping thread to finish its jobs"""
+        if self._fp is None:
+            return
+        self.sync()
+        self._fp.close()
+        self._fp = None
+        self._queue(None)  # The data log grew since the last rotation
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        self._thread.join()
+
+
+def segments(path, start=None, end=None):
+    """Files of a data log that may hold readings between start and end, from its index
+    @param path: The data log
+    @type path: str
+    @return: [str] paths in time order, the data log itself last
+    """
+    directory = os.path.dirname(path) or '.'
+    index = load_index(path)
+    found = [os.path.join(directory, entry['name']) for entry in index
+             if (start is None or entry['last'] >= start) and (end is None or entry['first'] <= end)]
+    if os.path.exists(path) and (end is None or not index or end >= index[-1]['last']):
+        found.append(path)
+    return found
+
+
+def read_range(path, start=None, end=None):
+    """Readings with start <= epoch <= end, only the segments of the range are opened
+    @param path: The data log
+    @type path: str
+    @param start: First epoch, None for the beginning
+    @type start: int
+    @param end: Last epoch, None for the end
+    @type end: int
+    @return: generator of [epoch, address, temperature, humidity]
+    """
+    for segment in segments(path, start, end):
+        with (gzip.open if segment.endswith(_GZIP_SUFFIX) else open)(segment, 'rb') as fp:
+            for line in fp:
+                fields = line.split(b',')
+                if len(fields) != 4:
+                    continue
+                epoch = int(fields[0])
+                if (start is None or epoch >= start) and (end is None or epoch <= end):
+                    yield [epoch, int(fields[1]), float(fields[2]), float(fields[3])]
+
+
+def debug():
+    logging.getLogger().debug("_DATALOG_MAX_BYTES\t\t{}".format(_DATALOG_MAX_BYTES))
+    logging.getLogger().debug("_DATALOG_DAILY\t\t{}".format(_DATALOG_DAILY))
+    logging.getLogger().debug("_DATALOG_COMPRESS\t\t{}".format(_DATALOG_COMPRESS))
+    logging.getLogger().debug("_DATALOG_QUOTA\t\t{}".format(_DATALOG_QUOTA))
+    logging.getLogger().debug("_DATALOG_FSYNC_INTERVAL\t{}".format(_DATALOG_FSYNC_INTERVAL))
+
+
+def main(argv=None):
+    import argparse  # Only the command line needs it, not the monitor importing this module
+    parser = argparse.ArgumentParser(prog='python -m sht21pi.datalog', description='Print readings of the data log')
+    parser.add_argument('logfile')
+    parser.add_argument('start', type=int, nargs='?', help='first epoch')
+    parser.add_argument('end', type=int, nargs='?', help='last epoch')
+    args = parser.parse_args(argv)
+    for row in read_range(args.logfile, args.start, args.end):
+        sys.stdout.write("{}, {}, {}, {}\n".format(*row))
+
+
+if __name__ == "__main__":
+    main()
+
+# vim: fileencoding=utf-8 filetype=python ts=4 expandtab
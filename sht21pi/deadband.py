@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+@author: Andre Poley
+@contact: andre.poley@mailbox.org
+@copyright: (c) 2019 by Andre Poley, Berkeley
+@license: MIT
+@version: 0.0.5
+@summary: Change-only reporting. Readings are passed on when they moved by more than a deadband or a heartbeat passed.
+'''
+import logging
+
+import readings
+
+_DEADBAND_ENABLED = False
+_DEADBAND_TEMPERATURE = 0.1  # C
+_DEADBAND_HUMIDITY = 0.5     # percent
+_DEADBAND_HEARTBEAT = 600    # seconds
+_DEADBAND_SINKS = ('influx', 'file')
+_DEADBAND_SENSORS = {}       # {sensor: (temperature, humidity)} overriding the defaults
+
+# Resolution of the raw words: C and percent per count, see i2c._get_temperature_from_buffer
+_TEMPERATURE_PER_COUNT = 175.72 / (1 << 16)
+_HUMIDITY_PER_COUNT = 125.0 / (1 << 16)
+
+
+def _counts(threshold, per_count):
+    """Deadband in raw counts, the two status bits of the word are not part of the value"""
+    return int(threshold / per_count) & ~0x3
+
+
+class Deadband(object):
+    """
+    Keeps the last reported raw words of every sensor. A reading is reported if its
+    temperature or humidity moved by more than the deadband since the last reported
+    one, or heartbeat seconds passed. The comparison is done on the raw words, so there
+    is no float noise. Failures of a batch are always reported.
+    """
+
+    def __init__(self, temperature=None, humidity=None, heartbeat=None, sensors=None):
+        """
+        @param temperature: Deadband in C, _DEADBAND_TEMPERATURE if None
+        @type temperature: float
+        @param humidity: Deadband in percent, _DEADBAND_HUMIDITY if None
+        @type humidity: float
+        @param heartbeat: Seconds after which a reading is reported anyway, _DEADBAND_HEARTBEAT if None
+        @type heartbeat: int
+        @param sensors: Deadbands per sensor {sensor: (temperature, humidity)}, _DEADBAND_SENSORS if None.
+            A value of None is the default deadband
+        @type sensors: dict
+        """
+        temperature = temperature if temperature is not None else _DEADBAND_TEMPERATURE
+        humidity = humidity if humidity is not None else _DEADBAND_HUMIDITY
+        self.heartbeat = heartbeat if heartbeat is not None else _DEADBAND_HEARTBEAT
+        self._default = (_counts(temperature, _TEMPERATURE_PER_COUNT), _counts(humidity, _HUMIDITY_PER_COUNT))
+        self._bands = dict(
+            (addr, (_counts(t if t is not None else temperature, _TEMPERATURE_PER_COUNT),
+                    _counts(rh if rh is not None else humidity, _HUMIDITY_PER_COUNT)))
+            for addr, (t, rh) in (sensors if sensors is not None else _DEADBAND_SENSORS).items())
+        self._last = {}  # {sensor: (epoch, temperature word, humidity word)}
+        self.reported = {}
+        self.suppressed = {}
+
+    def filter(self, batch):
+        """Readings of a batch that are to be reported
+        @param batch: readings of one cycle
+        @type batch: readings.ReadingBatch
+        @return: readings.ReadingBatch
+        """
+        result = readings.ReadingBatch()
+        for epoch, addr, t_raw, rh_raw in zip(batch.epochs, batch.addrs, batch.temperature_raw, batch.humidity_raw):
+            t_band, rh_band = self._bands.get(addr, self._default)
+            last = self._last.get(addr)
+            within = last is not None and epoch - last[0] < self.heartbeat
+            if within and abs((t_raw & 0xfffc) - last[1]) <= t_band and abs((rh_raw & 0xfffc) - last[2]) <= rh_band:
+                self.suppressed[addr] = self.suppressed.get(addr, 0) + 1
+                continue
+            self._last[addr] = (epoch, t_raw & 0xfffc, rh_raw & 0xfffc)
+            self.reported[addr] = self.reported.get(addr, 0) + 1
+            result.append(epoch, addr, t_raw, rh_raw)
+        for failure in batch.failures:
+            result.add_failure(*failure)
+        return result
+
+
+def parse_sensors(config):
+    """Per sensor deadbands from a configuration section, keys temperature_<n> and humidity_<n>
+    @param config: section of a configparser
+    @type config: configparser.SectionProxy or dict
+    @return: {sensor: (temperature, humidity)}, None for a value the section does not override
+    """
+    sensors = {}
+    for key in config:
+        kind, _, number = key.rpartition('_')
+        if kind in ('temperature', 'humidity') and number.isdigit():
+            addr = int(number)
+            t, rh = sensors.get(addr, (None, None))  # The defaults are filled in by Deadband
+            value = float(config[key])
+            sensors[addr] = (value, rh) if kind == 'temperature' else (t, value)
+    return sensors
+
+
+def debug():
+    logging.getLogger().debug("_DEADBAND_ENABLED\t\t{}".format(_DEADBAND_ENABLED))
+    logging.getLogger().debug("_DEADBAND_TEMPERATURE\t{}".format(_DEADBAND_TEMPERATURE))
+    logging.getLogger().debug("_DEADBAND_HUMIDITY\t\t{}".format(_DEADBAND_HUMIDITY))
+    logging.getLogger().debug("_DEADBAND_HEARTBEAT\t\t{}".format(_DEADBAND_HEARTBEAT))
+    logging.getLogger().debug("_DEADBAND_SINKS\t\t{}".format(', '.join(_DEADBAND_SINKS)))
+
+# vim: fileencoding=utf-8 filetype=python ts=4 expandtab
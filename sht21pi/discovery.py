@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+@author: Andre Poley
+@contact: andre.poley@mailbox.org
+@copyright: (c) 2019 by Andre Poley, Berkeley
+@license: MIT
+@version: 0.0.5
+@summary: Finds the sensors behind the muxes and keeps the result in a cache file.
+'''
+import os
+import json
+import logging
+import tempfile
+import threading
+
+import i2c
+
+_DISCOVERY_CACHE = '/var/lib/sht21pi/topology.json'
+_DISCOVERY_RESCAN = 86400.  # seconds between two scans, 0 to scan only at startup
+_DISCOVERY_FAILURES = 1     # breakers opened since the last scan that start a new one, 0 to never
+_RESERVED_BITS = 0x38       # Bits 3-5 of the sht21 user register always read 1
+_CACHE_LOCK = threading.Lock()  # The bus threads of a MultiBusScheduler share the cache file
+
+
+def probe(device, mux, addr):
+    """Whether an sht21 answers behind the mux channel of a sensor
+    @param device: Open bus connection
+    @type device: backend.SMBusBackend
+    @param mux: Muxes of the bus
+    @type mux: i2c.MuxController
+    @param addr: The sensor address 1-16
+    @type addr: int
+    @return: bool
+    """
+    try:
+        mux.select_sensor(addr)
+        register = device.read_byte_data(i2c._I2C_ADDRESS, i2c._READ_USER_REGISTER)
+    except IOError:
+        mux.invalidate()
+        return False
+    return register & _RESERVED_BITS == _RESERVED_BITS
+
+
+def scan(device, mux):
+    """Probe every channel of the muxes
+    @param device: Open bus connection
+    @type device: backend.SMBusBackend
+    @param mux: Muxes of the bus
+    @type mux: i2c.MuxController
+    @return: present mask, bit n-1 for sensor n like i2c._SENSORS_PRESENT
+    """
+    present = 0
+    for addr in range(1, 8 * len(mux.mux_addrs) + 1):
+        if probe(device, mux, addr):
+            present |= 1 << (addr - 1)
+    try:
+        mux.disable_all()
+    except IOError:
+        mux.invalidate()
+    return present
+
+
+def _key(bus_nr, mux_addrs):
+    return '{}/{}'.format(bus_nr, '/'.join('{:#04x}'.format(addr) for addr in mux_addrs))
+
+
+def load_cache(path):
+    """@return: {bus key: {'present': int, 'scanned': epoch}}, empty if there is no readable cache"""
+    try:
+        with open(path) as fp:
+            return json.load(fp)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def save_cache(path, cache):
+    """Replace the cache file, a failed write is logged and ignored"""
+    temporary = None
+    try:
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        fd, temporary = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp', dir=directory or '.')
+        with os.fdopen(fd, 'w') as fp:
+            json.dump(cache, fp, indent=1, sort_keys=True)
+        os.rename(temporary, path)
+    except (IOError, OSError) as e:
+        logging.getLogger().error("Cannot write the topology cache {}: {}".format(path, e))
+        if temporary is not None and os.path.exists(temporary):
+            os.remove(temporary)
+
+
+class Discovery(object):
+    """
+    Topology of one bus. At startup the cached topology is used if it is younger than
+    the rescan interval, otherwise the bus is scanned, a rescan interval of 0 always scans.
+    While running the scheduler asks check() after every cycle, which scans again when the
+    interval passed or circuit breakers opened, and hands the sensors found to the scheduler.
+    """
+
+    def __init__(self, bus_nr, mux_addrs, path=None, rescan=None, failures=None):
+        """
+        @param bus_nr: Bus number, part of the cache key
+        @type bus_nr: int
+        @param mux_addrs: I2C addresses of the muxes, part of the cache key
+        @type mux_addrs: (int, int)
+        @param path: Cache file, _DISCOVERY_CACHE if None
+        @type path: str
+        @param rescan: Seconds between two scans, _DISCOVERY_RESCAN if None
+        @type rescan: float
+        @param failures: Opened breakers that start a scan, _DISCOVERY_FAILURES if None
+        @type failures: int
+        """
+        self.key = _key(bus_nr, mux_addrs)
+        self.path = path if path is not None else _DISCOVERY_CACHE
+        self.rescan = rescan if rescan is not None else _DISCOVERY_RESCAN
+        self.failures = failures if failures is not None else _DISCOVERY_FAILURES
+        self.scans = 0
+        self.present = None
+        self._scanned = None
+        self._opened = 0
+
+    def discover(self, device, mux, now):
+        """Sensors at startup, from the cache if it is recent enough
+        @param now: Epoch
+        @type now: int
+        @return: present mask
+        """
+        entry = load_cache(self.path).get(self.key)
+        if entry is not None and self.rescan and now - entry['scanned'] < self.rescan:  # rescan 0 always scans
+            logging.getLogger().info("Sensors of bus {} from the cache: {:#06x}".format(self.key, entry['present']))
+            self.present = entry['present']
+            self._scanned = entry['scanned']
+            return self.present
+        return self.scan(device, mux, now)
+
+    def scan(self, device, mux, now):
+        """Scan the bus and update the cache
+        @return: present mask
+        """
+        self.present = scan(device, mux)
+        self._scanned = now
+        self.scans += 1
+        with _CACHE_LOCK:
+            cache = load_cache(self.path)
+            cache[self.key] = {'present': self.present, 'scanned': now}
+            save_cache(self.path, cache)
+        logging.getLogger().info("Sensors found on bus {}: {:#06x}".format(self.key, self.present))
+        return self.present
+
+    def check(self, cycle):
+        """Scan again if it is due and update the sensors of the scheduler
+        @param cycle: Scheduler of the bus
+        @type cycle: scheduler.PipelinedScheduler
+        """
+        now = int(cycle.clock.time())
+        opened = sum(breaker.opened for breaker in cycle.breakers.values())
+        failed = self.failures and opened - self._opened >= self.failures
+        if not failed and not (self.rescan and now - self._scanned >= self.rescan):
+            return
+        present = self.scan(cycle.bus, cycle.mux, now)
+        cycle.set_addrs([addr for addr in range(1, 17) if (present >> (addr - 1)) & 0x1])
+        self._opened = sum(breaker.opened for breaker in cycle.breakers.values())
+
+
+def debug():
+    logging.getLogger().debug("_DISCOVERY_CACHE\t\t{}".format(_DISCOVERY_CACHE))
+    logging.getLogger().debug("_DISCOVERY_RESCAN\t\t{}".format(_DISCOVERY_RESCAN))
+    logging.getLogger().debug("_DISCOVERY_FAILURES\t\t{}".format(_DISCOVERY_FAILURES))
+
+# vim: fileencoding=utf-8 filetype=python ts=4 expandtab
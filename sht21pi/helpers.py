@@ -8,7 +8,94 @@
 @version: 0.0.3
 @summary: Some helper functions to make life easier
 '''
+import os
 import logging
+import time
+import contextlib
+
+_CLOCK_MONOTONIC = 1  # linux/time.h
+
+
+def _libc_monotonic():
+    """CLOCK_MONOTONIC of clock_gettime through ctypes, for python2 which has no time.monotonic
+    @return: function returning seconds, None if libc does not provide the clock
+    """
+    try:
+        import ctypes
+        import ctypes.util
+        try:
+            libc = ctypes.CDLL('librt.so.1', use_errno=True)
+        except OSError:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        clock_gettime = libc.clock_gettime
+    except (ImportError, OSError, AttributeError):
+        return None
+
+    class Timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(Timespec)]
+
+    def monotonic():
+        spec = Timespec()  # One per call, the bus threads read the clock concurrently
+        if clock_gettime(_CLOCK_MONOTONIC, ctypes.byref(spec)) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return spec.tv_sec + spec.tv_nsec * 1e-9
+    return monotonic
+
+
+# Monotonic clock for scheduling, it does not jump with NTP or manual clock steps. Only a
+# python2 without clock_gettime falls back to the wall clock.
+monotonic = getattr(time, 'monotonic', None) or _libc_monotonic() or time.time
+
+
+class Clock(object):
+    """Time source of the acquisition. A simulated bus brings its own clock
+    running on virtual time, real buses use this one."""
+    monotonic = staticmethod(monotonic)
+    sleep = staticmethod(time.sleep)
+    time = staticmethod(time.time)
+
+
+CLOCK = Clock()
+
+
+class StartupProfile(object):
+    """Time spent in the phases of the startup, phases can be nested"""
+
+    def __init__(self):
+        self.phases = []  # [[depth, name, seconds]] in the order the phases started
+        self._depth = 0
+
+    def add(self, name, seconds):
+        self.phases.append([self._depth, name, seconds])
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Time the body of a with statement as a phase"""
+        phase = [self._depth, name, monotonic()]
+        self.phases.append(phase)
+        self._depth += 1
+        try:
+            yield
+        finally:
+            self._depth -= 1
+            phase[2] = monotonic() - phase[2]
+
+    def report(self):
+        """@return: one line per phase with its time in milliseconds"""
+        return '\n'.join('{:<32} {:>8.1f} ms'.format('  ' * depth + name, seconds * 1000.)
+                         for depth, name, seconds in self.phases)
+
+
+def get_clock(device):
+    """Clock of a bus connection
+    @param device: Open bus connection
+    @type device: backend.SMBusBackend
+    @return: Clock
+    """
+    return getattr(device, 'clock', CLOCK)
 
 
 def debugging():
@@ -23,17 +110,25 @@ def to_bool(s):
         return False
 
 
+def format_log(message):
+    """Format readings as lines of the data log
+    @param message: sensor readings
+    @type message: readings.ReadingBatch or [[int, int, float, float]]
+    @return: str
+    """
+    return ''.join(["{}, {}, {}, {}\n".format(epoch, addr, temp, humi) for epoch, addr, temp, humi in message])
+
+
 def write_log(logfile, message):
     """Write to data log
     @param message: An array with sensors readings to be written to the data log.
-    @type message: [[int, int, float, float]]
+    @type message: readings.ReadingBatch or [[int, int, float, float]]
     @return: None
     """
     try:
         fp = open(logfile, 'a')
         logging.getLogger().info("logging to {}".format(logfile))
-        for i in range(len(message)):
-            fp.write("{}, {}, {}, {}\n".format(message[i][0], message[i][1], message[i][2], message[i][3]))
+        fp.write(format_log(message))
     except IOError as e:
         raise IOError("Cannot access file {}".format(e), exc_info=True)
     except UnboundLocalError as e:
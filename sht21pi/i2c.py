@@ -8,20 +8,57 @@
 @version: 0.0.3
 @summary: read specified i2c address. Returns: epoch, address, temperature, humidity
 '''
-import sys
+import errno
 import logging
-import time
+
+import helpers
 
 _SOFTRESET = 0xFE
 _I2C_ADDRESS = 0x40
 _TRIGGER_TEMPERATURE_NO_HOLD = 0xF3
 _TRIGGER_HUMIDITY_NO_HOLD = 0xF5
+_READ_USER_REGISTER = 0xE7
+_WRITE_USER_REGISTER = 0xE6
+_RESOLUTION_MASK = 0x81  # bit 7 and bit 0 of the user register
+_CRC_POLYNOMIAL = 0x131  # x^8 + x^5 + x^4 + 1, datasheet (v4), page 14
+_CRC_RETRIES = 2         # New conversions started after a checksum mismatch
 
 # datasheet (v4), page 9, table 7, thanks to Martin Milata
 # for suggesting the use of these better values
 # code copied from https://github.com/mmilata/growd
 _TEMPERATURE_WAIT_TIME = 0.086  # (datasheet: typ=66, max=85)
 _HUMIDITY_WAIT_TIME = 0.030     # (datasheet: typ=22, max=29)
+_TEMPERATURE_TYPICAL_TIME = 0.066
+_HUMIDITY_TYPICAL_TIME = 0.022
+
+# datasheet (v4), page 9, table 7 and page 10, table 8. Conversion times scale with
+# the resolution, the maximum times are rounded up by 1ms like the values above.
+# (temperature bits, humidity bits): (user register bits, T max, T typ, RH max, RH typ)
+_RESOLUTIONS = {
+    (14, 12): (0x00, 0.086, 0.066, 0.030, 0.022),
+    (13, 10): (0x80, 0.044, 0.033, 0.010, 0.007),
+    (12, 8): (0x01, 0.023, 0.017, 0.005, 0.003),
+    (11, 11): (0x81, 0.012, 0.009, 0.016, 0.012),
+}
+_RESOLUTION = (14, 12)
+
+# Ready detection: the sensor NACKs its read header until the conversion is done.
+# Polling starts shortly before the typical conversion time and backs off up to
+# the maximum wait time, after which the fixed wait is used as fallback.
+_READY_POLLING = False
+_POLL_START_FACTOR = 0.8
+_POLL_BACKOFF_MIN = 0.001
+_POLL_BACKOFF_MAX = 0.004
+_NACK_ERRNOS = (errno.EIO, errno.ENXIO, getattr(errno, 'EREMOTEIO', 121))
+
+# Measured conversion times per sensor: {i2c_addr: {'temperature': s, 'humidity': s}}
+_CONVERSION_TIMES = {}
+
+
+class ChecksumError(IOError):
+    """The checksum sent by the sensor does not match the data"""
+    pass
+
 
 _SENSORS_PRESENT = 0x0000
 _SENSORS_ADDR = []
@@ -36,6 +73,7 @@ def read_i2c_addr(i2c_addr):
     @param i2c_addr: The i2c address to be read
     @type i2c_addr: int
     @return: array with time, address, temperature and humidity
+    @raise IOError: the sensor did not answer or sent corrupted data
     @summary: use mux1 for sensors 1-8 and mux2 for the others.
     Substract 8 to match the actual address for the multiplex slave
     """
@@ -45,37 +83,200 @@ def read_i2c_addr(i2c_addr):
     else:
         selectMuxOut(_SENSORS_MUX2_ADDR, i2c_addr - 8)
     try:
-        temp = read_temperature()
-        humi = read_humidity()
-
-        return [int(time.time()), int(i2c_addr), float(temp), float(humi)]
-    except Exception as e:
-        raise Exception('Cannot read sensors {}'.format(e))
-    finally:
-        logging.getLogger().info(
-            "Read sensor\t\t\t'{}': {} {}".format(int(i2c_addr), float(temp), float(humi)))
+        temp = read_temperature(i2c_addr)
+        humi = read_humidity(i2c_addr)
+    except IOError as e:
+        raise IOError(e.errno, 'Cannot read sensor {}: {}'.format(i2c_addr, e))
+    logging.getLogger().info("Read sensor\t\t\t'{}': {} {}".format(int(i2c_addr), float(temp), float(humi)))
+    return [int(helpers.get_clock(bus).time()), int(i2c_addr), float(temp), float(humi)]
 
 
-def read_temperature():
+def read_temperature(i2c_addr=None):
     """Reads the temperature from the sensor.  Note that this call blocks for
     250ms to allow the sensor to return the data
+    @param i2c_addr: Sensor address the measured conversion time is recorded for
+    @type i2c_addr: int
+    @raise IOError: the sensor did not answer or sent corrupted data
     """
-    data = []
     try:
-        bus.write_byte(_I2C_ADDRESS, _TRIGGER_TEMPERATURE_NO_HOLD)
-        time.sleep(_TEMPERATURE_WAIT_TIME)
-        data.append(bus.read_byte(_I2C_ADDRESS))
-        data.append(bus.read_byte(_I2C_ADDRESS))
-        temp = _get_temperature_from_buffer(data)
-    except IOError:
-        temp = -400.
+        data, elapsed = _measure(_TRIGGER_TEMPERATURE_NO_HOLD, _TEMPERATURE_WAIT_TIME, _TEMPERATURE_TYPICAL_TIME)
+    except IOError as err:
         logging.getLogger().error(
             "Cannot read temperature from I2C address: {}".format(_I2C_ADDRESS), exc_info=True)
-        raise IOError(
-            "Cannot read temperature from I2C address: {}".format(_I2C_ADDRESS), exc_info=True)
-    finally:
-        logging.getLogger().debug("read_temperature:\t\t{}".format(temp))
-        return temp
+        raise IOError(err.errno, "Cannot read temperature from I2C address: {} ({})".format(_I2C_ADDRESS, err))
+    _record_conversion_time(i2c_addr, 'temperature', elapsed)
+    temp = _get_temperature_from_buffer(data)
+    logging.getLogger().debug("read_temperature:\t\t{}".format(temp))
+    return temp
+
+
+def _measure(command, wait_time, typical_time):
+    """Trigger a conversion on the selected sensor and read the result,
+    starting a new conversion if the checksum does not match.
+    @return: tuple of [msb, lsb] and the conversion time in seconds
+    """
+    for attempt in range(_CRC_RETRIES + 1):
+        bus.write_byte(_I2C_ADDRESS, command)
+        try:
+            return _read_when_ready(bus, helpers.get_clock(bus).monotonic(), wait_time, typical_time)
+        except ChecksumError as err:
+            if attempt == _CRC_RETRIES:
+                raise
+            logging.getLogger().warning("{}, retrying".format(err))
+
+
+def _crc8(data):
+    """Checksum of the sensor as described in the datasheet
+    @param data: bytes to check
+    @type data: bytearray
+    @return: int
+    """
+    crc = 0
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            if crc & 0x80:
+                crc = (crc << 1) ^ _CRC_POLYNOMIAL
+            else:
+                crc <<= 1
+    return crc
+
+
+def _read_buffer(device):
+    """Read the result of a finished conversion from the selected sensor. MSB, LSB
+    and checksum are read in a single transaction and the checksum is verified.
+    @param device: Open bus connection
+    @type device: backend.SMBusBackend
+    @return: [msb, lsb]
+    """
+    data = device.read_block(_I2C_ADDRESS, 3)
+    if _crc8(data[:2]) != data[2]:
+        raise ChecksumError("Checksum mismatch from I2C address {}: {:02x}{:02x} crc {:02x}".format(
+            _I2C_ADDRESS, data[0], data[1], data[2]))
+    return [data[0], data[1]]
+
+
+def _poll_buffer(device, started, wait_time, typical_time, result):
+    """Generator waiting for a conversion and reading its result. Yields the seconds
+    to wait before the next transfer and appends ([msb, lsb], conversion time) to result.
+    With _READY_POLLING the sensor is read until it stops NACKing, with a bounded
+    backoff. Any other error or running past wait_time falls back to the fixed wait.
+    A ChecksumError is raised as is, the result is gone and needs a new conversion.
+    @param device: Open bus connection with the sensor selected
+    @type device: backend.SMBusBackend
+    @param started: Clock time the conversion was triggered, see helpers.get_clock
+    @type started: float
+    @param wait_time: Maximum conversion time
+    @type wait_time: float
+    @param typical_time: Typical conversion time
+    @type typical_time: float
+    @param result: list receiving the result
+    @type result: list
+    """
+    clock = helpers.get_clock(device)
+    deadline = started + wait_time
+    if _READY_POLLING:
+        delay = started + typical_time * _POLL_START_FACTOR - clock.monotonic()
+        if delay > 0:
+            yield delay
+        backoff = _POLL_BACKOFF_MIN
+        while True:
+            try:
+                data = _read_buffer(device)
+                result.append((data, clock.monotonic() - started))
+                return
+            except ChecksumError:
+                raise
+            except IOError as err:
+                if err.errno not in _NACK_ERRNOS:
+                    logging.getLogger().debug("Ready polling failed, using fixed wait: {}".format(err))
+                    break
+            if clock.monotonic() + backoff > deadline:
+                break
+            yield backoff
+            backoff = min(backoff * 2, _POLL_BACKOFF_MAX)
+    delay = deadline - clock.monotonic()
+    if delay > 0:
+        yield delay
+    data = _read_buffer(device)
+    result.append((data, clock.monotonic() - started))
+
+
+def _read_when_ready(device, started, wait_time, typical_time):
+    """Blocking variant of _poll_buffer
+    @return: tuple of [msb, lsb] and the conversion time in seconds
+    """
+    result = []
+    clock = helpers.get_clock(device)
+    for delay in _poll_buffer(device, started, wait_time, typical_time, result):
+        clock.sleep(delay)
+    return result[0]
+
+
+def _record_conversion_time(i2c_addr, kind, elapsed):
+    """Keep the last measured conversion time of a sensor
+    @param kind: 'temperature' or 'humidity'
+    @type kind: str
+    """
+    if i2c_addr is None:
+        return
+    _CONVERSION_TIMES.setdefault(i2c_addr, {})[kind] = elapsed
+    logging.getLogger().debug("conversion {} {}:\t\t{:.1f}ms".format(kind, i2c_addr, elapsed * 1000))
+
+
+def parse_resolution(text):
+    """Parse a resolution from the configuration file
+    @param text: temperature and humidity bits, e.g. '14/12' or '12/8'
+    @type text: str
+    @return: (temperature bits, humidity bits)
+    """
+    try:
+        resolution = tuple(int(bits) for bits in text.split('/'))
+    except ValueError:
+        resolution = None
+    if resolution not in _RESOLUTIONS:
+        raise ValueError("Unsupported resolution '{}', use one of {}".format(
+            text, ', '.join('{}/{}'.format(*r) for r in sorted(_RESOLUTIONS))))
+    return resolution
+
+
+def set_resolution(resolution):
+    """Use the conversion times of a resolution for all following reads
+    @param resolution: (temperature bits, humidity bits)
+    @type resolution: (int, int)
+    """
+    global _RESOLUTION, _TEMPERATURE_WAIT_TIME, _TEMPERATURE_TYPICAL_TIME, _HUMIDITY_WAIT_TIME, _HUMIDITY_TYPICAL_TIME
+    bits, t_max, t_typ, rh_max, rh_typ = _RESOLUTIONS[resolution]
+    _RESOLUTION = resolution
+    _TEMPERATURE_WAIT_TIME = t_max
+    _TEMPERATURE_TYPICAL_TIME = t_typ
+    _HUMIDITY_WAIT_TIME = rh_max
+    _HUMIDITY_TYPICAL_TIME = rh_typ
+
+
+def write_resolution(device, resolution):
+    """Write the resolution to the user register of the selected sensor,
+    the reserved bits of the register are kept as they are.
+    @param device: Open bus connection with the sensor selected
+    @type device: backend.SMBusBackend
+    @param resolution: (temperature bits, humidity bits)
+    @type resolution: (int, int)
+    """
+    register = device.read_byte_data(_I2C_ADDRESS, _READ_USER_REGISTER)
+    register = (register & ~_RESOLUTION_MASK & 0xff) | _RESOLUTIONS[resolution][0]
+    device.write_byte_data(_I2C_ADDRESS, _WRITE_USER_REGISTER, register)
+
+
+def read_resolution(device):
+    """Read the resolution back from the user register of the selected sensor
+    @param device: Open bus connection with the sensor selected
+    @type device: backend.SMBusBackend
+    @return: (temperature bits, humidity bits)
+    """
+    bits = device.read_byte_data(_I2C_ADDRESS, _READ_USER_REGISTER) & _RESOLUTION_MASK
+    for resolution, values in _RESOLUTIONS.items():
+        if values[0] == bits:
+            return resolution
 
 
 def _get_temperature_from_buffer(data):
@@ -88,26 +289,23 @@ def _get_temperature_from_buffer(data):
     return unadjusted
 
 
-def read_humidity():
+def read_humidity(i2c_addr=None):
     """Reads the humidity from the sensor.  Not that this call blocks
-    for 250ms to allow the sensor to return the data"""
-    data = []
+    for 250ms to allow the sensor to return the data
+    @param i2c_addr: Sensor address the measured conversion time is recorded for
+    @type i2c_addr: int
+    @raise IOError: the sensor did not answer or sent corrupted data
+    """
     try:
-        bus.write_byte(_I2C_ADDRESS, _TRIGGER_HUMIDITY_NO_HOLD)
-        time.sleep(_HUMIDITY_WAIT_TIME)
-        data.append(bus.read_byte(_I2C_ADDRESS))
-        data.append(bus.read_byte(_I2C_ADDRESS))
-        temp = _get_humidity_from_buffer(data)
+        data, elapsed = _measure(_TRIGGER_HUMIDITY_NO_HOLD, _HUMIDITY_WAIT_TIME, _HUMIDITY_TYPICAL_TIME)
     except IOError as err:
         logging.getLogger().error(
             "Cannot read humidity from I2C address: {}\n{}".format(_I2C_ADDRESS, err), exc_info=True)
-        temp = -100.
-        raise IOError(
-            "Cannot read humidity from I2C address: {} ({})".format(_I2C_ADDRESS, err))
-        sys.exit(1)
-    finally:
-        logging.getLogger().debug("read_humidity:\t\t{}".format(temp))
-        return temp
+        raise IOError(err.errno, "Cannot read humidity from I2C address: {} ({})".format(_I2C_ADDRESS, err))
+    _record_conversion_time(i2c_addr, 'humidity', elapsed)
+    humi = _get_humidity_from_buffer(data)
+    logging.getLogger().debug("read_humidity:\t\t{}".format(humi))
+    return humi
 
 
 def _get_humidity_from_buffer(data):
@@ -120,12 +318,107 @@ def _get_humidity_from_buffer(data):
     return unadjusted
 
 
+def _get_raw_from_temperature(temperature):
+    """Inverse of _get_temperature_from_buffer, recovers the 16 bit sensor word
+    @param temperature: Temperature in C
+    @type temperature: float
+    @return: int
+    """
+    return int(round((temperature + 46.85) * (1 << 16) / 175.72)) & 0xfffc
+
+
+def _get_raw_from_humidity(humidity):
+    """Inverse of _get_humidity_from_buffer, recovers the 16 bit sensor word
+    @param humidity: Relative humidity in percent
+    @type humidity: float
+    @return: int
+    """
+    return int(round((humidity + 6.0) * (1 << 16) / 125.0)) & 0xfffc
+
+
+class MuxController(object):
+    """
+    Keeps track of the channel each multiplexer has open. All sensors share one
+    address, so only one channel of one mux may be open at a time. The channel
+    register is only written when it changes and the other muxes are only
+    disabled if they may have a channel open.
+    """
+
+    def __init__(self, device, mux_addrs):
+        """
+        @param device: Open bus connection
+        @type device: backend.SMBusBackend
+        @param mux_addrs: I2C addresses of the muxes, sensors 1-8 on the first, 9-16 on the second
+        @type mux_addrs: [int]
+        """
+        self.device = device
+        self.mux_addrs = list(mux_addrs)
+        self.writes = 0
+        self.skipped_writes = 0
+        self.invalidate()
+
+    def invalidate(self):
+        """Forget the mux state, e.g. after a failed transfer. The next select writes again."""
+        self._channels = dict((addr, None) for addr in self.mux_addrs)
+
+    def select(self, mux_addr, channels):
+        """Open channels on one mux and close all others
+        @param mux_addr: I2C address of the mux
+        @type mux_addr: int
+        @param channels: channel register value, one bit per channel
+        @type channels: int
+        """
+        for other in self.mux_addrs:
+            if other != mux_addr and self._channels[other] != 0x00:
+                self._write(other, 0x00)
+        if self._channels.get(mux_addr) == channels:
+            self.skipped_writes += 1
+            return
+        self._write(mux_addr, channels)
+
+    def select_sensor(self, i2c_addr):
+        """Open the channel of a sensor
+        @param i2c_addr: The sensor address 1-16
+        @type i2c_addr: int
+        """
+        mux = (i2c_addr - 1) // 8
+        self.select(self.mux_addrs[mux], 0x01 << ((i2c_addr - 1) % 8))
+
+    def disable_all(self):
+        """Close the channels of all muxes"""
+        for addr in self.mux_addrs:
+            if self._channels[addr] != 0x00:
+                self._write(addr, 0x00)
+
+    def _write(self, addr, channels):
+        try:
+            self.device.write_byte(addr, channels)
+        except IOError:
+            self._channels[addr] = None
+            raise
+        self._channels[addr] = channels
+        self.writes += 1
+
+
+_MUX = None
+
+
 def selectMuxOut(address, index):
+    """Open a channel of a mux, index 0 closes all of its channels.
+    Goes through a MuxController for the configured muxes on the module bus.
+    @param address: I2C address of the mux
+    @type address: int
+    @param index: channel 1-8 or 0
+    @type index: int
+    """
+    global _MUX
     logging.getLogger().debug("MuxOut address:\t\t{} index: {}".format(hex(address), hex(index)))
+    if _MUX is None or _MUX.device is not bus:
+        _MUX = MuxController(bus, [_SENSORS_MUX1_ADDR, _SENSORS_MUX2_ADDR])
     if index != 0:
-        bus.write_byte(address, 0x01 << (index - 1))
+        _MUX.select(address, 0x01 << (index - 1))
     else:
-        bus.write_byte(0x71, 0x00)
+        _MUX.select(address, 0x00)
 
 
 def __enter__(self):
@@ -148,5 +441,7 @@ def debug():
     logging.getLogger().debug('_SENSORS_ADDR:\t\t{}'.format(_SENSORS_ADDR))
     logging.getLogger().debug('_SENSORS_MUX1_ADDR:\t\t{}'.format(hex(_SENSORS_MUX1_ADDR)))
     logging.getLogger().debug('_SENSORS_MUX2_ADDR:\t\t{}'.format(hex(_SENSORS_MUX2_ADDR)))
+    logging.getLogger().debug('_READY_POLLING:\t\t{}'.format(_READY_POLLING))
+    logging.getLogger().debug('_RESOLUTION:\t\t\t{}/{}'.format(*_RESOLUTION))
 
 # vim: fileencoding=utf-8 filetype=python ts=4 expandtab
@@ -9,22 +9,314 @@
 @summary: Write input data to an influxdb
 '''
 import socket
-import sys
+import time
+import zlib
 import logging
 import requests
 
+import aggregate
+import helpers
+import readings
+
+_SESSION = None
+_HOSTNAME = None
+_LINE_FORMAT = '{} temperature={},humidity={} {}'
+_STATUS_FORMAT = '{} status="{}" {}'
+_AGGREGATE_FORMAT = ('{}_{},{} count={}i,temperature_min={},temperature_mean={},temperature_max={},'
+                     'humidity_min={},humidity_mean={},humidity_max={} {}')
+_MAX_RETRY_INTERVAL = 300.
+_RETRY_STATUS = (408, 429)  # Client errors that are worth a retry, the server drops the rest for good
+
+
+def _get_hostname():
+    """ Get the host name once, it is part of every line
+    @return: str
+    """
+    global _HOSTNAME
+    if _HOSTNAME is None:
+        _HOSTNAME = socket.gethostname()
+    return _HOSTNAME
+
+
+def _gzip(data):
+    """ Compress a request body with gzip framing for Content-Encoding: gzip
+    @param data: body
+    @type data: str
+    @return: bytes
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data.encode('utf-8')) + compressor.flush()
+
+
+class InfluxWriter(object):
+    """
+    Batches readings in the influx line protocol and posts them over a pooled
+    http session. A batch is sent once it holds batch_size lines or its oldest
+    line is batch_age seconds old. Lines of a failed post are kept for the next
+    flush, up to max_lines, the oldest are dropped beyond that.
+
+    With a spool.Spool all lines go through the spool on disk instead and are
+    only removed once the server accepted them. After an outage the backlog is
+    sent in batches of drain_batch lines, at most drain_rate lines per second.
+    After a failed post, write() waits retry_interval (doubling up to
+    _MAX_RETRY_INTERVAL) before it tries again, so acquisition is not held up by
+    connection timeouts every cycle. A batch the server refuses with a client error,
+    e.g. 400 for a bad line or a field type conflict, would be refused again, so it is
+    logged and dropped instead and the spool keeps draining behind it.
+    """
+
+    def __init__(self, server, database, user, password,
+                 batch_size=500, batch_age=60., compress=True, timeout=10., max_lines=100000,
+                 spool=None, drain_batch=5000, drain_rate=20000., retry_interval=30.):
+        """
+        @param server: host:port of the influx server
+        @type server: str
+        @param database: database, also used as measurement name
+        @type database: str
+        @param batch_size: lines that trigger a post
+        @type batch_size: int
+        @param batch_age: seconds after which buffered lines are posted
+        @type batch_age: float
+        @param compress: gzip the request body
+        @type compress: bool
+        @param timeout: connect and read timeout of a post in seconds
+        @type timeout: float
+        @param max_lines: lines kept in memory while the server is unreachable, without spool
+        @type max_lines: int
+        @param spool: durable buffer all lines go through
+        @type spool: spool.Spool
+        @param drain_batch: lines per post when sending the spooled backlog
+        @type drain_batch: int
+        @param drain_rate: maximum lines per second when sending the spooled backlog
+        @type drain_rate: float
+        @param retry_interval: seconds to wait after a failed post
+        @type retry_interval: float
+        """
+        self.url = 'http://{}/write'.format(server)
+        self.params = {'precision': 's', 'db': database}
+        self.database = database
+        self.batch_size = batch_size
+        self.batch_age = batch_age
+        self.compress = compress
+        self.timeout = timeout
+        self.max_lines = max_lines
+        self.spool = spool
+        self.drain_batch = drain_batch
+        self.drain_rate = drain_rate
+        self.retry_interval = retry_interval
+        self._retry_delay = retry_interval
+        self._retry_at = None
+        self._backlog = len(spool) if spool is not None else 0
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=2)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.auth = (user, password)
+        self.session.verify = False
+        self._tags = {}
+        self._lines = []
+        self._oldest = helpers.monotonic() if self._backlog else None
+        self.posts = 0
+        self.posted_lines = 0
+        self.posted_bytes = 0
+        self.failures = 0
+        self.rejected_lines = 0
+        self.last_post_latency = 0.
+        self.post_time = 0.
+
+    def _tag_set(self, addr):
+        """ Measurement and tags of a sensor, computed once per sensor """
+        try:
+            return self._tags[addr]
+        except KeyError:
+            tag = '{},host={}-{}'.format(self.database, _get_hostname(), addr)
+            self._tags[addr] = tag
+            return tag
+
+    def encode(self, log):
+        """ Encode readings in the line protocol, failed sensors of a batch as status points
+        @param log: readings
+        @type log: readings.ReadingBatch or [[int, int, float, float]]
+        @return: [str]
+        """
+        lines = [_LINE_FORMAT.format(self._tag_set(addr), temp, humi, epoch) for epoch, addr, temp, humi in log]
+        for epoch, addr, status in getattr(log, 'failures', ()):
+            lines.append(_STATUS_FORMAT.format(self._tag_set(addr), readings.STATUS_NAMES[status], epoch))
+        return lines
+
+    def encode_aggregates(self, aggregates):
+        """ Encode aggregates in the line protocol, one measurement per window, e.g. sht21_15m
+        @param aggregates: finished windows
+        @type aggregates: [aggregate.Aggregate]
+        @return: [str]
+        """
+        lines = []
+        for row in aggregates:
+            measurement, tags = self._tag_set(row.addr).split(',', 1)
+            fields = row[3:] + (row.start,)
+            lines.append(_AGGREGATE_FORMAT.format(measurement, aggregate.window_name(row.window), tags, *fields))
+        return lines
+
+    def write(self, log):
+        """ Buffer readings and post them if the batch is due
+        @param log: readings
+        @type log: readings.ReadingBatch or [[int, int, float, float]]
+        @return: None
+        """
+        if not log and not getattr(log, 'failures', None):
+            return
+        self._buffer(self.encode(log))
+
+    def write_aggregates(self, aggregates):
+        """ Buffer aggregates and post them if the batch is due
+        @param aggregates: finished windows
+        @type aggregates: [aggregate.Aggregate]
+        @return: None
+        """
+        if aggregates:
+            self._buffer(self.encode_aggregates(aggregates))
+
+    def _buffer(self, lines):
+        if self._oldest is None:
+            self._oldest = helpers.monotonic()
+        if self.spool is not None:
+            self.spool.append(lines)
+            self._backlog += len(lines)
+        else:
+            self._lines.extend(lines)
+        if self.due():
+            self.flush()
+
+    def buffered(self):
+        """ Lines waiting to be posted, in memory or in the spool """
+        return self._backlog if self.spool is not None else len(self._lines)
+
+    def due(self):
+        """ True if the buffered lines should be posted """
+        buffered = self.buffered()
+        if not buffered:
+            return False
+        now = helpers.monotonic()
+        if self._retry_at is not None and now < self._retry_at:
+            return False
+        return buffered >= self.batch_size or now - self._oldest >= self.batch_age
+
+    def flush(self):
+        """ Post all buffered lines
+        @return: True if the server accepted them
+        """
+        if self.spool is not None:
+            return self._drain()
+        if not self._lines:
+            return True
+        if self.post(self._lines):
+            self._lines = []
+            self._oldest = None
+            return True
+        if len(self._lines) > self.max_lines:
+            logging.getLogger().error("Influx buffer full, dropping {} lines".format(len(self._lines) - self.max_lines))
+            del self._lines[:len(self._lines) - self.max_lines]
+        return False
+
+    def _drain(self):
+        """ Post the spooled lines oldest first, rate limited to drain_rate lines per second
+        @return: True if the spool is empty
+        """
+        pause = 0
+        while True:
+            last_id, lines = self.spool.peek(self.drain_batch)
+            if last_id is None:
+                self._backlog = 0
+                self._oldest = None
+                return True
+            if pause > 0:
+                time.sleep(pause)
+            started = helpers.monotonic()
+            if not self.post(lines):
+                return False
+            self.spool.ack(last_id)
+            self._backlog = max(0, self._backlog - len(lines))
+            pause = len(lines) / float(self.drain_rate) - (helpers.monotonic() - started)
+
+    def post(self, lines):
+        """ Post lines to the server
+        @param lines: line protocol lines
+        @type lines: [str]
+        @return: True if the server accepted them or rejected them for good
+        """
+        body = '\n'.join(lines)
+        headers = {'Content-Type': 'text/plain; charset=utf-8'}
+        if self.compress:
+            body = _gzip(body)
+            headers['Content-Encoding'] = 'gzip'
+        started = helpers.monotonic()
+        try:
+            response = self.session.post(
+                self.url, params=self.params, data=body, headers=headers, timeout=self.timeout)
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            self._timed(started)
+            status = e.response.status_code if e.response is not None else None
+            if status is not None and 400 <= status < 500 and status not in _RETRY_STATUS:
+                self.rejected_lines += len(lines)
+                logging.getLogger().error("Influx rejected {} lines, dropping them: {} {} first line: {}".format(
+                    len(lines), e, e.response.text.strip(), lines[0]), exc_info=False)
+                return True
+            self.failures += 1
+            self._retry_at = helpers.monotonic() + self._retry_delay
+            self._retry_delay = min(self._retry_delay * 2, _MAX_RETRY_INTERVAL)
+            logging.getLogger().error("Cannot write to influx: {}".format(e), exc_info=False)
+            return False
+        self._timed(started)
+        self._retry_at = None
+        self._retry_delay = self.retry_interval
+        self.posts += 1
+        self.posted_lines += len(lines)
+        self.posted_bytes += len(body)
+        logging.getLogger().info("Wrote {} lines ({} bytes) to influx".format(len(lines), len(body)))
+        return True
+
+    def _timed(self, started):
+        self.last_post_latency = helpers.monotonic() - started
+        self.post_time += self.last_post_latency
+
+    def close(self):
+        """ Post what is left and close the session and the spool """
+        self.flush()
+        self.session.close()
+        if self.spool is not None:
+            self.spool.close()
+
+
+def _get_session():
+    """ Get the http session, created on first use and kept open so a long
+    running process reuses the connection to the server
+    @return: requests.Session
+    """
+    global _SESSION
+    if _SESSION is None:
+        _SESSION = requests.Session()
+    return _SESSION
+
+
+def close():
+    """ Close the http session if one was opened
+    @return: None
+    """
+    global _SESSION
+    if _SESSION is not None:
+        _SESSION.close()
+        _SESSION = None
+
 
 def prepare_data(log):
     """ Prepare the logged data for a batched influx line interface query
     @param log: A group of comma seperated values
     @type log: [[int][int][float][float]]
     """
-    data = []
-    for i in range(len(log)):
-        data.append(
-            '{},host={}-{} temperature={},humidity={} {}'
-            .format(_INFLUX_DATABASE, socket.gethostname(), log[i][1], log[i][2], log[i][3], log[i][0]))
-    return data
+    host = '{},host={}'.format(_INFLUX_DATABASE, _get_hostname())
+    return ['{}-{} temperature={},humidity={} {}'.format(host, addr, temp, humi, epoch)
+            for epoch, addr, temp, humi in log]
 
 
 def post_to_database(args):
@@ -36,13 +328,11 @@ def post_to_database(args):
         ('precision', 's'),
         ('db', '{}'.format(_INFLUX_DATABASE)),
     )
-    data = ''
-    for i in range(len(args)):
-        data = "{}\n{}".format(data, args[i])
+    data = '\n'.join(args)
     try:
         logging.getLogger().debug("Influx query: {}".format(data))
-        # response = requests.post(
-        requests.post(
+        # response = _get_session().post(
+        _get_session().post(
             'http://{}/write'
             .format(_INFLUX_SERVER),
             params=params,
@@ -58,9 +348,7 @@ def post_to_database(args):
     except requests.exceptions.TooManyRedirects as errr:
         print("Too many redirects: {}".format(errr))
     except requests.exceptions.RequestException as e:
-        # catastrophic error. bail.
-        print(e)
-        sys.exit(1)
+        print("Request failed: {}".format(e))
     finally:
         logging.getLogger().info("Wrote to influx ")
 
@@ -70,3 +358,7 @@ def debug():
     logging.getLogger().debug("_INFLUX_DATABASE\t\t{}".format(_INFLUX_DATABASE))
     logging.getLogger().debug("_INFLUX_USER\t\t\t{}".format(_INFLUX_USER))
     logging.getLogger().debug("_INXLUX_PASSWORD\t\t{}".format(_INFLUX_PASSWORD))
+    logging.getLogger().debug("_INFLUX_BATCH_SIZE\t\t{}".format(_INFLUX_BATCH_SIZE))
+    logging.getLogger().debug("_INFLUX_BATCH_AGE\t\t{}".format(_INFLUX_BATCH_AGE))
+    logging.getLogger().debug("_INFLUX_GZIP\t\t\t{}".format(_INFLUX_GZIP))
+    logging.getLogger().debug("_INFLUX_SPOOL\t\t\t{}".format(_INFLUX_SPOOL))
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+@author: Andre Poley
+@contact: andre.poley@mailbox.org
+@copyright: (c) 2019 by Andre Poley, Berkeley
+@license: MIT
+@version: 0.0.5
+@summary: Latest reading of every sensor in a memory mapped file, for local readers like displays or alarms.
+'''
+import os
+import sys
+import mmap
+import errno
+import struct
+import logging
+import collections
+
+import readings
+
+_LATEST_ENABLED = False
+_LATEST_PATH = '/run/sht21pi/latest'
+
+# File: header, then one slot per sensor address. The layout is fixed so readers in other
+# languages can map it too, all numbers are little endian.
+_MAGIC = b'SHT21LT\x00'
+_VERSION = 1
+_SLOTS = 256  # Sensor addresses are one byte
+_HEADER = struct.Struct('<8sHHHxxI')  # magic, version, slots, slot size, cycle
+# Slot: sequence, epoch, sensor address, status, raw temperature word, raw humidity word.
+# The sequence is odd while the writer changes the slot, see LatestReader.read.
+_SLOT = struct.Struct('<IIBBHHxx')
+_SEQUENCE = struct.Struct('<I')
+_RETRIES = 1000
+
+Reading = collections.namedtuple('Reading', (
+    'addr', 'epoch', 'status', 'temperature_raw', 'humidity_raw', 'sequence', 'temperature', 'humidity'))
+
+
+def _offset(addr):
+    return _HEADER.size + addr * _SLOT.size
+
+
+class LatestWriter(object):
+    """
+    Keeps the latest reading of every sensor in a memory mapped file. Readers poll the
+    file without locks: every slot is a seqlock, its sequence is incremented before and
+    after the slot is changed, so a reader sees an odd or changed sequence when it raced
+    with the writer and reads again. There must be only one writer.
+    A failed read only updates the status of a slot, epoch and words stay those of the
+    last reading.
+    """
+
+    def __init__(self, path=_LATEST_PATH):
+        """
+        @param path: File to map, created with its directory if missing
+        @type path: str
+        """
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.path = path
+        size = _HEADER.size + _SLOTS * _SLOT.size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size != size:  # New file or other layout, start empty
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+            self._map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        magic, version, slots, slot_size, self.cycle = _HEADER.unpack_from(self._map, 0)
+        if (magic, version, slots, slot_size) != (_MAGIC, _VERSION, _SLOTS, _SLOT.size):
+            self._map[:] = b'\x00' * size
+            self.cycle = 0
+        _HEADER.pack_into(self._map, 0, _MAGIC, _VERSION, _SLOTS, _SLOT.size, self.cycle)
+        for addr in range(_SLOTS):  # A writer stopped while it changed the slot, the slot itself is whole
+            sequence = _SEQUENCE.unpack_from(self._map, _offset(addr))[0]
+            if sequence & 1:
+                _SEQUENCE.pack_into(self._map, _offset(addr), (sequence + 1) & 0xffffffff)
+
+    def _update(self, addr, epoch, status, temperature_raw, humidity_raw):
+        offset = _offset(addr)
+        locked = _SEQUENCE.unpack_from(self._map, offset)[0] | 1  # Odd, even if a stopped writer left it odd
+        _SEQUENCE.pack_into(self._map, offset, locked)
+        _SLOT.pack_into(self._map, offset, locked, epoch, addr, status, temperature_raw, humidity_raw)
+        _SEQUENCE.pack_into(self._map, offset, (locked + 1) & 0xffffffff)
+
+    def write(self, batch):
+        """Publish the readings and failures of a batch
+        @param batch: readings of one cycle
+        @type batch: readings.ReadingBatch
+        """
+        for epoch, addr, t_raw, rh_raw in zip(batch.epochs, batch.addrs, batch.temperature_raw, batch.humidity_raw):
+            self._update(addr, epoch, readings.STATUS_OK, t_raw, rh_raw)
+        for epoch, addr, status in batch.failures:
+            sequence, last_epoch, _, _, t_raw, rh_raw = _SLOT.unpack_from(self._map, _offset(addr))
+            self._update(addr, last_epoch, status, t_raw, rh_raw)
+        self.cycle = (self.cycle + 1) & 0xffffffff
+        _HEADER.pack_into(self._map, 0, _MAGIC, _VERSION, _SLOTS, _SLOT.size, self.cycle)
+
+    def close(self):
+        self._map.close()
+
+
+class LatestReader(object):
+    """Reads the file of a LatestWriter, reads are plain memory accesses to the mapping"""
+
+    def __init__(self, path=_LATEST_PATH):
+        """
+        @param path: File written by a LatestWriter
+        @type path: str
+        """
+        with open(path, 'rb') as fp:
+            size = os.fstat(fp.fileno()).st_size
+            if size < _HEADER.size:  # mmap and the header would fail on it
+                raise ValueError("{} is not a latest readings file, it has only {} bytes".format(path, size))
+            self._map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, slots, slot_size, cycle = _HEADER.unpack_from(self._map, 0)
+        if (magic, version) != (_MAGIC, _VERSION) or slot_size != _SLOT.size:
+            self._map.close()
+            raise ValueError("{} is not a latest readings file of version {}".format(path, _VERSION))
+        if size < _offset(slots):
+            self._map.close()
+            raise ValueError("{} is truncated, {} slots need {} bytes but it has {}".format(
+                path, slots, _offset(slots), size))
+        self.slots = slots
+
+    def cycle(self):
+        """@return: Number of batches written, changes when there is something new"""
+        return _HEADER.unpack_from(self._map, 0)[4]
+
+    def read(self, addr):
+        """Consistent copy of the slot of a sensor
+        @param addr: Sensor address
+        @type addr: int
+        @return: Reading or None if the sensor never reported
+        """
+        offset = _offset(addr)
+        for _ in range(_RETRIES):
+            sequence, epoch, slot_addr, status, t_raw, rh_raw = _SLOT.unpack_from(self._map, offset)
+            if sequence & 1 or _SEQUENCE.unpack_from(self._map, offset)[0] != sequence:
+                continue  # The writer is changing the slot
+            if sequence == 0:
+                return None
+            return Reading(slot_addr, epoch, status, t_raw, rh_raw, sequence // 2,
+                           readings.temperature([t_raw])[0], readings.humidity([rh_raw])[0])
+        raise IOError(errno.EAGAIN, "Slot {} of the latest readings stays locked".format(addr))
+
+    def read_all(self):
+        """@return: [Reading] of all sensors that reported"""
+        found = []
+        for addr in range(self.slots):
+            reading = self.read(addr)
+            if reading is not None:
+                found.append(reading)
+        return found
+
+    def close(self):
+        self._map.close()
+
+
+def debug():
+    logging.getLogger().debug("_LATEST_ENABLED\t\t{}".format(_LATEST_ENABLED))
+    logging.getLogger().debug("_LATEST_PATH\t\t\t{}".format(_LATEST_PATH))
+
+
+def main(argv=None):
+    import argparse  # Only the command line needs it, not the monitor importing this module
+    parser = argparse.ArgumentParser(prog='python -m sht21pi.latest', description='Print the latest readings')
+    parser.add_argument('path', nargs='?', default=_LATEST_PATH)
+    args = parser.parse_args(argv)
+    reader = LatestReader(args.path)
+    try:
+        for reading in reader.read_all():
+            sys.stdout.write("{}, {}, {}, {}, {}\n".format(
+                reading.epoch, reading.addr, reading.temperature, reading.humidity,
+                readings.STATUS_NAMES[reading.status]))
+    finally:
+        reader.close()
+
+
+if __name__ == "__main__":
+    main()
+
+# vim: fileencoding=utf-8 filetype=python ts=4 expandtab
@@ -9,11 +9,8 @@
 @summary: Class to update the ws2811x GRB leds. Needs privileged hardware access or else will cause Error -9.
 '''
 import sys
-import time
 import logging
 
-import _rpi_ws281x as ws
-
 _LED_CHANNEL = 0
 _LED_COUNT = 4         # How many LEDs to light.
 _LED_FREQ_HZ = 800000    # Frequency of the LED signal.  Should be 800khz or 400khz.
@@ -25,10 +22,74 @@ _LED_COLOURS_LIST = [0x000000, 0x050000, 0x101000, 0x006463]  # Colours are GRB
 _LEDS_HUMIDITY_THRESHOLD = float(1.)
 
 
-class Argospi2cWS2811x:
+class Ws2811Backend(object):
+    """
+    Hardware calls of the _rpi_ws281x extension. The strip is initialised once,
+    DMA and PWM stay set up until close() is called.
+    """
+
+    def __init__(self, channel, count, freq, dma, gpio, brightness, invert):
+        import _rpi_ws281x as ws
+        self._ws = ws
+        self._leds = ws.new_ws2811_t()
+        self._channel = ws.ws2811_channel_get(self._leds, channel)
+        ws.ws2811_channel_t_count_set(self._channel, count)
+        ws.ws2811_channel_t_gpionum_set(self._channel, gpio)
+        ws.ws2811_channel_t_invert_set(self._channel, invert)
+        ws.ws2811_channel_t_brightness_set(self._channel, brightness)
+        ws.ws2811_t_freq_set(self._leds, freq)
+        ws.ws2811_t_dmanum_set(self._leds, dma)
+        resp = ws.ws2811_init(self._leds)
+        if resp != ws.WS2811_SUCCESS:
+            message = ws.ws2811_get_return_t_str(resp)
+            ws.delete_ws2811_t(self._leds)
+            raise RuntimeError('ws2811_init failed with code {0} ({1})'.format(resp, message))
+
+    def render(self, colors):
+        """
+        @param colors: GRB colour of every led
+        @type colors: [int]
+        """
+        for i, color in enumerate(colors):
+            self._ws.ws2811_led_set(self._channel, i, color)
+        resp = self._ws.ws2811_render(self._leds)
+        if resp != self._ws.WS2811_SUCCESS:
+            raise RuntimeError('ws2811_render failed with code {0} ({1})'.format(
+                resp, self._ws.ws2811_get_return_t_str(resp)))
+
+    def close(self):
+        self._ws.ws2811_fini(self._leds)
+        self._ws.delete_ws2811_t(self._leds)
+
+
+class FakeBackend(object):
+    """Stand-in for the hardware, keeps the rendered colours and counts the renders"""
 
     def __init__(self):
+        self.renders = 0
+        self.colors = None
+        self.closed = False
+
+    def render(self, colors):
+        self.renders += 1
+        self.colors = list(colors)
+
+    def close(self):
+        self.closed = True
+
+
+class Argospi2cWS2811x:
+
+    def __init__(self, backend=None):
+        """
+        @param backend: Hardware interface, a Ws2811Backend is opened on the first update if None
+        @type backend: Ws2811Backend
+        """
         self.debug()
+        self._backend = backend
+        self._last = None
+        self.renders = 0
+        self.skipped_renders = 0
 
     def get_channel(self):
         return _LED_CHANNEL
@@ -52,44 +113,42 @@ class Argospi2cWS2811x:
         return _LED_INVERT
 
     def get_color(self, color):
-        return _LED_COLOURS_LIST[color]
+        return _LED_COLOURS_LIST[min(color, len(_LED_COLOURS_LIST) - 1)]
+
+    def get_backend(self):
+        if self._backend is None:
+            self._backend = Ws2811Backend(
+                self.get_channel(), self.get_count(), self.get_freq(), self.get_dma(),
+                self.get_gpio(), self.get_brightness(), self.get_invert())
+        return self._backend
 
     def set_leds(self, status):
         """ Set the color according to the humidity threshold
         In the optimal state when no threshold is reached the
-        led is turned off.
-        @param status: An integer array with 4 integers between 0 and 4
+        led is turned off. The strip is only rendered if a colour changed.
+        @param status: An integer array with 4 integers between 0 and 4,
+        values above the last colour use the last colour
         @type status: int[4]
         @return: None
         """
-        leds = ws.new_ws2811_t()
-        channel = ws.ws2811_channel_get(leds, self.get_channel())
-        ws.ws2811_channel_t_count_set(channel, self.get_count())
-        ws.ws2811_channel_t_gpionum_set(channel, self.get_gpio())
-        ws.ws2811_channel_t_invert_set(channel, self.get_invert())
-        ws.ws2811_channel_t_brightness_set(channel, self.get_brightness())
-        ws.ws2811_t_freq_set(leds, self.get_freq())
-        ws.ws2811_t_dmanum_set(leds, self.get_dma())
-        try:
-            resp = ws.ws2811_init(leds)
-        except Exception as err:
-            raise RuntimeError('ws2811_init failed with code {0} ({1}) {}', resp, err)
-        finally:
-            if resp != ws.WS2811_SUCCESS:
-                ws.ws2811_get_return_t_str(resp)
-        try:
-            for i in range(self.get_count()):
-                ws.ws2811_led_set(channel, i, self.get_color(status[i]))
-            resp = ws.ws2811_render(leds)
-            if resp != ws.WS2811_SUCCESS:
-                ws.ws2811_get_return_t_str(resp)
-            time.sleep(0.015)
-        except Exception as err:
-            raise RuntimeError('ws2811_render failed with code {0} ({1})'.format(resp, err))
-        finally:
-            logging.getLogger().info("LED status:\t\t\t{}".format(status))
-            ws.ws2811_fini(leds)
-            ws.delete_ws2811_t(leds)
+        colors = [self.get_color(status[i]) for i in range(self.get_count())]
+        if colors == self._last:
+            self.skipped_renders += 1
+            return
+        self._last = None  # Render again next time if this one fails
+        self.get_backend().render(colors)
+        self._last = colors
+        self.renders += 1
+        logging.getLogger().info("LED status:\t\t\t{}".format(status))
+
+    def close(self):
+        """ Release the strip
+        @return: None
+        """
+        if self._backend is not None:
+            self._backend.close()
+            self._backend = None
+            self._last = None
 
     def debug(self):
         """ Print configuration to application log if debug level is set to DEBUG
@@ -114,6 +173,7 @@ def main():
         status = [0, 1, 2, 3]
         ledTest = Argospi2cWS2811x()
         ledTest.set_leds(status)
+        ledTest.close()
     except IOError as e:
         print("I/OError: {}".format(e))
     except Exception:
@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+@author: Andre Poley
+@contact: andre.poley@mailbox.org
+@copyright: (c) 2019 by Andre Poley, Berkeley
+@license: MIT
+@version: 0.0.5
+@summary: Metrics of the acquisition and the sinks in the prometheus text format, served over http.
+'''
+import bisect
+import logging
+import threading
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:  # python2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+import readings
+
+_METRICS_ENABLED = False
+_METRICS_ADDRESS = '127.0.0.1'
+_METRICS_PORT = 9121
+_PREFIX = 'sht21pi_'
+_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# Cycle durations: a pipelined cycle at 14/12 bit takes about 0.12s
+CYCLE_BUCKETS = (0.025, 0.05, 0.1, 0.15, 0.2, 0.3, 0.5, 1., 2.5, 5., 10.)
+
+
+class Histogram(object):
+    """Cumulative histogram with fixed buckets like the prometheus histogram type"""
+
+    def __init__(self, buckets=CYCLE_BUCKETS):
+        """
+        @param buckets: Upper bounds in ascending order, +Inf is added
+        @type buckets: (float)
+        """
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def samples(self, name):
+        """@return: [(name, labels, value)] of the buckets, sum and count"""
+        samples = []
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), list(self.counts)):
+            total += count
+            samples.append((name + '_bucket', {'le': _format_value(bound)}, total))
+        samples.append((name + '_sum', {}, self.sum))
+        samples.append((name + '_count', {}, self.count))
+        return samples
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, bool):
+        return str(int(value))
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for key, value in sorted(labels.items())) + '}'
+
+
+class Metrics(object):
+    """
+    Collects the metrics when they are scraped. The acquisition and the sinks only
+    keep counters and last values in their attributes, which costs next to nothing,
+    everything else is done here on request.
+    """
+
+    def __init__(self):
+        self._families = []
+
+    def add(self, name, kind, description, collect):
+        """Add a metric family
+        @param name: Name without the sht21pi_ prefix
+        @type name: str
+        @param kind: counter, gauge or histogram
+        @type kind: str
+        @param description: HELP text
+        @type description: str
+        @param collect: Function returning [(labels, value)] for counters and gauges,
+        a Histogram for histograms
+        @type collect: callable
+        """
+        self._families.append((_PREFIX + name, kind, description, collect))
+
+    def add_scheduler(self, cycle):
+        """Metrics of the acquisition, see scheduler.PipelinedScheduler and scheduler.MultiBusScheduler"""
+        buses = getattr(cycle, 'schedulers', [cycle])
+
+        def last(column):  # Sensors the adaptive sampling or a breaker left out keep their last reading
+            words = sorted(item for bus in buses for item in dict(bus.last_readings).items())
+            convert = readings.temperature if column == 'temperature' else readings.humidity
+            values = convert([raw[0 if column == 'temperature' else 1] for addr, raw in words])
+            return [({'sensor': addr}, value) for (addr, raw), value in zip(words, values)]
+
+        def per_sensor(attribute):
+            return lambda: [({'sensor': addr + bus.offset}, value) for bus in buses
+                            for addr, value in sorted(dict(getattr(bus, attribute)).items())]
+
+        def conversions():
+            return [({'sensor': addr + bus.offset, 'kind': kind}, seconds) for bus in buses
+                    for addr, times in sorted(dict(bus.conversion_times).items())
+                    for kind, seconds in sorted(dict(times).items())]
+
+        def breakers(value):
+            return lambda: [({'sensor': addr + bus.offset}, value(breaker)) for bus in buses
+                            for addr, breaker in sorted(bus.breakers.items())]
+
+        def sampling(attribute):
+            return lambda: [({'sensor': addr + bus.offset}, value) for bus in buses if bus.sampler is not None
+                            for addr, value in sorted(dict(getattr(bus.sampler, attribute)).items())]
+
+        def mux(attribute):
+            return lambda: [({'bus': index}, getattr(bus.mux, attribute)) for index, bus in enumerate(buses)]
+
+        self.add('temperature_celsius', 'gauge', 'Last temperature of a sensor', lambda: last('temperature'))
+        self.add('humidity_percent', 'gauge', 'Last relative humidity of a sensor', lambda: last('humidity'))
+        self.add('sensor_read_latency_seconds', 'gauge',
+                 'Time from the temperature trigger to the humidity result of the last reading',
+                 per_sensor('read_latency'))
+        self.add('conversion_seconds', 'gauge', 'Last measured conversion time', conversions)
+        self.add('sensor_errors_total', 'counter', 'Failed reads of a sensor', per_sensor('errors'))
+        self.add('sensor_retries_total', 'counter', 'Conversions started again after a checksum mismatch',
+                 per_sensor('retries'))
+        self.add('sensor_breaker_open', 'gauge', '1 while the sensor is skipped by its circuit breaker',
+                 breakers(lambda breaker: int(breaker.is_open())))
+        self.add('sensor_breaker_opened_total', 'counter', 'Times the circuit breaker of the sensor opened',
+                 breakers(lambda breaker: breaker.opened))
+        self.add('cycle_duration_seconds', 'histogram', 'Duration of an acquisition cycle',
+                 lambda: cycle.cycle_histogram)
+        if any(bus.sampler is not None for bus in buses):
+            self.add('sensor_sample_interval_seconds', 'gauge', 'Interval the adaptive sampling reads the sensor at',
+                     sampling('intervals'))
+            self.add('sensor_activity', 'gauge', 'Change of the last reading relative to the adaptive sampling slopes',
+                     sampling('activity'))
+            self.add('sensor_deferred_total', 'counter', 'Reads deferred to the next cycle by the sensor limit',
+                     sampling('deferred'))
+        self.add('mux_writes_total', 'counter', 'Writes to the mux channel registers', mux('writes'))
+        self.add('mux_skipped_writes_total', 'counter', 'Mux writes skipped because the channel was open',
+                 mux('skipped_writes'))
+
+    def add_pipeline(self, sink_pipeline):
+        """Metrics of the sink workers, see pipeline.SinkWorker.stats"""
+        def stat(key):
+            return lambda: [({'sink': name}, stats[key]) for name, stats in sorted(sink_pipeline.stats().items())]
+        self.add('sink_backlog', 'gauge', 'Batches queued in memory and on disk', stat('backlog'))
+        self.add('sink_handled_total', 'counter', 'Batches handled', stat('handled'))
+        self.add('sink_dropped_total', 'counter', 'Batches dropped because the queue was full', stat('dropped'))
+        self.add('sink_errors_total', 'counter', 'Batches the sink failed on', stat('errors'))
+        self.add('sink_latency_seconds', 'gauge', 'Time the sink took for the last batch', stat('last_latency'))
+        self.add('sink_max_latency_seconds', 'gauge', 'Longest time the sink took for a batch', stat('max_latency'))
+        self.add('sink_delay_seconds', 'gauge', 'Time the last batch waited in the queue', stat('last_delay'))
+
+    def add_influx(self, writer):
+        """Metrics of the influx posts, see influx.InfluxWriter"""
+        self.add('influx_posts_total', 'counter', 'Accepted posts', lambda: [({}, writer.posts)])
+        self.add('influx_post_failures_total', 'counter', 'Failed posts', lambda: [({}, writer.failures)])
+        self.add('influx_rejected_lines_total', 'counter', 'Lines dropped because the server refused them',
+                 lambda: [({}, writer.rejected_lines)])
+        self.add('influx_posted_lines_total', 'counter', 'Lines accepted by the server',
+                 lambda: [({}, writer.posted_lines)])
+        self.add('influx_posted_bytes_total', 'counter', 'Bytes of accepted posts', lambda: [({}, writer.posted_bytes)])
+        self.add('influx_post_latency_seconds', 'gauge', 'Duration of the last post',
+                 lambda: [({}, writer.last_post_latency)])
+        self.add('influx_post_seconds_total', 'counter', 'Time spent posting', lambda: [({}, writer.post_time)])
+        self.add('influx_buffered_lines', 'gauge', 'Lines waiting to be posted', lambda: [({}, writer.buffered())])
+
+    def add_led(self, indicator):
+        """Metrics of the led strip, see led.Argospi2cWS2811x"""
+        self.add('led_renders_total', 'counter', 'Updates written to the strip', lambda: [({}, indicator.renders)])
+        self.add('led_skipped_renders_total', 'counter', 'Updates skipped because the colours did not change',
+                 lambda: [({}, indicator.skipped_renders)])
+
+    def add_deadband(self, deadbands):
+        """Metrics of the change-only reporting, see deadband.Deadband
+        @param deadbands: Deadband of every sink using one
+        @type deadbands: {str: deadband.Deadband}
+        """
+        def count(attribute):
+            return lambda: [({'sink': name, 'sensor': addr}, value) for name, band in sorted(deadbands.items())
+                            for addr, value in sorted(dict(getattr(band, attribute)).items())]
+        if not deadbands:
+            return
+        self.add('deadband_reported_total', 'counter', 'Readings passed on to the sink', count('reported'))
+        self.add('deadband_suppressed_total', 'counter', 'Readings held back because they stayed within the deadband',
+                 count('suppressed'))
+
+    def render(self):
+        """@return: all metrics in the prometheus text format"""
+        lines = []
+        for name, kind, description, collect in self._families:
+            try:
+                values = collect()
+            except Exception:
+                logging.getLogger().error("Cannot collect metric {}".format(name), exc_info=True)
+                continue
+            if values is None:
+                continue
+            lines.append('# HELP {} {}'.format(name, description))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            if kind == 'histogram':
+                samples = values.samples(name)
+            else:
+                samples = [(name, labels, value) for labels, value in values]
+            for sample, labels, value in samples:
+                lines.append('{}{} {}'.format(sample, _format_labels(labels), _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', _CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class MetricsServer(object):
+    """Serves the metrics at /metrics from a background thread"""
+
+    def __init__(self, metrics, address=_METRICS_ADDRESS, port=_METRICS_PORT):
+        """
+        @param metrics: Metrics to serve
+        @type metrics: Metrics
+        @param address: Address to listen on
+        @type address: str
+        @param port: Port to listen on, 0 for any free port
+        @type port: int
+        """
+        self.server = HTTPServer((address, port), _MetricsHandler)
+        self.server.metrics = metrics
+        self.port = self.server.server_port
+        self._thread = threading.Thread(target=self.server.serve_forever, name='metrics')
+        self._thread.daemon = True
+        self._thread.start()
+        logging.getLogger().info("Serving metrics on {}:{}".format(address, self.port))
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self._thread.join()
+
+
+def debug():
+    logging.getLogger().debug("_METRICS_ENABLED\t\t{}".format(_METRICS_ENABLED))
+    logging.getLogger().debug("_METRICS_ADDRESS\t\t{}".format(_METRICS_ADDRESS))
+    logging.getLogger().debug("_METRICS_PORT\t\t\t{}".format(_METRICS_PORT))
+
+# vim: fileencoding=utf-8 filetype=python ts=4 expandtab
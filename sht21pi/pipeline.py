@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+@author: Andre Poley
+@contact: andre.poley@mailbox.org
+@copyright: (c) 2019 by Andre Poley, Berkeley
+@license: MIT
+@version: 0.0.5
+@summary: Hands the readings of a cycle to the sinks, each sink runs on its own worker thread.
+'''
+import os
+import json
+import logging
+import threading
+import collections
+
+import helpers
+import readings
+
+DROP_OLDEST = 'drop-oldest'
+BLOCK = 'block'
+SPILL = 'spill'
+OVERFLOW_POLICIES = (DROP_OLDEST, BLOCK, SPILL)
+
+
+def _dumps(batch):
+    """Serialise a batch for the spill file, a ReadingBatch keeps its raw words"""
+    if isinstance(batch, readings.ReadingBatch):
+        return json.dumps({'raw': batch.to_list(), 'failures': batch.failures})
+    return json.dumps(batch)
+
+
+def _loads(line):
+    """Inverse of _dumps"""
+    batch = json.loads(line)
+    if isinstance(batch, dict):
+        return readings.ReadingBatch.from_list(batch['raw'], batch.get('failures', ()))
+    return batch
+
+
+class SinkWorker(threading.Thread):
+    """
+    Feeds batches from a bounded queue to one sink, so a slow sink does not
+    delay the acquisition loop or the other sinks. When the queue is full
+    the overflow policy decides what happens to a new batch:
+      drop-oldest: the oldest queued batch is dropped
+      block:       put() waits until the sink took a batch
+      spill:       batches go to a spool.Spool on disk until the sink caught up
+    """
+
+    def __init__(self, name, sink, maxsize=100, overflow=DROP_OLDEST, spill=None):
+        """
+        @param name: Name of the sink used in logs and stats
+        @type name: str
+        @param sink: Object with handle(batch) and close()
+        @type sink: sinks.Sink
+        @param maxsize: Batches kept in memory
+        @type maxsize: int
+        @param overflow: One of OVERFLOW_POLICIES
+        @type overflow: str
+        @param spill: Spool for the spill policy
+        @type spill: spool.Spool
+        """
+        threading.Thread.__init__(self, name='sink-{}'.format(name))
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy '{}', use one of {}".format(
+                overflow, ', '.join(OVERFLOW_POLICIES)))
+        if overflow == SPILL and spill is None:
+            raise ValueError("Overflow policy spill needs a spool")
+        self.daemon = True
+        self.sink_name = name
+        self.sink = sink
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.spill = spill
+        self._queue = collections.deque()
+        self._spilled = len(spill) if spill is not None else 0
+        self._cond = threading.Condition()
+        self._closing = False
+        self.handled = 0
+        self.dropped = 0
+        self.errors = 0
+        self.last_latency = 0.
+        self.max_latency = 0.
+        self.total_latency = 0.
+        self.last_delay = 0.
+
+    def put(self, batch):
+        """Queue a batch for the sink
+        @param batch: readings of one cycle
+        @type batch: readings.ReadingBatch
+        """
+        with self._cond:
+            if self._spilled or len(self._queue) >= self.maxsize:
+                if self.overflow == SPILL:  # Keep the order, spill until the spool is empty again
+                    self.spill.append([_dumps(batch)])
+                    self._spilled += 1
+                    self._cond.notify_all()
+                    return
+                if self.overflow == BLOCK:
+                    while len(self._queue) >= self.maxsize and not self._closing:
+                        self._cond.wait()
+                else:
+                    self._queue.popleft()
+                    self.dropped += 1
+                    logging.getLogger().warning("Sink {} is behind, dropped the oldest batch".format(self.sink_name))
+            self._queue.append((helpers.monotonic(), batch))
+            self._cond.notify_all()
+
+    def _take(self):
+        """Wait for the next batch
+        @return: (queued at, batch, spool id to ack once handled or None), None once closed and empty
+        """
+        with self._cond:
+            while not self._queue and not self._spilled and not self._closing:
+                self._cond.wait()
+            if self._queue:
+                queued, batch = self._queue.popleft()
+                self._cond.notify_all()
+                return queued, batch, None
+            if not self._spilled:
+                return None
+        last_id, lines = self.spill.peek(1)  # The memory queue is empty, continue with the spool
+        if last_id is None:
+            with self._cond:
+                self._spilled = 0
+            return self._take()
+        return None, _loads(lines[0]), last_id
+
+    def _ack(self, last_id):
+        """Remove a spilled batch from the spool, only after the sink handled it so a stop does not lose it"""
+        self.spill.ack(last_id)
+        with self._cond:
+            self._spilled -= 1
+
+    def run(self):
+        while True:
+            item = self._take()
+            if item is None:
+                break
+            queued, batch, spooled = item
+            started = helpers.monotonic()
+            try:
+                self.sink.handle(batch)
+            except Exception:
+                self.errors += 1
+                logging.getLogger().error("Sink {} failed".format(self.sink_name), exc_info=True)
+            if spooled is not None:
+                self._ack(spooled)
+            latency = helpers.monotonic() - started
+            self.handled += 1
+            self.last_latency = latency
+            self.max_latency = max(self.max_latency, latency)
+            self.total_latency += latency
+            if queued is not None:
+                self.last_delay = started - queued
+        try:
+            self.sink.close()
+        except Exception:
+            logging.getLogger().error("Cannot close sink {}".format(self.sink_name), exc_info=True)
+
+    def close(self, timeout=None):
+        """Handle the queued batches, close the sink and end the thread
+        @param timeout: Seconds to wait for the worker
+        @type timeout: float
+        """
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        self.join(timeout)
+
+    def backlog(self):
+        """Batches waiting in memory and on disk"""
+        with self._cond:
+            return len(self._queue) + self._spilled
+
+    def stats(self):
+        """Latency in seconds and backlog of the sink
+        @return: dict
+        """
+        return {
+            'backlog': self.backlog(),
+            'handled': self.handled,
+            'dropped': self.dropped,
+            'errors': self.errors,
+            'last_latency': self.last_latency,
+            'max_latency': self.max_latency,
+            'mean_latency': self.total_latency / self.handled if self.handled else 0.,
+            'last_delay': self.last_delay,
+        }
+
+
+class SinkPipeline(object):
+    """Starts a SinkWorker per sink and publishes every batch to all of them"""
+
+    def __init__(self, maxsize=100, overflow=DROP_OLDEST, spill_directory=None):
+        """
+        @param maxsize: Batches kept in memory per sink
+        @type maxsize: int
+        @param overflow: Default overflow policy
+        @type overflow: str
+        @param spill_directory: Directory of the spill files, one per sink
+        @type spill_directory: str
+        """
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.spill_directory = spill_directory
+        self.workers = []
+
+    def add(self, name, sink, overflow=None):
+        """Start a worker for a sink
+        @param name: Name of the sink
+        @type name: str
+        @param sink: Object with handle(batch) and close()
+        @type sink: sinks.Sink
+        @param overflow: Overflow policy of this sink, default of the pipeline if None
+        @type overflow: str
+        """
+        overflow = overflow or self.overflow
+        worker = SinkWorker(name, sink, self.maxsize, overflow, self._spill(name, overflow))
+        worker.start()
+        self.workers.append(worker)
+        return worker
+
+    def _spill(self, name, overflow):
+        """Spool of a sink with the spill policy, None for the other policies"""
+        if overflow != SPILL:
+            return None
+        import spool  # sqlite3 is only needed for the spill policy
+        return spool.Spool(os.path.join(self.spill_directory, '{}.spill'.format(name)))
+
+    def publish(self, batch):
+        """Hand a batch to every sink"""
+        for worker in self.workers:
+            worker.put(batch)
+
+    def stats(self):
+        """Stats of every sink, see SinkWorker.stats
+        @return: {name: dict}
+        """
+        return dict((worker.sink_name, worker.stats()) for worker in self.workers)
+
+    def close(self, timeout=None):
+        """Let every sink handle its backlog and close it"""
+        for worker in self.workers:
+            worker.close(timeout)
+            if worker.spill is not None:
+                worker.spill.close()
+
+    def debug(self):
+        for name, stats in sorted(self.stats().items()):
+            logging.getLogger().debug("Sink {}:\t\t\tbacklog {backlog} handled {handled} dropped {dropped} "
+                                      "latency {last_latency:.3f}s max {max_latency:.3f}s".format(name, **stats))
+
+# vim: fileencoding=utf-8 filetype=python ts=4 expandtab
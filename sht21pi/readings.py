@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+@author: Andre Poley
+@contact: andre.poley@mailbox.org
+@copyright: (c) 2019 by Andre Poley, Berkeley
+@license: MIT
+@version: 0.0.5
+@summary: Readings of a cycle as columns of raw sensor words, converted to C and percent in one call.
+'''
+from array import array
+
+# Status of a sensor in a cycle, stored with failures and in the binary log
+STATUS_OK = 0
+STATUS_ERROR = 1   # The read failed
+STATUS_OPEN = 2    # Skipped, the circuit breaker of the sensor is open
+STATUS_NAMES = {STATUS_OK: 'ok', STATUS_ERROR: 'error', STATUS_OPEN: 'open'}
+
+# Below this many values the conversion is done in python, numpy only pays off for large arrays
+_NUMPY_THRESHOLD = 256
+_numpy = None
+
+
+def _get_numpy():
+    """Import numpy on first use, None if it is not installed"""
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+            _numpy = numpy
+        except ImportError:
+            _numpy = False
+    return _numpy or None
+
+
+def _convert(raw, offset, scale):
+    """offset + scale * (raw & 0xfffc) / 2^16 for a whole column
+    @param raw: raw sensor words
+    @type raw: array('H'), numpy.ndarray or [int]
+    @return: numpy.ndarray or [float]
+    """
+    np = _get_numpy() if len(raw) >= _NUMPY_THRESHOLD or not isinstance(raw, (array, list)) else None
+    if np is not None:
+        if isinstance(raw, array):
+            raw = np.frombuffer(raw, dtype=np.uint16)
+        return offset + scale * (np.asarray(raw, dtype=np.uint16) & 0xfffc) / float(1 << 16)
+    return [offset + scale * (word & 0xfffc) / float(1 << 16) for word in raw]
+
+
+def temperature(raw):
+    """Datasheet formula T = -46.85 + 175.72 * ST / 2^16 on a column of raw words,
+    same result as i2c._get_temperature_from_buffer
+    @return: numpy.ndarray or [float]
+    """
+    return _convert(raw, -46.85, 175.72)
+
+
+def humidity(raw):
+    """Datasheet formula RH = -6 + 125 * SRH / 2^16 on a column of raw words,
+    same result as i2c._get_humidity_from_buffer
+    @return: numpy.ndarray or [float]
+    """
+    return _convert(raw, -6.0, 125.0)
+
+
+class ReadingBatch(object):
+    """
+    Readings kept as columns: epoch, address and the raw 16 bit temperature and
+    humidity words, so they can be stored without loss. Iterating gives
+    (epoch, address, temperature, humidity) rows like the lists of i2c.read_i2c_addr,
+    the conversion is done once for the whole batch.
+    Sensors without a reading in the cycle are kept apart as failures with their status.
+    """
+
+    def __init__(self):
+        self.epochs = array('I')
+        self.addrs = array('B')
+        self.temperature_raw = array('H')
+        self.humidity_raw = array('H')
+        self.failures = []
+        self._converted = None
+
+    def append(self, epoch, addr, temperature_raw, humidity_raw):
+        """
+        @param epoch: Time of the reading
+        @type epoch: int
+        @param addr: Sensor address
+        @type addr: int
+        @param temperature_raw: 16 bit word read from the sensor
+        @type temperature_raw: int
+        @param humidity_raw: 16 bit word read from the sensor
+        @type humidity_raw: int
+        """
+        self.epochs.append(epoch)
+        self.addrs.append(addr)
+        self.temperature_raw.append(temperature_raw)
+        self.humidity_raw.append(humidity_raw)
+        self._converted = None
+
+    def extend(self, other):
+        """Append the readings and failures of another batch
+        @type other: ReadingBatch
+        """
+        self.epochs.extend(other.epochs)
+        self.addrs.extend(other.addrs)
+        self.temperature_raw.extend(other.temperature_raw)
+        self.humidity_raw.extend(other.humidity_raw)
+        self.failures.extend(other.failures)
+        self._converted = None
+
+    def add_failure(self, epoch, addr, status):
+        """
+        @param epoch: Time of the failed read
+        @type epoch: int
+        @param addr: Sensor address
+        @type addr: int
+        @param status: STATUS_ERROR or STATUS_OPEN
+        @type status: int
+        """
+        self.failures.append((epoch, addr, status))
+
+    def temperatures(self):
+        """@return: temperatures in C"""
+        return self._physical()[0]
+
+    def humidities(self):
+        """@return: relative humidities in percent"""
+        return self._physical()[1]
+
+    def _physical(self):
+        if self._converted is None:
+            self._converted = (temperature(self.temperature_raw), humidity(self.humidity_raw))
+        return self._converted
+
+    def __len__(self):
+        return len(self.epochs)
+
+    def __iter__(self):
+        temperatures, humidities = self._physical()
+        return iter(zip(self.epochs, self.addrs, temperatures, humidities))
+
+    def __getitem__(self, i):
+        temperatures, humidities = self._physical()
+        return (self.epochs[i], self.addrs[i], temperatures[i], humidities[i])
+
+    def to_list(self):
+        """Raw columns as plain lists, e.g. for json
+        @return: [[epoch, address, temperature word, humidity word]]
+        """
+        return [list(row) for row in zip(self.epochs, self.addrs, self.temperature_raw, self.humidity_raw)]
+
+    @classmethod
+    def from_list(cls, rows, failures=()):
+        """Inverse of to_list
+        @param failures: [[epoch, address, status]]
+        """
+        batch = cls()
+        for row in rows:
+            batch.append(*row)
+        for failure in failures:
+            batch.add_failure(*failure)
+        return batch
+
+# vim: fileencoding=utf-8 filetype=python ts=4 expandtab
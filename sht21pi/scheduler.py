@@ -0,0 +1,552 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+@author: Andre Poley
+@contact: andre.poley@mailbox.org
+@copyright: (c) 2019 by Andre Poley, Berkeley
+@license: MIT
+@version: 0.0.5
+@summary: Pipelined acquisition of all sensors. Returns: [[epoch, address, temperature, humidity]]
+'''
+import logging
+import threading
+
+try:
+    import queue
+except ImportError:  # python2
+    import Queue as queue
+
+import helpers
+import i2c
+import readings
+
+# Circuit breaker: after _BREAKER_THRESHOLD failed reads in a row a sensor is skipped for
+# _BREAKER_BACKOFF seconds, doubling with every failed probe up to _BREAKER_MAX_BACKOFF.
+_BREAKER_THRESHOLD = 3
+_BREAKER_BACKOFF = 30.
+_BREAKER_MAX_BACKOFF = 1800.
+_SENSORS_PER_BUS = 16  # Offset between the sensor addresses of two buses, see MultiBusScheduler
+# Adaptive sampling: a sensor is read every _ADAPTIVE_MIN_INTERVAL seconds while its readings
+# change faster than the slopes (per minute), stable sensors back off to _ADAPTIVE_MAX_INTERVAL.
+# _ADAPTIVE_MAX_SENSORS limits the sensors read in one cycle, 0 for no limit.
+_ADAPTIVE_ENABLED = False
+_ADAPTIVE_MIN_INTERVAL = 10.
+_ADAPTIVE_MAX_INTERVAL = 300.
+_ADAPTIVE_TEMPERATURE_SLOPE = 0.2  # C per minute
+_ADAPTIVE_HUMIDITY_SLOPE = 1.0     # percent per minute
+_ADAPTIVE_MAX_SENSORS = 0
+_ADAPTIVE_BACKOFF = 1.5  # Interval factor per stable reading
+
+
+class SensorBreaker(object):
+    """
+    Circuit breaker of one sensor. While it is open the sensor is skipped, so a dead
+    sensor does not cost a conversion timeout every cycle. Once the backoff passed
+    the sensor is probed in the next cycle: a reading closes the breaker, a failure
+    opens it again for twice the time.
+    """
+
+    def __init__(self, threshold=None, backoff=None, max_backoff=None):
+        """
+        @param threshold: Failures in a row that open the breaker, _BREAKER_THRESHOLD if None
+        @type threshold: int
+        @param backoff: Seconds the breaker stays open the first time, _BREAKER_BACKOFF if None
+        @type backoff: float
+        @param max_backoff: Upper limit of the backoff, _BREAKER_MAX_BACKOFF if None
+        @type max_backoff: float
+        """
+        self.threshold = threshold if threshold is not None else _BREAKER_THRESHOLD
+        self.backoff = backoff if backoff is not None else _BREAKER_BACKOFF
+        self.max_backoff = max_backoff if max_backoff is not None else _BREAKER_MAX_BACKOFF
+        self.failures = 0
+        self.open_until = None
+        self.opened = 0
+
+    def allow(self, now):
+        """Whether the sensor is read in this cycle, either closed or due for a probe"""
+        return self.open_until is None or now >= self.open_until
+
+    def probing(self, now):
+        """Whether a read at this time is a probe of an open breaker"""
+        return self.open_until is not None and now >= self.open_until
+
+    def is_open(self):
+        return self.open_until is not None
+
+    def success(self):
+        """Count a reading
+        @return: number of failed reads before it if the breaker was open, else None
+        """
+        failures = self.failures if self.open_until is not None else None
+        self.failures = 0
+        self.open_until = None
+        return failures
+
+    def failure(self, now):
+        """Count a failed read
+        @return: seconds the breaker is open from now, None if it stays closed
+        """
+        self.failures += 1
+        if self.failures < self.threshold:
+            return None
+        delay = min(self.backoff * 2 ** (self.failures - self.threshold), self.max_backoff)
+        self.open_until = now + delay
+        self.opened += 1
+        return delay
+
+
+class AdaptiveSampler(object):
+    """
+    Decides which sensors are read in a cycle. The activity of a sensor is the change
+    between its last two readings per minute relative to the configured slopes, noise
+    shows up there as well. A sensor with an activity above 1 gets an interval shortened
+    by that factor, one below 0.5 backs off by _ADAPTIVE_BACKOFF, within the limits.
+    Due sensors are read most overdue and most active first, at most max_sensors per
+    cycle, the others are deferred to the next cycle.
+    """
+
+    def __init__(self, min_interval=None, max_interval=None, temperature_slope=None, humidity_slope=None,
+                 max_sensors=None):
+        """
+        @param min_interval: Shortest interval in seconds, _ADAPTIVE_MIN_INTERVAL if None
+        @type min_interval: float
+        @param max_interval: Longest interval in seconds, _ADAPTIVE_MAX_INTERVAL if None
+        @type max_interval: float
+        @param temperature_slope: C per minute above which a sensor is read faster, _ADAPTIVE_TEMPERATURE_SLOPE if None
+        @type temperature_slope: float
+        @param humidity_slope: Percent per minute above which a sensor is read faster, _ADAPTIVE_HUMIDITY_SLOPE if None
+        @type humidity_slope: float
+        @param max_sensors: Sensors read per cycle, 0 for all due ones, _ADAPTIVE_MAX_SENSORS if None
+        @type max_sensors: int
+        """
+        self.min_interval = min_interval if min_interval is not None else _ADAPTIVE_MIN_INTERVAL
+        self.max_interval = max_interval if max_interval is not None else _ADAPTIVE_MAX_INTERVAL
+        self.temperature_slope = temperature_slope if temperature_slope is not None else _ADAPTIVE_TEMPERATURE_SLOPE
+        self.humidity_slope = humidity_slope if humidity_slope is not None else _ADAPTIVE_HUMIDITY_SLOPE
+        self.max_sensors = max_sensors if max_sensors is not None else _ADAPTIVE_MAX_SENSORS
+        self.intervals = {}
+        self.activity = {}
+        self.deferred = {}
+        self._due = {}
+        self._last = {}  # {addr: (time, temperature, humidity)}
+
+    def select(self, now, addrs):
+        """Sensors to read in a cycle starting now
+        @param now: Monotonic time
+        @type now: float
+        @param addrs: All sensors of the bus
+        @type addrs: [int]
+        @return: [int] in the order of their priority
+        """
+        slack = self.min_interval / 2.  # A cycle starting a little early still reads sensors due in it
+        due = [addr for addr in addrs if self._due.get(addr, now) - now <= slack]
+        due.sort(key=lambda addr: -self.priority(addr, now))
+        if self.max_sensors and len(due) > self.max_sensors:
+            for addr in due[self.max_sensors:]:
+                self.deferred[addr] = self.deferred.get(addr, 0) + 1
+            due = due[:self.max_sensors]
+        return due
+
+    def priority(self, addr, now):
+        """Intervals the sensor is overdue plus its activity"""
+        overdue = (now - self._due.get(addr, now)) / self.intervals.get(addr, self.min_interval)
+        return overdue + self.activity.get(addr, 0.)
+
+    def update(self, batch, now, offset=0):
+        """Adapt the intervals of the sensors read in a cycle
+        @param batch: readings of the cycle
+        @type batch: readings.ReadingBatch
+        @param now: Monotonic time at the end of the cycle
+        @type now: float
+        @param offset: Added to the sensor addresses in the batch, see PipelinedScheduler
+        @type offset: int
+        """
+        for (epoch, addr, temp, humi) in batch:
+            addr -= offset
+            interval = self.intervals.get(addr, self.min_interval)
+            last = self._last.get(addr)
+            if last is not None and now > last[0]:
+                minutes = (now - last[0]) / 60.
+                activity = max(abs(temp - last[1]) / minutes / self.temperature_slope,
+                               abs(humi - last[2]) / minutes / self.humidity_slope)
+                self.activity[addr] = activity
+                if activity > 1.:
+                    interval = max(self.min_interval, interval / activity)
+                elif activity < 0.5:
+                    interval = min(self.max_interval, interval * _ADAPTIVE_BACKOFF)
+            if interval != self.intervals.get(addr):
+                logging.getLogger().info("Sampling sensor {} every {:.0f}s".format(addr + offset, interval))
+            self.intervals[addr] = interval
+            self._last[addr] = (now, temp, humi)
+            self._due[addr] = now + interval
+
+
+class PipelinedScheduler(object):
+    """
+    Reads all sensors in about one conversion period instead of one after the other.
+    The sht21 keeps converting in "no hold" mode after the mux switched to another
+    channel, so the scheduler triggers the temperature conversion on every sensor,
+    comes back to each one once its conversion time has passed, reads the result and
+    triggers the humidity conversion, then collects the humidity the same way.
+
+    A cycle is a generator yielding the seconds to wait before the next bus transfer,
+    read_all() drives it with the sleep of the bus clock. Waiting for a result is done by
+    i2c._poll_buffer, so the ready detection of i2c._READY_POLLING applies here too.
+    """
+
+    def __init__(self, bus, addrs, mux1_addr, mux2_addr, offset=0):
+        """
+        @param bus: Open bus connection
+        @type bus: backend.SMBusBackend
+        @param addrs: Sensor addresses 1-16 to read, 1-8 on mux1 and 9-16 on mux2
+        @type addrs: [int]
+        @param mux1_addr: I2C address of the first multiplexer
+        @type mux1_addr: int
+        @param mux2_addr: I2C address of the second multiplexer
+        @type mux2_addr: int
+        @param offset: Added to the sensor addresses in the readings, see MultiBusScheduler
+        @type offset: int
+        """
+        self.bus = bus
+        self.offset = offset
+        self.clock = helpers.get_clock(bus)
+        self.addrs = list(addrs)
+        self.mux = i2c.MuxController(bus, [mux1_addr, mux2_addr])
+        self.breakers = dict((addr, SensorBreaker()) for addr in self.addrs)
+        self.resolution = None
+        self.conversion_times = {}
+        self.read_latency = {}
+        self.errors = {}
+        self.retries = {}
+        self.last_cycle_time = None
+        self.last_batch = None
+        self.last_readings = {}  # {reported address: (raw temperature, raw humidity)}, also of sensors left out since
+        self.cycle_histogram = None  # metrics.Histogram of the cycle times, if metrics are enabled
+        self.sampler = AdaptiveSampler() if _ADAPTIVE_ENABLED else None
+        self.discovery = None  # discovery.Discovery rescanning the bus, if the sensors are discovered
+
+    def _select(self, i2c_addr):
+        """Open the mux channel of a sensor, see i2c.MuxController
+        @param i2c_addr: The sensor address 1-16
+        @type i2c_addr: int
+        """
+        self.mux.select_sensor(i2c_addr)
+
+    def _trigger(self, i2c_addr, command):
+        """Select a sensor and start a conversion
+        @return: time at which the conversion started
+        """
+        self._select(i2c_addr)
+        self.bus.write_byte(i2c._I2C_ADDRESS, command)
+        return self.clock.monotonic()
+
+    def configure_resolution(self, resolution, addrs=None):
+        """Write the resolution to every sensor and read it back
+        @param resolution: (temperature bits, humidity bits)
+        @type resolution: (int, int)
+        @param addrs: Sensors to configure, all if None
+        @type addrs: [int]
+        @return: resolution read back per sensor, None for sensors that failed
+        @rtype: {int: (int, int)}
+        """
+        self.resolution = resolution
+        configured = {}
+        for addr in self.addrs if addrs is None else addrs:
+            try:
+                self._select(addr)
+                i2c.write_resolution(self.bus, resolution)
+                configured[addr] = i2c.read_resolution(self.bus)
+            except IOError as err:
+                self._failed(addr, err)
+                configured[addr] = None
+                continue
+            if configured[addr] != resolution:
+                logging.getLogger().error("Sensor {} reports resolution {} instead of {}".format(
+                    addr, configured[addr], resolution))
+        return configured
+
+    def set_addrs(self, addrs):
+        """Change the sensors read, e.g. after a scan of the bus. New sensors get the resolution.
+        @param addrs: Sensor addresses 1-16
+        @type addrs: [int]
+        """
+        added = [addr for addr in addrs if addr not in self.breakers]
+        removed = [addr for addr in self.addrs if addr not in addrs]
+        if not added and not removed:
+            return
+        logging.getLogger().warning("Sensors added: {} removed: {}".format(
+            [addr + self.offset for addr in added], [addr + self.offset for addr in removed]))
+        self.addrs = list(addrs)
+        for addr in removed:
+            del self.breakers[addr]
+        for addr in added:
+            self.breakers[addr] = SensorBreaker()
+        if self.resolution is not None and added:
+            self.configure_resolution(self.resolution, added)
+
+    def _cycle(self, batch):
+        """Generator running one acquisition cycle, raw readings are appended as they complete.
+        Sensors failing with an IOError are logged and left out of this cycle. A checksum
+        mismatch starts the conversion again, it is collected at the end of the phase.
+        Failed sensors and sensors skipped by their circuit breaker are added as failures.
+        @param batch: batch receiving epoch, address and the raw temperature and humidity words
+        @type batch: readings.ReadingBatch
+        """
+        pending = []
+        first_trigger = {}
+        addrs = self.addrs if self.sampler is None else self.sampler.select(self.clock.monotonic(), self.addrs)
+        for addr in addrs:  # Start the temperature conversion on every sensor
+            breaker = self.breakers[addr]
+            now = self.clock.monotonic()
+            if not breaker.allow(now):
+                batch.add_failure(int(self.clock.time()), addr + self.offset, readings.STATUS_OPEN)
+                continue
+            try:
+                if breaker.probing(now) and self.resolution is not None:  # It may have lost its resolution
+                    self._select(addr)
+                    i2c.write_resolution(self.bus, self.resolution)
+                pending.append((addr, self._trigger(addr, i2c._TRIGGER_TEMPERATURE_NO_HOLD)))
+                first_trigger[addr] = pending[-1][1]
+            except IOError as err:
+                self._failed(addr, err, batch)
+
+        converting = []
+        temperatures = {}
+        retries = {}
+        for addr, started in pending:  # Collect the temperature, start the humidity conversion
+            result = []
+            try:
+                self._select(addr)
+                for delay in i2c._poll_buffer(
+                        self.bus, started, i2c._TEMPERATURE_WAIT_TIME, i2c._TEMPERATURE_TYPICAL_TIME, result):
+                    yield delay
+                temperatures[addr] = (result[0][0][0] << 8) | result[0][0][1]
+                self._record(addr, 'temperature', result[0][1])
+                converting.append((addr, self._trigger(addr, i2c._TRIGGER_HUMIDITY_NO_HOLD)))
+            except i2c.ChecksumError as err:
+                self._retry(addr, err, i2c._TRIGGER_TEMPERATURE_NO_HOLD, pending, retries, batch)
+            except IOError as err:
+                self._failed(addr, err, batch)
+
+        for addr, started in converting:  # Collect the humidity
+            result = []
+            try:
+                self._select(addr)
+                for delay in i2c._poll_buffer(
+                        self.bus, started, i2c._HUMIDITY_WAIT_TIME, i2c._HUMIDITY_TYPICAL_TIME, result):
+                    yield delay
+                humi = (result[0][0][0] << 8) | result[0][0][1]
+                self._record(addr, 'humidity', result[0][1])
+            except i2c.ChecksumError as err:
+                self._retry(addr, err, i2c._TRIGGER_HUMIDITY_NO_HOLD, converting, retries, batch)
+                continue
+            except IOError as err:
+                self._failed(addr, err, batch)
+                continue
+            batch.append(int(self.clock.time()), addr + self.offset, temperatures[addr], humi)
+            failures = self.breakers[addr].success()
+            if failures is not None:
+                logging.getLogger().warning("Sensor {} is back after {} failed reads".format(addr, failures))
+            self.read_latency[addr] = self.clock.monotonic() - first_trigger[addr]
+            logging.getLogger().debug("Read sensor\t\t\t'{}': {:#06x} {:#06x}".format(addr, temperatures[addr], humi))
+
+    def _retry(self, addr, err, command, queue, retries, batch):
+        """Start the conversion of a corrupted result again and queue it for collection
+        @param queue: list of (addr, started) the current phase iterates over
+        @type queue: list
+        @param retries: retries used per (addr, command) in this cycle
+        @type retries: dict
+        """
+        key = (addr, command)
+        retries[key] = retries.get(key, 0) + 1
+        if retries[key] > i2c._CRC_RETRIES:
+            self._failed(addr, err, batch)
+            return
+        self.retries[addr] = self.retries.get(addr, 0) + 1
+        logging.getLogger().warning("{}, retrying sensor {}".format(err, addr))
+        try:
+            queue.append((addr, self._trigger(addr, command)))
+        except IOError as error:
+            self._failed(addr, error, batch)
+
+    def _record(self, addr, kind, elapsed):
+        """Keep the measured conversion time of a sensor, see i2c._record_conversion_time"""
+        self.conversion_times.setdefault(addr, {})[kind] = elapsed
+        i2c._record_conversion_time(addr, kind, elapsed)
+
+    def _failed(self, addr, err, batch=None):
+        """Count a failed read against the circuit breaker of the sensor
+        @param batch: batch of the cycle receiving the failure
+        @type batch: readings.ReadingBatch
+        """
+        self.errors[addr] = self.errors.get(addr, 0) + 1
+        self.mux.invalidate()  # Mux state is unknown after a failed transfer
+        logging.getLogger().error("Cannot read sensor {}: {}".format(addr, err), exc_info=False)
+        if batch is not None:
+            batch.add_failure(int(self.clock.time()), addr + self.offset, readings.STATUS_ERROR)
+        backoff = self.breakers[addr].failure(self.clock.monotonic())
+        if backoff is not None:
+            logging.getLogger().error("Skipping sensor {} for {:.0f}s after {} failed reads".format(
+                addr, backoff, self.breakers[addr].failures))
+
+    def read_cycle(self):
+        """Read all sensors once
+        @return: readings in sensor order
+        @rtype: [[int, int, float, float]]
+        """
+        return [list(row) for row in self.read_all()]
+
+    def read_all(self):
+        """Read all sensors once, keeping the raw sensor words
+        @return: readings in sensor order
+        @rtype: readings.ReadingBatch
+        """
+        batch = readings.ReadingBatch()
+        started = self.clock.monotonic()
+        for delay in self._cycle(batch):
+            self.clock.sleep(delay)
+        self._finish(batch, started)
+        return batch
+
+    def _finish(self, batch, started):
+        """Keep the results of a cycle, also used by the drivers of aioengine
+        @param batch: readings of the cycle
+        @type batch: readings.ReadingBatch
+        @param started: Clock time the cycle started
+        @type started: float
+        """
+        self.last_cycle_time = self.clock.monotonic() - started
+        self.last_batch = batch
+        self.last_readings.update(zip(batch.addrs, zip(batch.temperature_raw, batch.humidity_raw)))
+        if self.sampler is not None:
+            self.sampler.update(batch, self.clock.monotonic(), self.offset)
+        if self.discovery is not None:
+            self.discovery.check(self)
+        if self.cycle_histogram is not None:
+            self.cycle_histogram.observe(self.last_cycle_time)
+        logging.getLogger().info("Read {} sensors in {:.1f}ms".format(len(batch), self.last_cycle_time * 1000))
+        logging.getLogger().debug("Mux writes:\t\t\t{} skipped: {}".format(self.mux.writes, self.mux.skipped_writes))
+
+
+def align_clocks(schedulers):
+    """Simulated buses each run their own virtual clock, bring them to the same time
+    @param schedulers: Schedulers of the buses
+    @type schedulers: [PipelinedScheduler]
+    """
+    clocks = []
+    for cycle in schedulers:
+        if cycle.clock is not helpers.CLOCK and cycle.clock not in clocks:
+            clocks.append(cycle.clock)
+    if len(clocks) > 1:
+        now = max(clock.monotonic() for clock in clocks)
+        for clock in clocks:
+            clock.sleep(now - clock.monotonic())
+
+
+class _BusWorker(threading.Thread):
+    """Runs the cycles of one bus on its own thread"""
+
+    def __init__(self, cycle):
+        threading.Thread.__init__(self, name='bus-{}'.format(cycle.offset // _SENSORS_PER_BUS))
+        self.daemon = True
+        self.cycle = cycle
+        self.requests = queue.Queue()
+        self.results = queue.Queue()
+
+    def run(self):
+        while True:
+            method = self.requests.get()
+            if method is None:
+                break
+            try:
+                self.results.put((True, method()))
+            except Exception as err:
+                logging.getLogger().error("Bus {} failed".format(self.name), exc_info=True)
+                self.results.put((False, err))
+
+
+class MultiBusScheduler(object):
+    """
+    Reads several buses at the same time, each with its own PipelinedScheduler on its
+    own thread. The threads spend the cycle sleeping or waiting for the bus, so the
+    cycle takes about as long as the slowest bus. The readings are merged into one
+    batch, sensor n of the i-th bus is reported as n + 16 * i.
+    """
+
+    def __init__(self, schedulers):
+        """
+        @param schedulers: One scheduler per bus, with the offsets of their sensors
+        @type schedulers: [PipelinedScheduler]
+        """
+        self.schedulers = list(schedulers)
+        self.clock = self.schedulers[0].clock
+        self.last_cycle_time = None
+        self.last_batch = None
+        self.cycle_histogram = None
+        self._workers = []
+
+    def _start(self):
+        """Start the bus threads on first use"""
+        self._workers = [_BusWorker(cycle) for cycle in self.schedulers]
+        for worker in self._workers:
+            worker.start()
+
+    def _run(self, method):
+        """Call method(scheduler) on every bus thread and wait for all of them
+        @return: results in bus order, None for buses that raised
+        """
+        if not self._workers:
+            self._start()
+        for worker in self._workers:
+            worker.requests.put(lambda cycle=worker.cycle: method(cycle))
+        results = []
+        for worker in self._workers:
+            ok, result = worker.results.get()
+            results.append(result if ok else None)
+        return results
+
+    def configure_resolution(self, resolution):
+        """See PipelinedScheduler.configure_resolution
+        @return: resolution read back per sensor, with the addresses of the readings
+        @rtype: {int: (int, int)}
+        """
+        configured = {}
+        for cycle, result in zip(self.schedulers, self._run(lambda cycle: cycle.configure_resolution(resolution))):
+            for addr, value in (result or {}).items():
+                configured[addr + cycle.offset] = value
+        return configured
+
+    def read_cycle(self):
+        """Read all buses once
+        @rtype: [[int, int, float, float]]
+        """
+        return [list(row) for row in self.read_all()]
+
+    def read_all(self):
+        """Read all buses once, at the same time
+        @return: readings of all buses in bus and sensor order
+        @rtype: readings.ReadingBatch
+        """
+        align_clocks(self.schedulers)
+        batch = readings.ReadingBatch()
+        for part in self._run(lambda cycle: cycle.read_all()):
+            if part is not None:
+                batch.extend(part)
+        align_clocks(self.schedulers)
+        self.last_cycle_time = max(cycle.last_cycle_time or 0. for cycle in self.schedulers)
+        self.last_batch = batch
+        if self.cycle_histogram is not None:
+            self.cycle_histogram.observe(self.last_cycle_time)
+        logging.getLogger().info("Read {} sensors on {} buses in {:.1f}ms".format(
+            len(batch), len(self.schedulers), self.last_cycle_time * 1000))
+        return batch
+
+    def close(self):
+        """End the bus threads"""
+        for worker in self._workers:
+            worker.requests.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+
+# vim: fileencoding=utf-8 filetype=python ts=4 expandtab
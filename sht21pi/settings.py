@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+@author: Andre Poley
+@contact: andre.poley@mailbox.org
+@copyright: (c) 2019 by Andre Poley, Berkeley
+@license: MIT
+@version: 0.0.5
+@summary: Parses and validates the configuration file once and keeps the result as a snapshot next to it.
+'''
+import os
+import sys
+import errno
+import marshal
+import logging
+
+import deadband
+import helpers
+import i2c
+import pipeline
+
+_SNAPSHOT_VERSION = 1
+_SNAPSHOT_DIRECTORY = '/var/lib/sht21pi'
+_SNAPSHOT_SUFFIX = '.snapshot'
+_ENGINES = ('threads', 'asyncio')
+_BACKENDS = ('smbus', 'simulated')
+
+
+def _section(config, name):
+    return config[name] if config.has_section(name) else {}
+
+
+def _positive(name, value):
+    if value <= 0:
+        raise ValueError("{} must be greater than 0, got {}".format(name, value))
+    return value
+
+
+def _choice(name, value, choices):
+    if value not in choices:
+        raise ValueError("Unknown {} '{}', use one of {}".format(name, value, ', '.join(choices)))
+    return value
+
+
+def _present(value):
+    """Sensors present on a bus, None for auto to find them with the discovery module"""
+    return None if value.strip().lower() == 'auto' else int(value, 16)
+
+
+def parse(configfile):
+    """Parse and validate a configuration file
+    @param configfile: A file formated for python's configparser
+    @type configfile: str
+    @return: {module name: {global name: value}}, the settings of the monitor itself under 'monitor'
+    """
+    import configparser  # Only needed when the snapshot is out of date
+    config = configparser.ConfigParser()
+    try:
+        config.read(configfile)
+        log_dir = str(config['CONFIGURATION']['log_directory'])
+        monitor = {
+            '_INFLUX_ENABLED': helpers.to_bool(config['INFLUX']['enabled']),
+            '_LEDS_ENABLED': helpers.to_bool(config['LEDS']['enabled']),
+            '_LOG_FILE': log_dir + str(config['CONFIGURATION']['log_file']),
+            '_LOG_DIR': log_dir,
+            '_LOG_ENABLED': helpers.to_bool(config['CONFIGURATION']['log_enabled']),
+            '_LOG_LEVEL': str(config['CONFIGURATION']['log_level']),
+            '_LOG_FORMAT': _choice('log format', str(config['CONFIGURATION'].get('log_format', 'text')),
+                                   ('text', 'binary')),
+            '_ENGINE': _choice('engine', str(config['CONFIGURATION'].get('engine', 'threads')), _ENGINES),
+            '_BINARY_LOG_DIRECTORY': str(config['CONFIGURATION'].get('binary_log_directory', log_dir + 'binary/')),
+            '_BACKEND': _choice('backend', str(config['SENSORS'].get('backend', 'smbus')), _BACKENDS),
+            '_RESOLUTION': i2c.parse_resolution(config['SENSORS'].get('resolution', '14/12')),
+        }
+        buses = []
+        bus_sections = [section for section in config.sections() if section.split()[0] == 'BUS']
+        for section in sorted(bus_sections, key=lambda name: int(name.split()[1])):  # [BUS 3] is /dev/i2c-3
+            buses.append((
+                int(section.split()[1]),
+                _present(config[section].get('present', config['SENSORS']['present'])),
+                int(config[section].get('mux1_addr', config['SENSORS']['mux1_addr']), 16),
+                int(config[section].get('mux2_addr', config['SENSORS']['mux2_addr']), 16)))
+        monitor['_BUSES'] = buses
+        metrics_config = _section(config, 'METRICS')
+        monitor['_METRICS_ENABLED'] = helpers.to_bool(metrics_config.get('enabled', 'False'))
+        adaptive_config = _section(config, 'ADAPTIVE')
+        latest_config = _section(config, 'LATEST')
+        monitor['_LATEST_ENABLED'] = helpers.to_bool(latest_config.get('enabled', 'False'))
+        sinks_config = _section(config, 'PIPELINE')
+        monitor['_QUEUE_SIZE'] = _positive('queue_size', int(sinks_config.get('queue_size', '100')))
+        monitor['_OVERFLOW'] = _choice('overflow policy', str(sinks_config.get('overflow', pipeline.DROP_OLDEST)),
+                                       pipeline.OVERFLOW_POLICIES)
+        monitor['_SPILL_DIRECTORY'] = str(sinks_config.get('spill_directory', '/var/lib/sht21pi'))
+        monitor['_SINK_OVERFLOW'] = dict(
+            (name, _choice('overflow policy', str(sinks_config['{}_overflow'.format(name)]),
+                           pipeline.OVERFLOW_POLICIES))
+            for name in ('led', 'influx', 'file', 'latest') if '{}_overflow'.format(name) in sinks_config)
+        deadband_config = _section(config, 'DEADBAND')
+        aggregate_config = _section(config, 'AGGREGATE')
+        discovery_config = _section(config, 'DISCOVERY')
+        datalog_config = _section(config, 'DATALOG')
+        snapshot = {
+            'monitor': monitor,
+            'i2c': {
+                '_SENSORS_PRESENT': _present(config['SENSORS']['present']),
+                '_SENSORS_MUX1_ADDR': int(config['SENSORS']['mux1_addr'], 16),
+                '_SENSORS_MUX2_ADDR': int(config['SENSORS']['mux2_addr'], 16),
+                '_READY_POLLING': helpers.to_bool(config['SENSORS'].get('ready_polling', 'False')),
+            },
+            'scheduler': {
+                '_BREAKER_THRESHOLD': _positive('breaker_threshold',
+                                                int(config['SENSORS'].get('breaker_threshold', '3'))),
+                '_BREAKER_BACKOFF': float(config['SENSORS'].get('breaker_backoff', '30')),
+                '_BREAKER_MAX_BACKOFF': float(config['SENSORS'].get('breaker_max_backoff', '1800')),
+                '_ADAPTIVE_ENABLED': helpers.to_bool(adaptive_config.get('enabled', 'False')),
+                '_ADAPTIVE_MIN_INTERVAL': _positive('min_interval', float(adaptive_config.get('min_interval', '10'))),
+                '_ADAPTIVE_MAX_INTERVAL': _positive('max_interval', float(adaptive_config.get('max_interval', '300'))),
+                '_ADAPTIVE_TEMPERATURE_SLOPE': _positive('temperature_slope',
+                                                         float(adaptive_config.get('temperature_slope', '0.2'))),
+                '_ADAPTIVE_HUMIDITY_SLOPE': _positive('humidity_slope',
+                                                      float(adaptive_config.get('humidity_slope', '1.0'))),
+                '_ADAPTIVE_MAX_SENSORS': int(adaptive_config.get('max_sensors', '0')),
+            },
+            'led': {
+                '_LEDS_HUMIDITY_THRESHOLD': float(config['LEDS']['humidity_threshold']),
+            },
+            'influx': {
+                '_INFLUX_SERVER': str(config['INFLUX']['server']),
+                '_INFLUX_DATABASE': str(config['INFLUX']['database']),
+                '_INFLUX_USER': str(config['INFLUX']['user']),
+                '_INFLUX_PASSWORD': str(config['INFLUX']['password']),
+                '_INFLUX_BATCH_SIZE': _positive('batch_size', int(config['INFLUX'].get('batch_size', '500'))),
+                '_INFLUX_BATCH_AGE': float(config['INFLUX'].get('batch_age', '60')),
+                '_INFLUX_GZIP': helpers.to_bool(config['INFLUX'].get('gzip', 'True')),
+                '_INFLUX_SPOOL': str(config['INFLUX'].get('spool', '')),
+                '_INFLUX_DRAIN_BATCH': _positive('drain_batch', int(config['INFLUX'].get('drain_batch', '5000'))),
+                '_INFLUX_DRAIN_RATE': _positive('drain_rate', float(config['INFLUX'].get('drain_rate', '20000'))),
+            },
+            'metrics': {
+                '_METRICS_ENABLED': monitor['_METRICS_ENABLED'],
+                '_METRICS_ADDRESS': str(metrics_config.get('address', '127.0.0.1')),
+                '_METRICS_PORT': int(metrics_config.get('port', '9121')),
+            },
+            'latest': {
+                '_LATEST_ENABLED': monitor['_LATEST_ENABLED'],
+                '_LATEST_PATH': str(latest_config.get('path', '/run/sht21pi/latest')),
+            },
+            'deadband': {
+                '_DEADBAND_ENABLED': helpers.to_bool(deadband_config.get('enabled', 'False')),
+                '_DEADBAND_TEMPERATURE': float(deadband_config.get('temperature', '0.1')),
+                '_DEADBAND_HUMIDITY': float(deadband_config.get('humidity', '0.5')),
+                '_DEADBAND_HEARTBEAT': int(deadband_config.get('heartbeat', '600')),
+                '_DEADBAND_SINKS': tuple(name.strip() for name in str(deadband_config.get(
+                    'sinks', 'influx, file')).split(',') if name.strip()),
+                '_DEADBAND_SENSORS': deadband.parse_sensors(deadband_config),
+            },
+            'aggregate': {
+                '_AGGREGATE_ENABLED': helpers.to_bool(aggregate_config.get('enabled', 'False')),
+                '_AGGREGATE_WINDOWS': tuple(_positive('window', int(window)) for window in str(
+                    aggregate_config.get('windows', '60, 900, 3600')).split(',')),
+                '_AGGREGATE_RAW_UPSTREAM': helpers.to_bool(aggregate_config.get('raw_upstream', 'True')),
+                '_AGGREGATE_LOG_FILE': log_dir + str(aggregate_config.get('log_file', 'aggregates.log')),
+            },
+            'discovery': {
+                '_DISCOVERY_CACHE': str(discovery_config.get('cache', '/var/lib/sht21pi/topology.json')),
+                '_DISCOVERY_RESCAN': float(discovery_config.get('rescan', '86400')),
+                '_DISCOVERY_FAILURES': int(discovery_config.get('failures', '1')),
+            },
+            'datalog': {
+                '_DATALOG_MAX_BYTES': int(float(datalog_config.get('max_size', '16')) * (1 << 20)),
+                '_DATALOG_DAILY': helpers.to_bool(datalog_config.get('daily', 'True')),
+                '_DATALOG_COMPRESS': helpers.to_bool(datalog_config.get('compress', 'True')),
+                '_DATALOG_QUOTA': int(float(datalog_config.get('quota', '512')) * (1 << 20)),
+                '_DATALOG_FSYNC_INTERVAL': float(datalog_config.get('fsync_interval', '60')),
+            },
+        }
+    except KeyError as e:
+        raise KeyError("Configuration is missing key {}".format(e))
+    logging.getLogger().info("Configuration is done", exc_info=False)
+    return snapshot
+
+
+def _key(configfile):
+    """What a snapshot depends on: the configuration file, the modules parsing it and the python version"""
+    stat = os.stat(configfile)
+    return (_SNAPSHOT_VERSION, sys.version, os.path.abspath(configfile), stat.st_mtime, stat.st_size,
+            os.stat(__file__).st_mtime, os.stat(i2c.__file__).st_mtime, os.stat(deadband.__file__).st_mtime)
+
+
+def snapshot_path(configfile):
+    """The snapshot of a configuration file, in _SNAPSHOT_DIRECTORY and not next to it so /etc stays read only"""
+    return os.path.join(_SNAPSHOT_DIRECTORY, os.path.basename(configfile) + _SNAPSHOT_SUFFIX)
+
+
+def load(configfile):
+    """The settings of a configuration file, from its snapshot if the file did not change since it was taken
+    @param configfile: A file formated for python's configparser
+    @type configfile: str
+    @return: (settings like parse, True if they came from the snapshot)
+    """
+    try:
+        key = _key(configfile)
+    except (OSError, TypeError):  # No such file, configparser reports the missing sections
+        return parse(configfile), False
+    path = snapshot_path(configfile)
+    try:
+        with open(path, 'rb') as fp:
+            cached_key, snapshot = marshal.load(fp)
+        if cached_key == key:
+            return snapshot, True
+    except (IOError, OSError, EOFError, ValueError, TypeError):
+        pass
+    snapshot = parse(configfile)
+    try:  # It holds the influx password, only the owner may read it
+        fd = os.open(path + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.fchmod(fd, 0o600)  # A stale file keeps its mode
+        with os.fdopen(fd, 'wb') as fp:
+            marshal.dump((key, snapshot), fp)
+        os.rename(path + '.tmp', path)
+    except (IOError, OSError) as e:
+        if e.errno not in (errno.EACCES, errno.EROFS, errno.EPERM, errno.ENOENT):
+            raise
+        logging.getLogger().debug("Cannot write the configuration snapshot {}: {}".format(path, e))
+    return snapshot, False
+
+
+def apply(snapshot, name, module):
+    """Set the configured globals of a module
+    @param snapshot: settings from load or parse
+    @type snapshot: dict
+    @param name: Name of the module in the snapshot
+    @type name: str
+    @param module: The module
+    @type module: module
+    @return: module
+    """
+    for key, value in snapshot.get(name, {}).items():
+        setattr(module, key, value)
+    return module
+
+# vim: fileencoding=utf-8 filetype=python ts=4 expandtab
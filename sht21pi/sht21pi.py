@@ -11,18 +11,23 @@
 import sys
 # import os
 import logging
-import time
 import getopt
+import importlib
+import threading
 
-import smbus
 # import nclib
 
-import configparser
-
+# influx (requests), led, latest, metrics (http.server), the bus backends and configparser
+# are imported when the configuration needs them, see _import and settings.load
+import aggregate
+import datalog
+import deadband
 import helpers
 import i2c
-import led
-import influx
+import pipeline
+import scheduler
+import settings
+import sinks
 
 
 class StorageHumidityMonitor(object):
@@ -43,44 +48,209 @@ class StorageHumidityMonitor(object):
     _TEMPERATURE = []
     _HUMIDITY = []
 
-    def __init__(self, bus_nr):
+    def __init__(self, bus_nr, bus=None, configfile=None, profile=None):
         """
         @param bus_nr: Bus number used on this board. Can be 0 or 1. Default is 1 for raspberry pi.
         @type bus_nr: int
+        @param bus: Bus connection to use instead of the backend set in the configuration,
+        e.g. a simbus.SimulatedBus, or a list with one per configured bus
+        @type bus: backend.SMBusBackend
+        @param configfile: Configuration file to use instead of the -c argument
+        @type configfile: str
+        @param profile: Records the time of the startup phases
+        @type profile: helpers.StartupProfile
         @summary: Sensors 1-8 use mux1 and 9-16 use mux2. Which one to use is defined
         in the selectMuxOut function with the address for mux2 being substracted by 8
         as to match the analog and digital addresses(9-16 are known as 1-8 to mux2).
+        With [BUS <n>] sections in the configuration every bus has its own muxes and
+        sensors, the sensors of the i-th bus are reported as 1 + 16 * i to 16 + 16 * i.
         """
 #        configfile = 'sht21pi.conf'
-        self._get_configuration()
-        i2c._SENSORS_ADDR = []
+        self._profile = profile if profile is not None else helpers.StartupProfile()
+        self._modules = {}
+        with self._profile.phase('configuration'):
+            self._get_configuration(configfile)
         logging.basicConfig(filename='{}/{}'.format(self._LOG_DIR, self._LOG_NAME), level=self._LOG_LEVEL)
-        self._softreset(bus_nr)
-        for i in range(1, 17):
-            if ((i2c._SENSORS_PRESENT >> (i - 1)) & 0x1) == 1:  # Add existing sensors to Array _SENSORS_ADDR
-                i2c._SENSORS_ADDR.append(i)
+        with self._profile.phase('buses'):
+            self._open_buses(bus_nr, bus)
+        with self._profile.phase('sinks'):
+            self._sinks = self._create_sinks()
+        with self._profile.phase('pipeline'):
+            self._pipeline = self._create_pipeline() if self._ENGINE == 'threads' else None  # asyncio: see aioengine
+        self._metrics = None
+        self._metrics_server = None
+        if self._METRICS_ENABLED:
+            with self._profile.phase('metrics'):
+                metrics = self._import('metrics')
+                self._metrics = metrics.Metrics()
+                self._metrics_server = self._start_metrics()
+
+    def _import(self, name):
+        """Import a module on first use and set its configured globals
+        @param name: Module name
+        @type name: str
+        @return: module
+        """
+        try:
+            return self._modules[name]
+        except KeyError:
+            pass
+        with self._profile.phase('import {}'.format(name)):
+            module = importlib.import_module(name)
+        self._modules[name] = settings.apply(self._settings, name, module)
+        return module
+
+    def _open_buses(self, bus_nr, bus):
+        """Open, reset and schedule the configured buses
+        @param bus_nr: Bus number if there are no [BUS <n>] sections
+        @type bus_nr: int
+        @param bus: Bus connection or list of connections given to __init__
+        @type bus: backend.SMBusBackend
+        """
+        buses = self._BUSES or [(bus_nr, i2c._SENSORS_PRESENT, i2c._SENSORS_MUX1_ADDR, i2c._SENSORS_MUX2_ADDR)]
+        given = bus if isinstance(bus, (list, tuple)) else [bus]
+        self._devices = []
+        schedulers = []
+        for index, (nr, present, mux1_addr, mux2_addr) in enumerate(buses):
+            device = given[index] if index < len(given) and given[index] is not None else self._open_bus(
+                nr, present, (mux1_addr, mux2_addr))
+            self._softreset(device)
+            finder = None
+            if present is None:  # present = auto
+                finder = self._import('discovery').Discovery(nr, (mux1_addr, mux2_addr))
+                present = finder.discover(device, i2c.MuxController(device, [mux1_addr, mux2_addr]),
+                                          int(helpers.get_clock(device).time()))
+            if index == 0:
+                i2c._SENSORS_PRESENT = present
+            addrs = [i for i in range(1, 17) if (present >> (i - 1)) & 0x1]  # Existing sensors
+            cycle = scheduler.PipelinedScheduler(
+                device, addrs, mux1_addr, mux2_addr, offset=index * scheduler._SENSORS_PER_BUS)
+            cycle.discovery = finder
+            schedulers.append(cycle)
+            self._devices.append(device)
+        i2c.bus = self._devices[0]
+        i2c._SENSORS_ADDR = schedulers[0].addrs
+        if len(schedulers) == 1:
+            self._scheduler = schedulers[0]
+        else:
+            self._scheduler = scheduler.MultiBusScheduler(schedulers)
+        self._scheduler.configure_resolution(i2c._RESOLUTION)  # The soft reset restored the default
 
-    def _softreset(self, bus_nr="1"):
+    def _create_sinks(self):
+        """Create the enabled sinks. The led strip and the influx session are set up
+        once for the lifetime of the monitor.
+        @return: [(name, sinks.Sink)]
         """
-        @param bus_nr: default bus is 1 on this board.
+        created = []
+        self._indicator = None
+        self._influx_writer = None
+        if self._LEDS_ENABLED:
+            self._indicator = self._import('led').Argospi2cWS2811x()
+            created.append(('led', sinks.LedSink(self._indicator)))
+        if self._INFLUX_ENABLED:
+            influx = self._import('influx')
+            spool = self._import('spool').Spool(influx._INFLUX_SPOOL) if influx._INFLUX_SPOOL else None
+            writer = self._influx_writer = influx.InfluxWriter(
+                influx._INFLUX_SERVER, influx._INFLUX_DATABASE, influx._INFLUX_USER, influx._INFLUX_PASSWORD,
+                batch_size=influx._INFLUX_BATCH_SIZE, batch_age=influx._INFLUX_BATCH_AGE,
+                compress=influx._INFLUX_GZIP,
+                spool=spool,
+                drain_batch=influx._INFLUX_DRAIN_BATCH, drain_rate=influx._INFLUX_DRAIN_RATE)
+            created.append(('influx', sinks.InfluxSink(writer)))
+        if self._LATEST_ENABLED:
+            latest = self._import('latest')
+            created.append(('latest', sinks.LatestSink(latest.LatestWriter(latest._LATEST_PATH))))
+        if self._LOG_ENABLED and self._LOG_FORMAT == 'binary':
+            created.append(('file', sinks.BinaryLogSink(self._BINARY_LOG_DIRECTORY, aggregate._AGGREGATE_LOG_FILE)))
+        elif self._LOG_ENABLED:
+            created.append(('file', sinks.FileSink(self._LOG_FILE, aggregate._AGGREGATE_LOG_FILE)))
+        if deadband._DEADBAND_ENABLED:
+            created = [(name, sinks.DeadbandSink(sink) if name in deadband._DEADBAND_SINKS else sink)
+                       for name, sink in created]
+        if aggregate._AGGREGATE_ENABLED:  # Outside of the deadband, the aggregates see every reading
+            created = [(name, sinks.AggregateSink(sink, raw=aggregate._AGGREGATE_RAW_UPSTREAM or name == 'file')
+                        if name in ('influx', 'file') else sink) for name, sink in created]
+        return created
+
+    def _create_pipeline(self):
+        """Start a worker thread for every sink
+        @return: pipeline.SinkPipeline
+        """
+        sink_pipeline = pipeline.SinkPipeline(self._QUEUE_SIZE, self._OVERFLOW, self._SPILL_DIRECTORY)
+        for name, sink in self._sinks:
+            sink_pipeline.add(name, sink, self._SINK_OVERFLOW.get(name))
+        return sink_pipeline
+
+    def _start_metrics(self):
+        """Serve the metrics of the scheduler and the sinks over http
+        @return: metrics.MetricsServer
+        """
+        metrics = self._import('metrics')
+        registry = self._metrics
+        self._scheduler.cycle_histogram = metrics.Histogram()
+        registry.add_scheduler(self._scheduler)
+        if self._pipeline is not None:  # The asyncio engine adds its pipeline once it runs
+            registry.add_pipeline(self._pipeline)
+        if self._influx_writer is not None:
+            registry.add_influx(self._influx_writer)
+        if self._indicator is not None:
+            registry.add_led(self._indicator)
+        registry.add_deadband(self._deadbands())
+        return metrics.MetricsServer(registry, metrics._METRICS_ADDRESS, metrics._METRICS_PORT)
+
+    def _deadbands(self):
+        """Deadbands of the sinks, a sinks.DeadbandSink may be wrapped by a sinks.AggregateSink
+        @return: {str: deadband.Deadband}
+        """
+        found = {}
+        for name, sink in self._sinks:
+            while sink is not None:
+                if isinstance(sink, sinks.DeadbandSink):
+                    found[name] = sink.deadband
+                sink = getattr(sink, 'sink', None)
+        return found
+
+    def _open_bus(self, bus_nr, present, mux_addrs):
+        """Open the bus backend set in the configuration
+        @param bus_nr: Bus number
         @type bus_nr: int
+        @param present: Sensors present on the bus for the simulated backend, None for all
+        @type present: int
+        @param mux_addrs: I2C addresses of the muxes, for the simulated backend
+        @type mux_addrs: (int, int)
+        @return: backend.SMBusBackend or simbus.SimulatedBus
+        """
+        if self._BACKEND == 'simulated':
+            return self._import('simbus').SimulatedBus(
+                present=present if present is not None else 0xffff, mux_addrs=mux_addrs, seed=int(bus_nr))
+        return self._import('backend').SMBusBackend(int(bus_nr))
+
+    def _softreset(self, bus):
+        """
+        @param bus: Open bus connection
+        @type bus: backend.SMBusBackend
         """
         try:  # Soft reset the bus
-            i2c.bus = smbus.SMBus(int(bus_nr))
-            i2c.bus.write_byte(i2c._I2C_ADDRESS, i2c._SOFTRESET)
-            time.sleep(0.015)
+            bus.write_byte(i2c._I2C_ADDRESS, i2c._SOFTRESET)
+            helpers.get_clock(bus).sleep(0.015)
         except IOError as err:
             logging.getLogger().error("Error during initialization: {}".format(err), exc_info=False)
             pass
         except Exception as ere:
             raise Exception("Unexpected Exception {}".format(ere))
 
-    def _get_configuration(self):
+    def _get_configuration(self, configfile=None):
         """Try to open a configuration file passed as an argument and fallback
         to the default if none was passed.
+        @param configfile: Configuration file, the -c argument is used if None
+        @type configfile: str
         """
+        if configfile is not None:
+            logging.getLogger().info("Got configuration {}".format(configfile), exc_info=False)
+            self._read_configuration(configfile)
+            return
         try:  # Abort if -c option is used without a filename
-            opts, args = getopt.getopt(sys.argv[1:], "c:")
+            opts, args = getopt.getopt(sys.argv[1:], "c:", ["daemon", "interval=", "profile-startup"])
         except getopt.GetoptError:
             logging.getLogger().error("Usage: Missing argument -c. Ensure -c file exists", exc_info=False)
             sys.exit(1)
@@ -99,32 +269,21 @@ class StorageHumidityMonitor(object):
             self._read_configuration(configfile)
 
     def _read_configuration(self, configfile):
-        """Parse a config file
+        """Load the settings of a config file, see settings.load, and set the globals
+        of the modules that are always imported. The others get theirs in _import.
         @param configfile: A file formated for python's configparser
         @type configfile: configuration file
         """
-        config = configparser.ConfigParser()
-        try:
-            config.read(configfile)
-            self._INFLUX_ENABLED = helpers.to_bool(config['INFLUX']['enabled'])
-            self._LEDS_ENABLED = helpers.to_bool(config['LEDS']['enabled'])
-            self._LOG_FILE = str(config['CONFIGURATION']['log_directory']) + str(config['CONFIGURATION']['log_file'])
-            self._LOG_DIR = str(config['CONFIGURATION']['log_directory'])
-            self._LOG_ENABLED = helpers.to_bool(config['CONFIGURATION']['log_enabled'])
-            self._LOG_LEVEL = str(config['CONFIGURATION']['log_level'])
-            i2c._SENSORS_PRESENT = int(config['SENSORS']['present'], 16)
-            i2c._SENSORS_MUX1_ADDR = int(config['SENSORS']['mux1_addr'], 16)
-            i2c._SENSORS_MUX2_ADDR = int(config['SENSORS']['mux2_addr'], 16)
-            led._LEDS_HUMIDITY_THRESHOLD = float(config['LEDS']['humidity_threshold'])
-            influx._INFLUX_SERVER = str(config['INFLUX']['server'])
-            influx._INFLUX_DATABASE = str(config['INFLUX']['database'])
-            influx._INFLUX_USER = str(config['INFLUX']['user'])
-            influx._INFLUX_PASSWORD = str(config['INFLUX']['password'])
-            logging.getLogger().info("Configuration is done", exc_info=False)
-        except KeyError as e:
-            raise KeyError("Configuration is missing key {}".format(e))
+        self._settings, cached = settings.load(configfile)
+        logging.getLogger().info("Configuration {}".format("from snapshot" if cached else "parsed"), exc_info=False)
+        for key, value in self._settings['monitor'].items():
+            setattr(self, key, value)
+        for name, module in (('i2c', i2c), ('scheduler', scheduler), ('deadband', deadband), ('aggregate', aggregate),
+                             ('datalog', datalog)):
+            settings.apply(self._settings, name, module)
+        i2c.set_resolution(self._RESOLUTION)
         try:
-            if (influx._INFLUX_USER == 'influxUsername') and (self._INFLUX_ENABLED):
+            if (self._settings['influx']['_INFLUX_USER'] == 'influxUsername') and (self._INFLUX_ENABLED):
                 sys.exit(1)
         except Exception:
             raise Exception("Please configure the influx username and password before using this software.")
@@ -138,19 +297,29 @@ class StorageHumidityMonitor(object):
         self.close()
 
     def close(self):
-        """Closes the i2c connection"""
-        i2c.bus.close()
+        """Lets the sinks handle their backlog, closes them, the metrics server and the i2c connections"""
+        if self._pipeline is not None:
+            self._pipeline.close()
+        else:  # Sinks the asyncio engine did not run
+            for name, sink in self._sinks:
+                sink.close()
+            self._sinks = []
+        if self._metrics_server is not None:
+            self._metrics_server.close()
+        if isinstance(self._scheduler, scheduler.MultiBusScheduler):
+            self._scheduler.close()
+        for device in self._devices:
+            device.close()
 
     def write_log(self, message):
         """Write to data log
         @param message: An array with sensors readings to be written to the data log.
-        @type message: [[int, int, float, float]]
+        @type message: readings.ReadingBatch or [[int, int, float, float]]
         @return: None
         """
         try:
             fp = open(self._LOG_FILE, 'a')
-            for i in range(len(message)):
-                fp.write("{}, {}, {}, {}\n".format(message[i][0], message[i][1], message[i][2], message[i][3]))
+            fp.write(helpers.format_log(message))
         except IOError as e:
             raise IOError("Cannot access file {}".format(e), exc_info=True)
         finally:
@@ -160,38 +329,64 @@ class StorageHumidityMonitor(object):
     def run(self):
         """
         Run the main loop. Log to application log if debug level is DEBUG.
-        Then write to database, log to file, check humidity treshold, update leds.
+        Then hand the readings to the sinks, which check the humidity treshold
+        and update the leds, write to the database and log to file on their own threads.
         """
         self.debug()
+        if self._ENGINE == 'asyncio':  # The sinks stay open for the next call, close() closes them
+            import aioengine  # python 3 only
+            aioengine.run(self, 0., cycles=1, keep_sinks=True)
+            return
         try:
-            log_batch = []
-            status = [0] * led._LED_COUNT
-
-            for i in i2c._SENSORS_ADDR:  # Acquire sensor data
-                data = i2c.read_i2c_addr(i)
-                log_batch.append(data)
+            log_batch = self._scheduler.read_all()  # Acquire sensor data
 
-            if data[3] > led._LEDS_HUMIDITY_THRESHOLD:  # Update the treshold status
-                status[i % (led._LED_COUNT)] += 1
-
-            if self._LEDS_ENABLED:  # Update the leds according to treshold status
-                logging.getLogger().info("Updating LEDs", exc_info=False)
-                indicator = led.Argospi2cWS2811x()
-                indicator.set_leds(status)
-
-            if self._INFLUX_ENABLED:  # Write to database
-                logging.getLogger().info("Contacting influx", exc_info=False)
-                data = influx.prepare_data(log_batch)
-                influx.post_to_database(data)
-
-            if self._LOG_ENABLED:  # Write to local logfile
-                logging.getLogger().info("Log file enabled", exc_info=False)
-                helpers.write_log(self._LOG_FILE, log_batch)
+            self._pipeline.publish(log_batch)  # Update leds, write to database and local logfile
+            self._pipeline.debug()
         except IndexError:
             logging.getLogger().error("Index out of range.", exc_info=True)
         except IOError:
             logging.getLogger().error("Failed to connect to i2c.", exc_info=True)
 
+    def run_forever(self, interval, stop=None, cycles=None):
+        """
+        Run acquisition cycles until stop is set. Cycles start on a fixed
+        monotonic schedule so the run time of a cycle does not add up to drift.
+        Slots missed by an overrunning cycle are skipped instead of run back to back.
+        On a simulated bus the schedule runs on its virtual clock.
+        @param interval: Seconds between the start of two cycles
+        @type interval: float
+        @param stop: Event to end the loop, e.g. set from a signal handler
+        @type stop: threading.Event
+        @param cycles: Number of cycles to run, None to run until stopped
+        @type cycles: int
+        @return: None
+        """
+        if self._ENGINE == 'asyncio':
+            import aioengine  # python 3 only
+            aioengine.run(self, interval, stop, cycles)
+            return
+        if stop is None:
+            stop = threading.Event()
+        clock = helpers.get_clock(i2c.bus)
+        deadline = clock.monotonic()
+        while not stop.is_set():
+            self.run()
+            if cycles is not None:
+                cycles -= 1
+                if cycles <= 0:
+                    break
+            deadline += interval
+            now = clock.monotonic()
+            if now > deadline:
+                missed = int((now - deadline) // interval) + 1
+                logging.getLogger().warning("Cycle overran by {:.3f}s, skipping {} slot(s)".format(
+                    now - deadline, missed))
+                deadline += missed * interval
+            if clock is helpers.CLOCK:
+                stop.wait(deadline - now)
+            else:
+                clock.sleep(deadline - now)
+
     def debug(self):
         ''' Print configuration to application log if debug level is set to DEBUG
         @return: None
@@ -199,9 +394,16 @@ class StorageHumidityMonitor(object):
         logging.getLogger().debug('\nLOG_ENABLED:\t\t{}'.format(self._LOG_ENABLED))
         logging.getLogger().debug('LOG_FILE:\t\t\t{}'.format(self._LOG_FILE))
         logging.getLogger().debug('LOG_LEVEL:\t\t\t{}'.format(self._LOG_LEVEL))
+        logging.getLogger().debug('LOG_FORMAT:\t\t\t{}'.format(self._LOG_FORMAT))
+        logging.getLogger().debug('ENGINE:\t\t\t{}'.format(self._ENGINE))
         logging.getLogger().debug('LEDS_ENABLED:\t\t{}'.format(self._LEDS_ENABLED))
         logging.getLogger().debug('INFLUX_ENABLED:\t\t{}'.format(self._INFLUX_ENABLED))
         i2c.debug()
-        influx.debug()
+        datalog.debug()
+        deadband.debug()
+        aggregate.debug()
+        for name in ('influx', 'latest', 'metrics', 'discovery'):
+            if name in self._modules:
+                self._modules[name].debug()
 
 # vim: fileencoding=utf-8 filetype=python ts=4 expandtab
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+@author: Andre Poley
+@contact: andre.poley@mailbox.org
+@copyright: (c) 2019 by Andre Poley, Berkeley
+@license: MIT
+@version: 0.0.5
+@summary: Simulated bus with two multiplexers and up to 16 sht21 for tests and benchmarks without hardware.
+'''
+import errno
+import random
+
+import i2c
+
+_EPOCH = 1600000000    # Wall clock time of the simulation start
+_BUS_SPEED = 100000.   # Standard mode, bits per second
+_BITS_PER_BYTE = 9     # 8 data bits and the ack
+_FRAME_BITS = 2        # start and stop condition
+_USER_REGISTER = 0x3a  # Default after power on, datasheet (v4), page 9
+_RESERVED_BITS = 0x38  # Bits 3-5 of the user register are kept by the sensor
+_STATUS_HUMIDITY = 0x02  # Bit 1 of the lsb marks a humidity result
+FAULTS = ('nack', 'crc', 'stuck')
+
+
+class SimClock(object):
+    """Virtual time, sleep() advances it without waiting. Same interface as helpers.Clock."""
+
+    def __init__(self, start=0.):
+        self._now = float(start)
+        self.slept = 0.
+
+    def monotonic(self):
+        return self._now
+
+    def time(self):
+        return _EPOCH + self._now
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            self._now += seconds
+            self.slept += seconds
+
+    def advance(self, seconds):
+        """Pass time spent on the bus"""
+        self._now += seconds
+
+
+class SimulatedSensor(object):
+    """State of one sht21: user register, running conversion and its result"""
+
+    def __init__(self, number, temperature, humidity):
+        self.number = number
+        self.temperature = temperature
+        self.humidity = humidity
+        self.register = _USER_REGISTER
+        self.ready_at = None
+        self.result = None
+        self.conversions = 0
+
+    def resolution(self):
+        bits = self.register & i2c._RESOLUTION_MASK
+        for resolution, values in i2c._RESOLUTIONS.items():
+            if values[0] == bits:
+                return values
+
+    def reset(self):
+        self.register = _USER_REGISTER
+        self.ready_at = None
+        self.result = None
+
+
+class SimulatedBus(object):
+    """
+    Bus connection with the interface of backend.SMBusBackend. The muxes keep their
+    channel register, every sht21 answers at i2c._I2C_ADDRESS on its mux channel:
+      - triggers start a conversion taking between the typical and maximum time of the resolution
+      - reads NACK until the conversion is done and return msb, lsb and checksum
+      - the user register can be read and written, soft reset restores it
+    Two sensors answering at the same time is a bus conflict and fails with EIO,
+    no sensor answering fails with a NACK. Every transfer advances the clock by
+    its duration at 100kHz. Faults can be injected per sensor, see inject_fault.
+    """
+
+    def __init__(self, present=0xffff, mux_addrs=(0x70, 0x71), clock=None, seed=0, temperature=21., humidity=45.):
+        """
+        @param present: Sensors present, bit n-1 for sensor n like i2c._SENSORS_PRESENT
+        @type present: int
+        @param mux_addrs: I2C addresses of the muxes, sensors 1-8 on the first, 9-16 on the second
+        @type mux_addrs: (int, int)
+        @param clock: Virtual clock, a new one if None
+        @type clock: SimClock
+        @param seed: Seed of the conversion times and readings
+        @type seed: int
+        @param temperature: Mean temperature in C
+        @type temperature: float
+        @param humidity: Mean relative humidity in percent
+        @type humidity: float
+        """
+        self.clock = clock if clock is not None else SimClock()
+        self.mux_addrs = list(mux_addrs)
+        self.channels = dict((addr, 0x00) for addr in self.mux_addrs)
+        self._random = random.Random(seed)
+        self.sensors = {}
+        for number in range(1, 8 * len(self.mux_addrs) + 1):
+            if (present >> (number - 1)) & 0x1:
+                self.sensors[number] = SimulatedSensor(
+                    number, temperature + self._random.uniform(-2., 2.), humidity + self._random.uniform(-5., 5.))
+        self.faults = {}
+        self.transactions = 0
+        self.bytes = 0
+        self.busy_time = 0.
+        self.nacks = 0
+        self.closed = False
+
+    def inject_fault(self, number, kind, count=None):
+        """Make a sensor misbehave
+        @param number: Sensor 1-16
+        @type number: int
+        @param kind: 'nack': every transfer is NACKed, 'crc': results have a wrong checksum,
+        'stuck': conversions never finish
+        @type kind: str
+        @param count: Transfers (nack), results (crc) or conversions (stuck) affected, None for all
+        @type count: int
+        """
+        if kind not in FAULTS:
+            raise ValueError("Unknown fault '{}', use one of {}".format(kind, ', '.join(FAULTS)))
+        self.faults[number] = [kind, count]
+
+    def clear_faults(self):
+        self.faults = {}
+
+    def _fault(self, sensor, kind):
+        """Whether a fault of this kind applies now, counts it down"""
+        fault = self.faults.get(sensor.number)
+        if fault is None or fault[0] != kind:
+            return False
+        if fault[1] is not None:
+            fault[1] -= 1
+            if fault[1] <= 0:
+                del self.faults[sensor.number]
+        return True
+
+    def _transfer(self, length):
+        """Account for a transaction of length bytes after the address byte"""
+        duration = ((length + 1) * _BITS_PER_BYTE + _FRAME_BITS) / _BUS_SPEED
+        self.clock.advance(duration)
+        self.transactions += 1
+        self.bytes += length + 1
+        self.busy_time += duration
+
+    def _nack(self, addr):
+        self.nacks += 1
+        return IOError(getattr(errno, 'EREMOTEIO', errno.EIO), "Remote I/O error: no ack from {}".format(hex(addr)))
+
+    def _sensor(self, addr):
+        """The sensor answering at addr through the open mux channels"""
+        if self.closed:
+            raise IOError(errno.EBADF, "Bus is closed")
+        if addr != i2c._I2C_ADDRESS:
+            raise self._nack(addr)
+        answering = []
+        for mux, mux_addr in enumerate(self.mux_addrs):
+            for channel in range(8):
+                if self.channels[mux_addr] >> channel & 0x1:
+                    sensor = self.sensors.get(mux * 8 + channel + 1)
+                    if sensor is not None:
+                        answering.append(sensor)
+        if len(answering) > 1:
+            raise IOError(errno.EIO, "Bus conflict: sensors {} answer at {}".format(
+                ', '.join(str(sensor.number) for sensor in answering), hex(addr)))
+        if not answering or self._fault(answering[0], 'nack'):
+            raise self._nack(addr)
+        return answering[0]
+
+    def _convert(self, sensor, command):
+        """Start a conversion, the result is available once it is done"""
+        bits, t_max, t_typ, rh_max, rh_typ = sensor.resolution()
+        if command == i2c._TRIGGER_TEMPERATURE_NO_HOLD:
+            sensor.temperature += self._random.gauss(0., 0.01)
+            word = i2c._get_raw_from_temperature(sensor.temperature)
+            typ, maximum = t_typ, t_max
+        else:
+            sensor.humidity += self._random.gauss(0., 0.05)
+            word = i2c._get_raw_from_humidity(sensor.humidity) | _STATUS_HUMIDITY
+            typ, maximum = rh_typ, rh_max
+        sensor.conversions += 1
+        sensor.result = bytearray([word >> 8, word & 0xff])
+        if self._fault(sensor, 'stuck'):
+            sensor.ready_at = float('inf')
+        else:
+            sensor.ready_at = self.clock.monotonic() + self._random.uniform(typ, maximum - 0.001)
+
+    def write_byte(self, addr, value):
+        self._transfer(1)
+        if addr in self.channels:
+            self.channels[addr] = value & 0xff
+            return
+        sensor = self._sensor(addr)
+        if value in (i2c._TRIGGER_TEMPERATURE_NO_HOLD, i2c._TRIGGER_HUMIDITY_NO_HOLD):
+            self._convert(sensor, value)
+        elif value == i2c._SOFTRESET:
+            sensor.reset()
+        else:
+            raise self._nack(addr)
+
+    def read_byte(self, addr):
+        self._transfer(1)
+        if addr in self.channels:
+            return self.channels[addr]
+        raise self._nack(addr)
+
+    def write_byte_data(self, addr, register, value):
+        self._transfer(2)
+        sensor = self._sensor(addr)
+        if register != i2c._WRITE_USER_REGISTER:
+            raise self._nack(addr)
+        sensor.register = (sensor.register & _RESERVED_BITS) | (value & ~_RESERVED_BITS & 0xff)
+
+    def read_byte_data(self, addr, register):
+        self._transfer(2)
+        sensor = self._sensor(addr)
+        if register != i2c._READ_USER_REGISTER:
+            raise self._nack(addr)
+        return sensor.register
+
+    def read_block(self, addr, length):
+        """Read the result of the last conversion, NACKed while it is running
+        @return: bytearray of msb, lsb and checksum
+        """
+        self._transfer(length)
+        sensor = self._sensor(addr)
+        if sensor.result is None or self.clock.monotonic() < sensor.ready_at:
+            raise self._nack(addr)
+        data = sensor.result + bytearray([i2c._crc8(sensor.result)])
+        sensor.result = None
+        if self._fault(sensor, 'crc'):
+            data[2] ^= 0xff
+        return data[:length]
+
+    def close(self):
+        self.closed = True
+
+# vim: fileencoding=utf-8 filetype=python ts=4 expandtab
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+@author: Andre Poley
+@contact: andre.poley@mailbox.org
+@copyright: (c) 2019 by Andre Poley, Berkeley
+@license: MIT
+@version: 0.0.5
+@summary: Consumers of the readings of a cycle: leds, influx and the data log.
+'''
+import logging
+
+import aggregate
+import datalog
+import deadband
+import readings
+
+
+class Sink(object):
+    """A sink gets the readings of every cycle from its pipeline.SinkWorker"""
+
+    def handle(self, batch):
+        """
+        @param batch: readings of one cycle
+        @type batch: readings.ReadingBatch
+        """
+        raise NotImplementedError
+
+    def handle_aggregates(self, aggregates):
+        """
+        @param aggregates: windows finished in the cycle, see aggregate.Aggregator
+        @type aggregates: [aggregate.Aggregate]
+        """
+        pass
+
+    def close(self):
+        pass
+
+
+class LedSink(Sink):
+    """
+    Shows how many sensors are above the humidity threshold on the leds. Sensors that
+    are not in a batch, because the adaptive sampling skipped them or they failed, keep
+    the state of their last reading.
+    """
+
+    def __init__(self, indicator):
+        """
+        @param indicator: led strip
+        @type indicator: led.Argospi2cWS2811x
+        """
+        self.indicator = indicator
+        self.humid = {}  # {sensor address: above the threshold at the last reading}
+
+    def handle(self, batch):
+        import led  # Imported by the monitor once the leds are enabled
+        for data in batch:  # Update the treshold status
+            self.humid[data[1]] = data[3] > led._LEDS_HUMIDITY_THRESHOLD
+        status = [0] * led._LED_COUNT
+        for addr, humid in self.humid.items():
+            if humid:
+                status[addr % (led._LED_COUNT)] += 1
+        logging.getLogger().info("Updating LEDs", exc_info=False)
+        self.indicator.set_leds(status)
+
+    def close(self):
+        self.indicator.close()
+
+
+class InfluxSink(Sink):
+    """Writes the readings to influx, see influx.InfluxWriter"""
+
+    def __init__(self, writer):
+        """
+        @param writer: influx writer
+        @type writer: influx.InfluxWriter
+        """
+        self.writer = writer
+
+    def handle(self, batch):
+        logging.getLogger().info("Contacting influx", exc_info=False)
+        self.writer.write(batch)
+
+    def handle_aggregates(self, aggregates):
+        self.writer.write_aggregates(aggregates)
+
+    def close(self):
+        self.writer.close()
+
+
+class FileSink(Sink):
+    """Appends the readings to the data log, see datalog.DataLogWriter"""
+
+    def __init__(self, logfile, aggregate_file=None):
+        """
+        @param logfile: path of the data log
+        @type logfile: str
+        @param aggregate_file: path of the aggregate log
+        @type aggregate_file: str
+        """
+        self.logfile = logfile
+        self.writer = datalog.DataLogWriter(logfile)
+        self.aggregate_file = aggregate_file
+
+    def handle(self, batch):
+        self.writer.write(batch)
+
+    def handle_aggregates(self, aggregates):
+        if self.aggregate_file:
+            aggregate.write_log(self.aggregate_file, aggregates)
+
+    def close(self):
+        self.writer.close()
+
+
+class BinaryLogSink(Sink):
+    """Appends the readings to the binary data log, see binlog.BinaryLogWriter"""
+
+    def __init__(self, directory, aggregate_file=None):
+        """
+        @param directory: directory of the segments
+        @type directory: str
+        @param aggregate_file: path of the aggregate log, aggregates are kept as text
+        @type aggregate_file: str
+        """
+        import binlog  # Only needed with log_format = binary
+        self.writer = binlog.BinaryLogWriter(directory)
+        self.aggregate_file = aggregate_file
+
+    def handle(self, batch):
+        self.writer.write(batch)
+        self.writer.flush()
+
+    def handle_aggregates(self, aggregates):
+        if self.aggregate_file:
+            aggregate.write_log(self.aggregate_file, aggregates)
+
+    def close(self):
+        self.writer.close()
+
+
+class LatestSink(Sink):
+    """Publishes the latest reading of every sensor for local readers, see latest.LatestWriter"""
+
+    def __init__(self, writer):
+        """
+        @param writer: memory mapped table
+        @type writer: latest.LatestWriter
+        """
+        self.writer = writer
+
+    def handle(self, batch):
+        self.writer.write(batch)
+
+    def close(self):
+        self.writer.close()
+
+
+class DeadbandSink(Sink):
+    """Passes only the readings that moved by more than the deadband on to a sink, see deadband.Deadband"""
+
+    def __init__(self, sink, band=None):
+        """
+        @param sink: sink to pass the readings on to
+        @type sink: Sink
+        @param band: deadband, one with the configured defaults if None
+        @type band: deadband.Deadband
+        """
+        self.sink = sink
+        self.deadband = band if band is not None else deadband.Deadband()
+
+    def handle(self, batch):
+        reported = self.deadband.filter(batch)
+        if len(reported) or reported.failures:
+            self.sink.handle(reported)
+
+    def handle_aggregates(self, aggregates):
+        self.sink.handle_aggregates(aggregates)
+
+    def close(self):
+        self.sink.close()
+
+
+class AggregateSink(Sink):
+    """Adds the windows finished by the readings of a cycle, see aggregate.Aggregator"""
+
+    def __init__(self, sink, aggregator=None, raw=True):
+        """
+        @param sink: sink to pass the readings and aggregates on to
+        @type sink: Sink
+        @param aggregator: aggregator, one with the configured windows if None
+        @type aggregator: aggregate.Aggregator
+        @param raw: Pass the readings on too, failures always are
+        @type raw: bool
+        """
+        self.sink = sink
+        self.aggregator = aggregator if aggregator is not None else aggregate.Aggregator()
+        self.raw = raw
+
+    def handle(self, batch):
+        aggregates = self.aggregator.add(batch)
+        if self.raw:
+            self.sink.handle(batch)
+        elif batch.failures:
+            failed = readings.ReadingBatch()
+            failed.failures.extend(batch.failures)
+            self.sink.handle(failed)
+        if aggregates:
+            self.sink.handle_aggregates(aggregates)
+
+    def close(self):
+        dropped = self.aggregator.discard()  # Windows still open are incomplete
+        if dropped:
+            logging.getLogger().info("Dropped {} unfinished aggregate windows".format(dropped))
+        self.sink.close()
+
+# vim: fileencoding=utf-8 filetype=python ts=4 expandtab
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+@author: Andre Poley
+@contact: andre.poley@mailbox.org
+@copyright: (c) 2019 by Andre Poley, Berkeley
+@license: MIT
+@version: 0.0.5
+@summary: Durable first in first out buffer for lines waiting to be sent, kept in an sqlite database.
+'''
+import logging
+import sqlite3
+import threading
+
+
+class Spool(object):
+    """
+    Lines are appended in one transaction per batch and removed only after they
+    were delivered, so nothing is lost when the process stops during an outage.
+    The database runs in WAL mode, an append is a sequential write to the log.
+    Safe to use from several threads.
+    """
+
+    def __init__(self, path):
+        """
+        @param path: Database file, created if missing
+        @type path: str
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS spool (id INTEGER PRIMARY KEY AUTOINCREMENT, line TEXT NOT NULL)')
+        self._db.commit()
+        backlog = len(self)
+        if backlog:
+            logging.getLogger().info("Spool {} holds {} lines".format(path, backlog))
+
+    def append(self, lines):
+        """Add lines at the end
+        @param lines: lines to keep
+        @type lines: [str]
+        """
+        with self._lock:
+            self._db.executemany('INSERT INTO spool (line) VALUES (?)', ((line,) for line in lines))
+            self._db.commit()
+
+    def peek(self, limit):
+        """Get the oldest lines without removing them
+        @param limit: maximum number of lines
+        @type limit: int
+        @return: id of the last line returned (None if empty) and the lines
+        @rtype: (int, [str])
+        """
+        with self._lock:
+            rows = self._db.execute('SELECT id, line FROM spool ORDER BY id LIMIT ?', (limit,)).fetchall()
+        if not rows:
+            return None, []
+        return rows[-1][0], [row[1] for row in rows]
+
+    def ack(self, last_id):
+        """Remove the lines up to last_id after they were delivered
+        @param last_id: id returned by peek
+        @type last_id: int
+        """
+        with self._lock:
+            self._db.execute('DELETE FROM spool WHERE id <= ?', (last_id,))
+            self._db.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM spool').fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+# vim: fileencoding=utf-8 filetype=python ts=4 expandtab
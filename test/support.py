@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""Configuration and monitor loading shared by the tests that run the monitor"""
+import os
+
+try:
+    import configparser
+except ImportError:  # python2 without the backport, the monitor cannot be loaded
+    configparser = None
+
+CONFIG = """[CONFIGURATION]
+log_enabled = True
+log_directory = {directory}/
+log_file = data.log
+log_level = ERROR
+
+[SENSORS]
+present = 0xff40
+mux1_addr = 0x70
+mux2_addr = 0x71
+backend = simulated
+
+[LEDS]
+enabled = False
+humidity_threshold = 40
+
+[INFLUX]
+enabled = False
+server = example.com:8086
+database = influxDatabase
+user = influxUsername
+password = influxPassword
+"""
+
+
+def load_monitor():
+    """sht21pi.py has the name of the package, load it from its path"""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'sht21pi', 'sht21pi.py')
+    try:
+        import importlib.util
+        spec = importlib.util.spec_from_file_location('sht21pi_monitor', path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+    except ImportError:  # python2
+        import imp
+        return imp.load_source('sht21pi_monitor', path)
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'sht21pi'))
+
+import aggregate  # noqa: E402
+import readings  # noqa: E402
+import sinks  # noqa: E402
+
+_EPOCH = 1600000200  # Start of a 15 min window
+
+
+class _Sink(sinks.Sink):
+
+    def __init__(self):
+        self.batches = []
+        self.aggregates = []
+
+    def handle(self, batch):
+        self.batches.append(batch)
+
+    def handle_aggregates(self, aggregates):
+        self.aggregates.extend(aggregates)
+
+
+def _batch(epoch, *rows):
+    batch = readings.ReadingBatch()
+    for addr, t_raw, rh_raw in rows:
+        batch.append(epoch, addr, t_raw, rh_raw)
+    return batch
+
+
+class AggregateTestSuite(unittest.TestCase):
+    """Rolling min/max/mean over aligned windows"""
+
+    def test_windows(self):
+        aggregator = aggregate.Aggregator((60, 900))
+        finished = []
+        for i in range(12):  # Two minutes every 10s, sensor 2 only in the first
+            rows = [(1, 0x6000 + 4 * i, 0x7000 - 4 * i)] + ([(2, 0x6000, 0x7000)] if i < 6 else [])
+            finished.extend(aggregator.add(_batch(_EPOCH + 10 * i, *rows)))
+        self.assertEqual([(row.window, row.start, row.addr, row.count) for row in finished],
+                         [(60, _EPOCH, 1, 6), (60, _EPOCH, 2, 6)])
+        first = finished[0]
+        self.assertAlmostEqual(first.temperature_min, readings.temperature([0x6000])[0])
+        self.assertAlmostEqual(first.temperature_max, readings.temperature([0x6000 + 20])[0])
+        self.assertAlmostEqual(first.temperature_mean, sum(readings.temperature([0x6000 + 8, 0x6000 + 12])) / 2)
+        self.assertAlmostEqual(first.humidity_min, readings.humidity([0x7000 - 20])[0])
+        finished = aggregator.add(_batch(_EPOCH + 900, (1, 0x6000, 0x7000)))
+        self.assertEqual([(row.window, row.start, row.addr, row.count) for row in finished],
+                         [(60, _EPOCH + 60, 1, 6), (900, _EPOCH, 1, 12), (900, _EPOCH, 2, 6)])
+        self.assertEqual(aggregator.discard(), 2)  # (60, 1) and (900, 1) are still open
+        self.assertEqual(aggregator.emitted, {60: 3, 900: 2})
+        self.assertEqual(aggregator.add(_batch(_EPOCH + 1800, (1, 0x6000, 0x7000))), [])  # Nothing partial left
+
+    def test_aggregates_only(self):
+        sink = _Sink()
+        aggregating = sinks.AggregateSink(sink, aggregate.Aggregator((60,)), raw=False)
+        aggregating.handle(_batch(_EPOCH, (1, 0x6000, 0x7000)))
+        failed = _batch(_EPOCH + 60, (1, 0x6000, 0x7000))
+        failed.add_failure(_EPOCH + 60, 2, readings.STATUS_ERROR)
+        aggregating.handle(failed)
+        self.assertEqual([(len(batch), batch.failures) for batch in sink.batches],
+                         [(0, [(_EPOCH + 60, 2, readings.STATUS_ERROR)])])
+        self.assertEqual([row.start for row in sink.aggregates], [_EPOCH])
+        aggregating.close()  # The window of _EPOCH + 60 is not finished, it is not written
+        self.assertEqual([row.start for row in sink.aggregates], [_EPOCH])
+
+    def test_format_log(self):
+        row = aggregate.Aggregate(3600, _EPOCH, 3, 360, 20.0, 20.5, 21.0, 40.0, 41.5, 43.0)
+        self.assertEqual(aggregate.format_log([row]), '1h, {}, 3, 360, 20.0, 20.5, 21.0, 40.0, 41.5, 43.0\n'.format(
+            _EPOCH))
+        self.assertEqual([aggregate.window_name(window) for window in (30, 60, 900, 5400, 86400)],
+                         ['30s', '1m', '15m', '90m', '1d'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'sht21pi'))
+
+import i2c  # noqa: E402
+import scheduler  # noqa: E402
+import simbus  # noqa: E402
+
+try:
+    import aioengine
+except (ImportError, SyntaxError):  # python2
+    aioengine = None
+
+from .support import CONFIG, load_monitor  # noqa: E402
+
+
+class _Sink(object):
+
+    def __init__(self):
+        self.batches = []
+        self.closed = False
+
+    def handle(self, batch):
+        self.batches.append(batch)
+
+    def close(self):
+        self.closed = True
+
+
+@unittest.skipIf(aioengine is None, "asyncio needs python 3")
+class AsyncEngineTestSuite(unittest.TestCase):
+    """The asyncio engine on simulated buses"""
+
+    def setUp(self):
+        i2c.set_resolution((14, 12))
+        self.polling = i2c._READY_POLLING
+        i2c._READY_POLLING = True
+
+    def tearDown(self):
+        i2c._READY_POLLING = self.polling
+
+    def test_buses(self):
+        schedulers = [scheduler.PipelinedScheduler(simbus.SimulatedBus(seed=index), range(1, 17), 0x70, 0x71,
+                                                   offset=16 * index) for index in range(2)]
+        acquisition = scheduler.MultiBusScheduler(schedulers)
+        sink = _Sink()
+        stats = aioengine.run_engine(acquisition, [('test', sink)], 10., cycles=2)
+        self.assertTrue(sink.closed)
+        self.assertEqual(stats['test']['handled'], 2)
+        self.assertEqual([list(batch.addrs) for batch in sink.batches], [list(range(1, 33))] * 2)
+        self.assertLess(acquisition.last_cycle_time, 0.15)
+        self.assertGreaterEqual(schedulers[1].clock.monotonic(), 10.)  # Clocks kept in step
+
+    def test_monitor(self):
+        directory = tempfile.mkdtemp()
+        try:
+            configfile = os.path.join(directory, 'sht21pi.conf')
+            with open(configfile, 'w') as fp:
+                fp.write(CONFIG.format(directory=directory).replace(
+                    'log_level = ERROR', 'log_level = ERROR\nengine = asyncio'))
+            monitor = load_monitor().StorageHumidityMonitor(1, configfile=configfile)
+            try:
+                monitor.run_forever(10., cycles=3)
+            finally:
+                monitor.close()
+            with open(os.path.join(directory, 'data.log')) as fp:
+                self.assertEqual(len(fp.readlines()), 27)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_monitor_run_twice(self):
+        directory = tempfile.mkdtemp()
+        try:
+            configfile = os.path.join(directory, 'sht21pi.conf')
+            with open(configfile, 'w') as fp:
+                fp.write(CONFIG.format(directory=directory).replace(
+                    'log_level = ERROR', 'log_level = ERROR\nengine = asyncio'))
+            monitor = load_monitor().StorageHumidityMonitor(1, configfile=configfile)
+            try:
+                monitor.run()
+                monitor.run()  # The sinks of the first call are still open
+                self.assertEqual([name for name, sink in monitor._sinks], ['file'])
+            finally:
+                monitor.close()
+            with open(os.path.join(directory, 'data.log')) as fp:
+                self.assertEqual(len(fp.readlines()), 18)
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'sht21pi'))
+
+import binlog  # noqa: E402
+import i2c  # noqa: E402
+import readings  # noqa: E402
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def _reading(epoch, addr, raw_temperature, raw_humidity):
+    return [epoch, addr,
+            i2c._get_temperature_from_buffer([raw_temperature >> 8, raw_temperature & 0xff]),
+            i2c._get_humidity_from_buffer([raw_humidity >> 8, raw_humidity & 0xff])]
+
+
+@unittest.skipIf(numpy is None, "numpy is not installed")
+class BinaryLogTestSuite(unittest.TestCase):
+    """Write, convert and read back the binary data log"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.start = 1600041600  # 2020-09-14 00:00 UTC
+        # Two days of two sensors every 10 minutes
+        self.readings = [_reading(self.start + i * 600, addr, 0x6000 + 4 * i, 0x7000 + 4 * addr)
+                         for i in range(288) for addr in (4, 9)]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_read_range(self):
+        writer = binlog.BinaryLogWriter(os.path.join(self.directory, 'bin'), index_every=16)
+        writer.write(self.readings[:100])
+        writer.close()
+        writer = binlog.BinaryLogWriter(os.path.join(self.directory, 'bin'), index_every=16)
+        writer.write(self.readings[100:])  # Appends to the open segment
+        writer.close()
+        reader = binlog.BinaryLogReader(os.path.join(self.directory, 'bin'))
+        self.assertEqual(len(reader.segments()), 2)
+        self.assertEqual(len(reader.read_range()), len(self.readings))
+        records = reader.read_range(self.start + 86400 - 600, self.start + 86400)
+        self.assertEqual(list(records['epoch']), [self.start + 86400 - 600] * 2 + [self.start + 86400] * 2)
+        self.assertEqual(list(records['addr']), [4, 9, 4, 9])
+        self.assertEqual(int(records['temperature_raw'][2]), 0x6000 + 4 * 144)
+        data = reader.read_physical(self.start, self.start)
+        self.assertEqual(list(data['temperature']), [self.readings[0][2], self.readings[1][2]])
+        self.assertEqual(list(data['humidity']), [self.readings[0][3], self.readings[1][3]])
+
+    def test_torn_record(self):
+        directory = os.path.join(self.directory, 'bin')
+        writer = binlog.BinaryLogWriter(directory, index_every=16)
+        writer.write(self.readings[:40])
+        writer.close()
+        segment = os.path.join(directory, '20200914.sbl')
+        with open(segment, 'r+b') as fp:  # A crash lost the last records, the index was written
+            fp.truncate(binlog._HEADER.size + 20 * binlog._RECORD.size + 5)
+        reader = binlog.BinaryLogReader(directory)
+        self.assertEqual(len(reader.read_range(self.start + 9 * 600)), 2)  # Before the writer recovered
+        writer = binlog.BinaryLogWriter(directory, index_every=16)
+        writer.write(self.readings[40:100])
+        writer.close()
+        self.assertEqual(os.path.getsize(segment), binlog._HEADER.size + 80 * binlog._RECORD.size)
+        with open(os.path.join(directory, '20200914.idx'), 'rb') as fp:
+            data = fp.read()
+        self.assertEqual([binlog._INDEX.unpack_from(data, offset)[1] for offset in range(0, len(data), 8)],
+                         [0, 16, 32, 48, 64])
+        records = reader.read_range(self.start + 20 * 600, self.start + 20 * 600)
+        self.assertEqual(list(records['addr']), [4, 9])
+        self.assertEqual(len(reader.read_range()), 80)
+
+    def test_failures(self):
+        batch = readings.ReadingBatch()
+        batch.append(self.start, 4, 0x6000, 0x7000)
+        batch.add_failure(self.start, 9, readings.STATUS_OPEN)
+        writer = binlog.BinaryLogWriter(os.path.join(self.directory, 'bin'))
+        writer.write(batch)
+        writer.close()
+        records = binlog.BinaryLogReader(os.path.join(self.directory, 'bin')).read_range()
+        self.assertEqual(list(records['addr']), [4, 9])
+        self.assertEqual(list(records['status']), [readings.STATUS_OK, readings.STATUS_OPEN])
+
+    def test_convert_csv(self):
+        logfile = os.path.join(self.directory, 'sht21pi.log')
+        with open(logfile, 'w') as fp:
+            for row in self.readings:
+                fp.write("{}, {}, {}, {}\n".format(*row))
+        self.assertEqual(binlog.convert_csv(logfile, os.path.join(self.directory, 'bin')), len(self.readings))
+        data = binlog.BinaryLogReader(os.path.join(self.directory, 'bin')).read_physical()
+        self.assertEqual(list(data['temperature']), [row[2] for row in self.readings])
+
+
+if __name__ == '__main__':
+    unittest.main()
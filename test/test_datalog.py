@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import gzip
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'sht21pi'))
+
+import datalog  # noqa: E402
+
+_DAY = 1558828800  # 2019-05-26 00:00:00 UTC
+
+
+def _batch(epoch, count=4):
+    return [[epoch, addr, 20.5, 45.25] for addr in range(1, count + 1)]
+
+
+class DataLogTestSuite(unittest.TestCase):
+    """Rotation, compression, quota and index of the text data log"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'sht21pi.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _files(self):
+        return sorted(name for name in os.listdir(self.directory) if name.startswith('sht21pi.log.2'))
+
+    def test_kept_open(self):
+        writer = datalog.DataLogWriter(self.path, fsync_interval=3600.)
+        for cycle in range(10):
+            writer.write(_batch(_DAY + 10 * cycle))
+        self.assertEqual(writer.syncs, 0)
+        self.assertLess(os.path.getsize(self.path), writer._size)  # Still buffered
+        writer.close()
+        with open(self.path) as fp:
+            lines = fp.read().splitlines()
+        self.assertEqual(len(lines), 40)
+        self.assertEqual(lines[0], '{}, 1, {}, {}'.format(_DAY, 20.5, 45.25))
+        writer = datalog.DataLogWriter(self.path, fsync_interval=0.)  # Continues the data log
+        self.assertEqual((writer._first, writer._last), (_DAY, _DAY + 90))
+        writer.write(_batch(_DAY + 100))
+        self.assertEqual(writer.syncs, 1)
+        writer.close()
+
+    def test_rotation(self):
+        writer = datalog.DataLogWriter(self.path, max_bytes=500, compress=False, quota=0)
+        for cycle in range(20):  # 108 bytes a cycle, a segment every 5 cycles
+            writer.write(_batch(_DAY - 30 + 10 * cycle))
+        writer.write(_batch(_DAY + 86400))  # Next day
+        writer.close()
+        self.assertEqual(writer.rotations, 5)
+        index = datalog.load_index(self.path)
+        self.assertEqual(self._files(), [entry['name'] for entry in index])
+        self.assertEqual([(entry['first'], entry['last']) for entry in index],
+                         [(_DAY - 30, _DAY - 10), (_DAY, _DAY + 40), (_DAY + 50, _DAY + 90),
+                          (_DAY + 100, _DAY + 140), (_DAY + 150, _DAY + 160)])
+        self.assertEqual(index[0]['name'], 'sht21pi.log.20190525-235930')
+        self.assertEqual(len(list(datalog.read_range(self.path))), 84)
+
+    def test_compression_and_index(self):
+        writer = datalog.DataLogWriter(self.path, max_bytes=0, quota=0)
+        for day in range(3):
+            for cycle in range(10):
+                writer.write(_batch(_DAY + day * 86400 + 600 * cycle))
+        writer.close()
+        self.assertEqual(writer.compressed, 2)
+        self.assertEqual(self._files(), ['sht21pi.log.20190526-000000.gz', 'sht21pi.log.20190527-000000.gz'])
+        with gzip.open(os.path.join(self.directory, self._files()[0]), 'rb') as fp:
+            self.assertEqual(len(fp.read().splitlines()), 40)
+        start, end = _DAY + 86400 + 1200, _DAY + 86400 + 1800
+        self.assertEqual(datalog.segments(self.path, start, end), [os.path.join(self.directory, self._files()[1])])
+        self.assertEqual(datalog.segments(self.path, _DAY + 2 * 86400), [self.path])
+        rows = list(datalog.read_range(self.path, start, end))
+        self.assertEqual([row[0] for row in rows], [start] * 4 + [start + 600] * 4)
+        self.assertEqual(rows[0][1:], [1, 20.5, 45.25])
+        os.remove(self.path + datalog._INDEX_SUFFIX)  # A lost index is rebuilt from the segments
+        datalog.DataLogWriter(self.path).close()
+        self.assertEqual([entry['first'] for entry in datalog.load_index(self.path)], [_DAY, _DAY + 86400])
+
+    def test_interrupted_compression(self):
+        writer = datalog.DataLogWriter(self.path, compress=False, quota=0)
+        writer.write(_batch(_DAY))
+        writer.write(_batch(_DAY + 86400))
+        writer.close()
+        segment = os.path.join(self.directory, 'sht21pi.log.20190526-000000')
+        with open(segment + '.gz.tmp', 'wb') as fp:  # Stopped while it compressed the segment
+            fp.write(b'\x1f\x8b')
+        datalog.DataLogWriter(self.path, quota=0).close()
+        self.assertEqual(self._files(), ['sht21pi.log.20190526-000000.gz'])
+        self.assertEqual([entry['name'] for entry in datalog.load_index(self.path)], self._files())
+        self.assertEqual(len(list(datalog.read_range(self.path, end=_DAY + 10))), 4)
+
+    def test_quota(self):
+        writer = datalog.DataLogWriter(self.path, max_bytes=500, daily=False, compress=False, quota=1200)
+        for cycle in range(40):
+            writer.write(_batch(_DAY + 10 * cycle))
+        writer.close()
+        index = datalog.load_index(self.path)
+        self.assertGreater(writer.removed, 0)
+        self.assertEqual(self._files(), [entry['name'] for entry in index])
+        self.assertLessEqual(sum(entry['size'] for entry in index) + os.path.getsize(self.path), 1200)
+        rows = list(datalog.read_range(self.path, index[-1]['last'] + 1))
+        self.assertEqual(rows[0][0], index[-1]['last'] + 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
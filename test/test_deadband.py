@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'sht21pi'))
+
+import deadband  # noqa: E402
+import metrics  # noqa: E402
+import readings  # noqa: E402
+import sinks  # noqa: E402
+
+_T = 0x6000  # 24.3C
+_RH = 0x7000  # 48.7%
+_T_COUNT = int(0.1 / deadband._TEMPERATURE_PER_COUNT)
+_RH_COUNT = int(0.5 / deadband._HUMIDITY_PER_COUNT)
+
+
+class _Sink(object):
+
+    def __init__(self):
+        self.batches = []
+
+    def handle(self, batch):
+        self.batches.append(batch)
+
+    def close(self):
+        pass
+
+
+def _batch(epoch, *rows):
+    batch = readings.ReadingBatch()
+    for addr, t_raw, rh_raw in rows:
+        batch.append(epoch, addr, t_raw, rh_raw)
+    return batch
+
+
+class DeadbandTestSuite(unittest.TestCase):
+    """Change-only reporting on the raw words"""
+
+    def setUp(self):
+        self.band = deadband.Deadband(temperature=0.1, humidity=0.5, heartbeat=600, sensors={2: (1., 0.5)})
+
+    def _reported(self, epoch, *rows):
+        return list(self.band.filter(_batch(epoch, *rows)).addrs)
+
+    def test_deadband(self):
+        self.assertEqual(self._reported(0, (1, _T, _RH), (2, _T, _RH)), [1, 2])
+        self.assertEqual(self._reported(10, (1, _T + 0x3, _RH | 0x2), (2, _T + _T_COUNT, _RH)), [])  # Status bits
+        self.assertEqual(self._reported(20, (1, _T + _T_COUNT + 8, _RH), (2, _T + _T_COUNT + 8, _RH)), [1])
+        self.assertEqual(self._reported(30, (1, _T + _T_COUNT + 8, _RH - _RH_COUNT - 8)), [1])
+        self.assertEqual(self.band.reported, {1: 3, 2: 1})
+        self.assertEqual(self.band.suppressed, {1: 1, 2: 2})
+
+    def test_heartbeat(self):
+        self.assertEqual(self._reported(0, (1, _T, _RH)), [1])
+        self.assertEqual(self._reported(599, (1, _T, _RH)), [])
+        self.assertEqual(self._reported(600, (1, _T, _RH)), [1])
+        self.assertEqual(self._reported(610, (1, _T, _RH)), [])
+
+    def test_sink(self):
+        sink = _Sink()
+        band_sink = sinks.DeadbandSink(sink, self.band)
+        band_sink.handle(_batch(0, (1, _T, _RH)))
+        band_sink.handle(_batch(10, (1, _T, _RH)))
+        failed = _batch(20, (1, _T, _RH))
+        failed.add_failure(20, 3, readings.STATUS_ERROR)
+        band_sink.handle(failed)
+        self.assertEqual([len(batch) for batch in sink.batches], [1, 0])
+        self.assertEqual(sink.batches[1].failures, [(20, 3, readings.STATUS_ERROR)])
+        registry = metrics.Metrics()
+        registry.add_deadband({'influx': self.band})
+        self.assertIn('sht21pi_deadband_suppressed_total{sensor="1",sink="influx"} 2', registry.render())
+
+    def test_parse_sensors(self):
+        self.assertEqual(deadband.parse_sensors({'temperature': '0.2', 'temperature_3': '0.5', 'humidity_3': '2',
+                                                 'humidity_12': '1'}),
+                         {3: (0.5, 2.), 12: (None, 1.)})
+
+    def test_one_sided_override(self):
+        section = {'temperature': '0.3', 'humidity': '2', 'humidity_7': '1'}
+        band = deadband.Deadband(temperature=float(section['temperature']), humidity=float(section['humidity']),
+                                 heartbeat=600, sensors=deadband.parse_sensors(section))
+        self.assertEqual(band._bands[7], (deadband._counts(0.3, deadband._TEMPERATURE_PER_COUNT),
+                                          deadband._counts(1., deadband._HUMIDITY_PER_COUNT)))
+        self.assertEqual(band._default[0], band._bands[7][0])  # Not the module default of 0.1
+
+
+if __name__ == '__main__':
+    unittest.main()
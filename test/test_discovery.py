@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'sht21pi'))
+
+import discovery  # noqa: E402
+import i2c  # noqa: E402
+import scheduler  # noqa: E402
+import simbus  # noqa: E402
+from .support import CONFIG, load_monitor, configparser  # noqa: E402
+
+
+class DiscoveryTestSuite(unittest.TestCase):
+    """Scanning the muxes of the simulated bus and the topology cache"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = os.path.join(self.directory, 'topology.json')
+        self.polling = i2c._READY_POLLING
+        i2c.set_resolution((14, 12))
+
+    def tearDown(self):
+        i2c._READY_POLLING = self.polling
+        shutil.rmtree(self.directory)
+
+    def test_scan(self):
+        bus = simbus.SimulatedBus(present=0x8241)
+        mux = i2c.MuxController(bus, [0x70, 0x71])
+        self.assertEqual(discovery.scan(bus, mux), 0x8241)
+        self.assertEqual(bus.channels, {0x70: 0, 0x71: 0})  # Disabled again
+        bus.inject_fault(7, 'nack')
+        self.assertEqual(discovery.scan(bus, mux), 0x8201)
+
+    def test_cache(self):
+        bus = simbus.SimulatedBus(present=0x00f0)
+        mux = i2c.MuxController(bus, [0x70, 0x71])
+        finder = discovery.Discovery(1, (0x70, 0x71), path=self.cache, rescan=3600.)
+        self.assertEqual(finder.discover(bus, mux, 1000), 0x00f0)
+        self.assertEqual(discovery.load_cache(self.cache), {'1/0x70/0x71': {'present': 0x00f0, 'scanned': 1000}})
+        other = discovery.Discovery(3, (0x70, 0x71), path=self.cache, rescan=3600.)
+        other.discover(simbus.SimulatedBus(present=0x0001), mux, 1000)
+        bus.sensors[9] = simbus.SimulatedSensor(9, 21., 45.)
+        restarted = discovery.Discovery(1, (0x70, 0x71), path=self.cache, rescan=3600.)
+        self.assertEqual(restarted.discover(bus, mux, 2000), 0x00f0)  # From the cache
+        self.assertEqual(restarted.scans, 0)
+        self.assertEqual(restarted.discover(bus, mux, 4600), 0x01f0)  # Too old
+        self.assertEqual(sorted(discovery.load_cache(self.cache)), ['1/0x70/0x71', '3/0x70/0x71'])
+
+    def test_scan_on_start(self):
+        bus = simbus.SimulatedBus(present=0x00f0)
+        mux = i2c.MuxController(bus, [0x70, 0x71])
+        discovery.Discovery(1, (0x70, 0x71), path=self.cache, rescan=0.).discover(bus, mux, 1000)
+        bus.sensors[9] = simbus.SimulatedSensor(9, 21., 45.)  # Rewired while stopped
+        restarted = discovery.Discovery(1, (0x70, 0x71), path=self.cache, rescan=0.)
+        self.assertEqual(restarted.discover(bus, mux, 1010), 0x01f0)
+        self.assertEqual(restarted.scans, 1)
+
+    def test_shared_cache(self):
+        finders, threads = [], []
+        for bus_nr in range(1, 9):  # One thread a bus like MultiBusScheduler
+            bus = simbus.SimulatedBus(present=1 << bus_nr)
+            finders.append(discovery.Discovery(bus_nr, (0x70, 0x71), path=self.cache))
+            threads.append(threading.Thread(target=finders[-1].scan,
+                                            args=(bus, i2c.MuxController(bus, [0x70, 0x71]), 1000)))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        cache = discovery.load_cache(self.cache)
+        self.assertEqual(dict((key, entry['present']) for key, entry in cache.items()),
+                         dict((finder.key, 1 << bus_nr) for bus_nr, finder in enumerate(finders, 1)))
+        self.assertEqual(os.listdir(self.directory), ['topology.json'])
+
+    def test_rescan(self):
+        i2c._READY_POLLING = True
+        bus = simbus.SimulatedBus(present=0x000f)
+        cycle = scheduler.PipelinedScheduler(bus, [1, 2, 3, 4], 0x70, 0x71)
+        cycle.configure_resolution((12, 8))
+        cycle.discovery = discovery.Discovery(1, (0x70, 0x71), path=self.cache, rescan=600., failures=1)
+        cycle.discovery.scan(bus, cycle.mux, int(bus.clock.time()))
+        del bus.sensors[3]
+        for _ in range(scheduler._BREAKER_THRESHOLD):  # Until the breaker opens
+            batch = cycle.read_all()
+        self.assertEqual(cycle.addrs, [1, 2, 4])
+        self.assertEqual(cycle.discovery.scans, 2)
+        bus.sensors[5] = simbus.SimulatedSensor(5, 21., 45.)
+        self.assertEqual(list(cycle.read_all().addrs), [1, 2, 4])
+        bus.clock.sleep(600.)
+        cycle.read_all()  # Scheduled scan
+        self.assertEqual(cycle.addrs, [1, 2, 4, 5])
+        self.assertEqual(bus.sensors[5].resolution(), i2c._RESOLUTIONS[(12, 8)])  # Configured like the others
+        batch = cycle.read_all()
+        self.assertEqual(list(batch.addrs), [1, 2, 4, 5])
+        self.assertEqual(batch.failures, [])
+
+    @unittest.skipIf(configparser is None, "configparser is not installed")
+    def test_monitor(self):
+        configfile = os.path.join(self.directory, 'sht21pi.conf')
+        with open(configfile, 'w') as fp:
+            config = CONFIG.format(directory=self.directory).replace('present = 0xff40', 'present = auto')
+            fp.write(config + "[DISCOVERY]\ncache = {}\n".format(self.cache))
+        monitor = load_monitor().StorageHumidityMonitor(1, configfile=configfile)
+        try:
+            monitor.run()
+        finally:
+            monitor.close()
+        self.assertEqual(monitor._scheduler.addrs, list(range(1, 17)))
+        self.assertEqual(discovery.load_cache(self.cache)['1/0x70/0x71']['present'], 0xffff)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'sht21pi'))
+
+import helpers  # noqa: E402
+
+
+class HelpersTestSuite(unittest.TestCase):
+    """Clock of the schedule"""
+
+    def test_monotonic(self):
+        self.assertIsNot(helpers.monotonic, time.time)  # Not the wall clock on python2 either
+        first = helpers.monotonic()
+        self.assertLessEqual(first, helpers.monotonic())
+
+    @unittest.skipIf(helpers._libc_monotonic() is None, "clock_gettime is not available")
+    def test_libc_monotonic(self):
+        monotonic = helpers._libc_monotonic()
+        before = helpers.monotonic()
+        now = monotonic()
+        self.assertLessEqual(before, now)
+        self.assertLess(now - helpers.monotonic(), 0.1)  # The same clock as time.monotonic
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import zlib
+import shutil
+import tempfile
+import threading
+import unittest
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:  # python2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'sht21pi'))
+
+import aggregate  # noqa: E402
+import readings  # noqa: E402
+import spool  # noqa: E402
+
+try:
+    import influx
+except ImportError:  # requests is not installed
+    influx = None
+
+
+class _InfluxHandler(BaseHTTPRequestHandler):
+    """Stand-in for the influx /write endpoint, keeps the decoded bodies"""
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        self.server.posts.append((self.path, body.decode('utf-8')))
+        self.send_response(self.server.status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@unittest.skipIf(influx is None, "requests is not installed")
+class InfluxWriterTestSuite(unittest.TestCase):
+    """InfluxWriter against a local http server"""
+
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), _InfluxHandler)
+        self.server.posts = []
+        self.server.status = 204
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.writer = influx.InfluxWriter(
+            '127.0.0.1:{}'.format(self.server.server_port), 'sht21', 'user', 'password', batch_size=4)
+
+    def tearDown(self):
+        self.writer.session.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_batches_by_size(self):
+        self.writer.write([[1600000000, 1, 20.5, 40.25], [1600000000, 2, 21.0, 41.0]])
+        self.assertEqual(self.server.posts, [])
+        self.writer.write([[1600000010, 1, 20.5, 40.5], [1600000010, 2, 21.0, 41.5]])
+        self.assertEqual(len(self.server.posts), 1)
+        path, body = self.server.posts[0]
+        self.assertIn('db=sht21', path)
+        lines = body.split('\n')
+        self.assertEqual(len(lines), 4)
+        self.assertTrue(lines[0].startswith('sht21,host='))
+        self.assertTrue(lines[0].endswith('-1 temperature=20.5,humidity=40.25 1600000000'))
+
+    def test_status_points(self):
+        batch = readings.ReadingBatch()
+        batch.append(1600000000, 1, 0x6000, 0x7000)
+        batch.add_failure(1600000000, 2, readings.STATUS_ERROR)
+        lines = self.writer.encode(batch)
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[1].endswith('-2 status="error" 1600000000'))
+
+    def test_aggregate_points(self):
+        row = aggregate.Aggregate(900, 1600000200, 3, 90, 20.0, 20.5, 21.0, 40.0, 41.5, 43.0)
+        line = self.writer.encode_aggregates([row])[0]
+        self.assertTrue(line.startswith('sht21_15m,host='))
+        self.assertTrue(line.endswith('-3 count=90i,temperature_min=20.0,temperature_mean=20.5,temperature_max=21.0,'
+                                      'humidity_min=40.0,humidity_mean=41.5,humidity_max=43.0 1600000200'))
+
+    def test_keeps_lines_on_failure(self):
+        self.server.status = 500
+        self.writer.write([[1600000000, 1, 20.5, 40.25]])
+        self.assertFalse(self.writer.flush())
+        self.assertEqual(self.writer.failures, 1)
+        self.server.status = 204
+        self.assertTrue(self.writer.flush())
+        self.assertEqual(self.writer.posted_lines, 1)
+
+    def test_spool_keeps_lines_until_accepted(self):
+        directory = tempfile.mkdtemp()
+        try:
+            store = spool.Spool(os.path.join(directory, 'influx.spool'))
+            writer = influx.InfluxWriter(
+                '127.0.0.1:{}'.format(self.server.server_port), 'sht21', 'user', 'password',
+                batch_size=1, spool=store, drain_batch=2, drain_rate=1000.)
+            self.server.status = 500
+            writer.write([[1600000000, 1, 20.5, 40.25], [1600000000, 2, 21.0, 41.0]])
+            writer.write([[1600000010, 1, 20.5, 40.5]])  # Waits for the retry interval
+            self.assertEqual(len(self.server.posts), 1)
+            self.assertEqual(len(store), 3)
+            self.server.status = 204
+            self.assertTrue(writer.flush())
+            self.assertEqual(len(store), 0)
+            self.assertEqual([len(body.split('\n')) for path, body in self.server.posts[1:]], [2, 1])
+            writer.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_spool_drops_rejected_lines(self):
+        directory = tempfile.mkdtemp()
+        try:
+            store = spool.Spool(os.path.join(directory, 'influx.spool'))
+            writer = influx.InfluxWriter(
+                '127.0.0.1:{}'.format(self.server.server_port), 'sht21', 'user', 'password',
+                batch_size=1, spool=store, drain_rate=1000.)
+            self.server.status = 400  # E.g. a field type conflict, posting it again would fail the same way
+            writer.write([[1600000000, 1, 20.5, 40.25], [1600000000, 2, 21.0, 41.0]])
+            self.assertEqual((len(store), writer.rejected_lines, writer.failures), (0, 2, 0))
+            self.server.status = 204
+            writer.write([[1600000010, 1, 20.5, 40.5]])  # Not held back by a retry interval
+            self.assertEqual((len(store), writer.posted_lines), (0, 1))
+            self.server.status = 429
+            writer.write([[1600000020, 1, 20.5, 40.5]])
+            self.assertEqual((len(store), writer.failures), (1, 1))
+            writer.close()
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'sht21pi'))
+
+import latest  # noqa: E402
+import readings  # noqa: E402
+
+
+class LatestTestSuite(unittest.TestCase):
+    """Memory mapped table of the latest readings"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'run', 'latest')
+        self.writer = latest.LatestWriter(self.path)
+
+    def tearDown(self):
+        self.writer.close()
+        shutil.rmtree(self.directory)
+
+    def _write(self, epoch, rows, failures=()):
+        batch = readings.ReadingBatch.from_list([[epoch] + list(row) for row in rows],
+                                                [[epoch, addr, status] for addr, status in failures])
+        self.writer.write(batch)
+
+    def test_latest(self):
+        reader = latest.LatestReader(self.path)
+        try:
+            self.assertEqual(reader.read_all(), [])
+            self._write(1600000000, [(1, 0x6000, 0x7000), (2, 0x6100, 0x7100)])
+            self._write(1600000010, [(1, 0x6004, 0x7004)], [(2, readings.STATUS_ERROR)])
+            self.assertEqual(reader.cycle(), 2)
+            first, second = reader.read_all()
+            self.assertEqual(first[:6], (1, 1600000010, readings.STATUS_OK, 0x6004, 0x7004, 2))
+            self.assertAlmostEqual(first.temperature, readings.temperature([0x6004])[0])
+            self.assertEqual(second[:6], (2, 1600000000, readings.STATUS_ERROR, 0x6100, 0x7100, 2))
+            self.assertIsNone(reader.read(3))
+        finally:
+            reader.close()
+
+    def test_torn_slot(self):
+        self._write(1600000000, [(1, 0x6000, 0x7000)])
+        latest._SEQUENCE.pack_into(self.writer._map, latest._offset(1), 3)  # Writer stopped in the middle
+        reader = latest.LatestReader(self.path)
+        try:
+            with self.assertRaises(IOError):
+                reader.read(1)
+            self._write(1600000010, [(1, 0x6004, 0x7004)])  # The next write finishes the slot
+            self.assertEqual(reader.read(1)[:4], (1, 1600000010, readings.STATUS_OK, 0x6004))
+            latest._SEQUENCE.pack_into(self.writer._map, latest._offset(1), 5)
+            self.writer.close()
+            self.writer = latest.LatestWriter(self.path)  # So does a restart
+            self.assertEqual(reader.read(1).epoch, 1600000010)
+            for epoch in (1600000020, 1600000030, 1600000040):
+                self._write(epoch, [(1, 0x6008, 0x7008)])
+                self.assertEqual(reader.read(1).epoch, epoch)
+        finally:
+            reader.close()
+
+    def test_reopen(self):
+        self._write(1600000000, [(1, 0x6000, 0x7000)])
+        self.writer.close()
+        self.writer = latest.LatestWriter(self.path)  # A restart keeps the last values
+        self.assertEqual(self.writer.cycle, 1)
+        reader = latest.LatestReader(self.path)
+        try:
+            self.assertEqual(reader.read(1).epoch, 1600000000)
+        finally:
+            reader.close()
+
+    def test_invalid_file(self):
+        other = os.path.join(self.directory, 'other')
+        for content in (b'', b'SHT21LT\x00', b'x' * 4096):  # Empty, shorter than the header, foreign
+            with open(other, 'wb') as fp:
+                fp.write(content)
+            self.assertRaises(ValueError, latest.LatestReader, other)
+        with open(self.path, 'rb') as fp:
+            header = fp.read(latest._offset(10))
+        with open(other, 'wb') as fp:  # Cut after ten slots
+            fp.write(header)
+        self.assertRaises(ValueError, latest.LatestReader, other)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'sht21pi'))
+
+import led  # noqa: E402
+import sinks  # noqa: E402
+
+
+class LedTestSuite(unittest.TestCase):
+    """Argospi2cWS2811x on a fake backend"""
+
+    def test_renders_only_on_change(self):
+        backend = led.FakeBackend()
+        indicator = led.Argospi2cWS2811x(backend)
+        indicator.set_leds([0, 1, 2, 3])
+        indicator.set_leds([0, 1, 2, 3])
+        self.assertEqual(backend.renders, 1)
+        self.assertEqual(indicator.skipped_renders, 1)
+        indicator.set_leds([0, 1, 2, 4])  # Above the last colour
+        self.assertEqual(backend.renders, 1)
+        indicator.set_leds([1, 1, 2, 3])
+        self.assertEqual(backend.renders, 2)
+        self.assertEqual(backend.colors[0], led._LED_COLOURS_LIST[1])
+        indicator.close()
+        self.assertTrue(backend.closed)
+
+    def test_sink_keeps_skipped_sensors(self):
+        threshold = led._LEDS_HUMIDITY_THRESHOLD
+        led._LEDS_HUMIDITY_THRESHOLD = 40.
+        try:
+            shown = []
+            indicator = led.Argospi2cWS2811x(led.FakeBackend())
+            indicator.set_leds = shown.append
+            sink = sinks.LedSink(indicator)
+            sink.handle([[0, 1, 20., 50.], [0, 2, 20., 30.], [0, 5, 20., 60.]])
+            sink.handle([[10, 2, 20., 45.]])  # 1 and 5 were not read in this cycle
+            sink.handle([[20, 5, 20., 35.]])
+            self.assertEqual(shown, [[0, 2, 0, 0], [0, 2, 1, 0], [0, 1, 1, 0]])
+        finally:
+            led._LEDS_HUMIDITY_THRESHOLD = threshold
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import unittest
+
+try:
+    from urllib.request import urlopen
+except ImportError:  # python2
+    from urllib2 import urlopen
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'sht21pi'))
+
+import i2c  # noqa: E402
+import metrics  # noqa: E402
+import pipeline  # noqa: E402
+import scheduler  # noqa: E402
+import simbus  # noqa: E402
+
+
+class _Sink(object):
+
+    def handle(self, batch):
+        pass
+
+    def close(self):
+        pass
+
+
+class MetricsTestSuite(unittest.TestCase):
+    """Metrics of a cycle on the simulated bus"""
+
+    def setUp(self):
+        i2c.set_resolution((14, 12))
+        self.bus = simbus.SimulatedBus(present=0x0007)
+        self.bus.inject_fault(2, 'crc', count=1)
+        self.bus.inject_fault(3, 'nack')
+        self.cycle = scheduler.PipelinedScheduler(self.bus, [1, 2, 3], 0x70, 0x71)
+        self.cycle.cycle_histogram = metrics.Histogram()
+        self.pipeline = pipeline.SinkPipeline()
+        self.pipeline.add('file', _Sink())
+        self.registry = metrics.Metrics()
+        self.registry.add_scheduler(self.cycle)
+        self.registry.add_pipeline(self.pipeline)
+
+    def tearDown(self):
+        self.pipeline.close()
+
+    def test_render(self):
+        self.pipeline.publish(self.cycle.read_all())
+        text = self.registry.render()
+        self.assertIn('# TYPE sht21pi_cycle_duration_seconds histogram', text)
+        self.assertIn('sht21pi_cycle_duration_seconds_bucket{le="0.3"} 1\n', text)  # The retry adds a conversion
+        self.assertIn('sht21pi_cycle_duration_seconds_count 1\n', text)
+        self.assertIn('sht21pi_sensor_errors_total{sensor="3"} 1\n', text)
+        self.assertIn('sht21pi_sensor_retries_total{sensor="2"} 1\n', text)
+        self.assertIn('sht21pi_conversion_seconds{kind="humidity",sensor="1"}', text)
+        self.assertIn('sht21pi_sink_backlog{sink="file"}', text)
+        temperatures = [line for line in text.splitlines() if line.startswith('sht21pi_temperature_celsius')]
+        self.assertEqual(len(temperatures), 2)
+
+    def test_last_readings(self):
+        self.cycle.read_all()
+        self.bus.inject_fault(1, 'nack')  # Left out of the next batch, like a sensor the sampling skips
+        self.cycle.read_all()
+        self.assertEqual(list(self.cycle.last_batch.addrs), [2])
+        text = self.registry.render()
+        self.assertIn('sht21pi_temperature_celsius{sensor="1"}', text)
+        self.assertIn('sht21pi_humidity_percent{sensor="2"}', text)
+        self.assertNotIn('sht21pi_humidity_percent{sensor="3"}', text)  # Never read
+
+    def test_histogram(self):
+        histogram = metrics.Histogram((0.1, 1.))
+        for value in (0.05, 0.1, 0.5, 2.):
+            histogram.observe(value)
+        self.assertEqual([value for name, labels, value in histogram.samples('h')], [2, 3, 4, 2.65, 4])
+
+    def test_server(self):
+        server = metrics.MetricsServer(self.registry, '127.0.0.1', 0)
+        try:
+            self.cycle.read_all()
+            body = urlopen('http://127.0.0.1:{}/metrics'.format(server.port)).read().decode('utf-8')
+        finally:
+            server.close()
+        self.assertIn('sht21pi_humidity_percent{sensor="1"}', body)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'sht21pi'))
+
+import pipeline  # noqa: E402
+
+
+class _BlockedSink(object):
+    """Keeps the batches, handle() waits until released"""
+
+    def __init__(self):
+        self.batches = []
+        self.release = threading.Event()
+
+    def handle(self, batch):
+        self.release.wait()
+        self.batches.append(batch)
+
+    def close(self):
+        pass
+
+
+class PipelineTestSuite(unittest.TestCase):
+    """Overflow policies of the sink workers"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.sink = _BlockedSink()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _publish(self, overflow):
+        sink_pipeline = pipeline.SinkPipeline(maxsize=2, overflow=overflow, spill_directory=self.directory)
+        worker = sink_pipeline.add('test', self.sink)
+        for i in range(6):
+            sink_pipeline.publish([[1600000000 + i, 1, 20.0, 40.0]])
+        self.sink.release.set()
+        sink_pipeline.close(5)
+        return worker, [batch[0][0] - 1600000000 for batch in self.sink.batches]
+
+    def test_drop_oldest(self):
+        worker, handled = self._publish(pipeline.DROP_OLDEST)
+        self.assertEqual(handled[-2:], [4, 5])
+        self.assertEqual(len(handled) + worker.dropped, 6)
+        self.assertEqual(worker.stats()['backlog'], 0)
+
+    def test_spill_keeps_order(self):
+        worker, handled = self._publish(pipeline.SPILL)
+        self.assertEqual(handled, [0, 1, 2, 3, 4, 5])
+        self.assertEqual(worker.dropped, 0)
+
+    def test_spill_acks_handled_batches(self):
+        import spool
+        store = spool.Spool(os.path.join(self.directory, 'test.spill'))
+        store.append([pipeline._dumps([[1600000000, 1, 20.0, 40.0]])])  # Left by the last run
+        spooled = []
+        self.sink.handle = lambda batch: spooled.append(len(store))
+        worker = pipeline.SinkWorker('test', self.sink, overflow=pipeline.SPILL, spill=store)
+        worker.start()
+        worker.close(5)
+        self.assertEqual(spooled, [1])  # Still in the spool while the sink handles it
+        self.assertEqual((len(store), worker.backlog()), (0, 0))
+        store.close()
+
+    def test_block(self):
+        sink_pipeline = pipeline.SinkPipeline(maxsize=2, overflow=pipeline.BLOCK)
+        worker = sink_pipeline.add('test', self.sink)
+        publisher = threading.Thread(target=lambda: [sink_pipeline.publish([[1600000000 + i, 1, 20.0, 40.0]])
+                                                     for i in range(6)])
+        publisher.start()
+        publisher.join(0.2)
+        self.assertTrue(publisher.is_alive())  # Waits for the sink
+        self.assertLessEqual(worker.backlog(), 2)
+        self.sink.release.set()
+        publisher.join(5)
+        sink_pipeline.close(5)
+        self.assertEqual([batch[0][0] - 1600000000 for batch in self.sink.batches], [0, 1, 2, 3, 4, 5])
+        self.assertEqual(worker.dropped, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
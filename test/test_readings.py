@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'sht21pi'))
+
+import i2c  # noqa: E402
+import readings  # noqa: E402
+
+
+class ReadingBatchTestSuite(unittest.TestCase):
+    """Column conversion matches the conversion of i2c.py"""
+
+    def _batch(self, size):
+        batch = readings.ReadingBatch()
+        for i in range(size):
+            batch.append(1600000000 + i, i % 16 + 1, (0x5000 + 37 * i) & 0xffff, (0x6000 + 11 * i) & 0xffff)
+        return batch
+
+    def test_conversion(self):
+        for size in (3, readings._NUMPY_THRESHOLD + 1):  # Python and numpy path
+            batch = self._batch(size)
+            for i, (epoch, addr, temp, humi) in enumerate(batch):
+                t_raw, rh_raw = batch.temperature_raw[i], batch.humidity_raw[i]
+                self.assertEqual(epoch, 1600000000 + i)
+                self.assertAlmostEqual(temp, i2c._get_temperature_from_buffer([t_raw >> 8, t_raw & 0xff]), 9)
+                self.assertAlmostEqual(humi, i2c._get_humidity_from_buffer([rh_raw >> 8, rh_raw & 0xff]), 9)
+
+    def test_list_round_trip(self):
+        batch = self._batch(5)
+        self.assertEqual(readings.ReadingBatch.from_list(batch.to_list()).to_list(), batch.to_list())
+
+
+if __name__ == '__main__':
+    unittest.main()
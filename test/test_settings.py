@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'sht21pi'))
+
+import helpers  # noqa: E402
+import settings  # noqa: E402
+from .support import CONFIG, load_monitor, configparser  # noqa: E402
+
+
+@unittest.skipIf(configparser is None, "configparser is not installed")
+class SettingsTestSuite(unittest.TestCase):
+    """Configuration snapshot and lazily imported sinks"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.configfile = os.path.join(self.directory, 'sht21pi.conf')
+        self.snapshot_directory = settings._SNAPSHOT_DIRECTORY
+        settings._SNAPSHOT_DIRECTORY = self.directory
+        self._write("[DEADBAND]\nenabled = True\ntemperature = 0.3\nhumidity_7 = 2\n")
+
+    def tearDown(self):
+        settings._SNAPSHOT_DIRECTORY = self.snapshot_directory
+        shutil.rmtree(self.directory)
+
+    def _write(self, extra=''):
+        with open(self.configfile, 'w') as fp:
+            fp.write(CONFIG.format(directory=self.directory) + extra)
+
+    def test_snapshot(self):
+        parsed, cached = settings.load(self.configfile)
+        self.assertFalse(cached)
+        path = os.path.join(self.directory, 'sht21pi.conf' + settings._SNAPSHOT_SUFFIX)
+        self.assertEqual(settings.snapshot_path(self.configfile), path)
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)  # It holds the influx password
+        snapshot, cached = settings.load(self.configfile)
+        self.assertTrue(cached)
+        self.assertEqual(snapshot, parsed)
+        self.assertEqual(snapshot['i2c']['_SENSORS_PRESENT'], 0xff40)
+        self.assertEqual(snapshot['deadband']['_DEADBAND_TEMPERATURE'], 0.3)
+        self.assertEqual(snapshot['deadband']['_DEADBAND_SENSORS'], {7: (None, 2.)})  # 0.3 once applied
+        self._write("[AGGREGATE]\nwindows = 300\n")  # Changes size and modification time
+        snapshot, cached = settings.load(self.configfile)
+        self.assertFalse(cached)
+        self.assertEqual(snapshot['aggregate']['_AGGREGATE_WINDOWS'], (300,))
+
+    def test_validation(self):
+        self._write("[PIPELINE]\noverflow = drop-newest\n")
+        with self.assertRaises(ValueError):
+            settings.load(self.configfile)
+        self._write("[AGGREGATE]\nwindows = 60, 0\n")
+        with self.assertRaises(ValueError):
+            settings.load(self.configfile)
+        with open(self.configfile, 'w') as fp:
+            fp.write("[CONFIGURATION]\nlog_enabled = True\n")
+        with self.assertRaises(KeyError):
+            settings.load(self.configfile)
+
+    def test_lazy_imports(self):
+        profile = helpers.StartupProfile()
+        monitor = load_monitor().StorageHumidityMonitor(1, configfile=self.configfile, profile=profile)
+        monitor.close()
+        self.assertEqual(sorted(monitor._modules), ['simbus'])  # No influx, leds or metrics
+        self.assertEqual([(depth, name) for depth, name, seconds in profile.phases],
+                         [(0, 'configuration'), (0, 'buses'), (1, 'import simbus'), (0, 'sinks'), (0, 'pipeline')])
+        self.assertIn('import simbus', profile.report())
+
+
+if __name__ == '__main__':
+    unittest.main()
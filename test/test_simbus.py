@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'sht21pi'))
+
+import i2c  # noqa: E402
+import readings  # noqa: E402
+import scheduler  # noqa: E402
+import simbus  # noqa: E402
+from .support import CONFIG, load_monitor, configparser  # noqa: E402
+
+
+class SimulatedBusTestSuite(unittest.TestCase):
+    """Acquisition on the simulated bus, in virtual time"""
+
+    def setUp(self):
+        self.polling = i2c._READY_POLLING
+        i2c.set_resolution((14, 12))
+
+    def tearDown(self):
+        i2c._READY_POLLING = self.polling
+
+    def _read(self, bus, addrs):
+        cycle = scheduler.PipelinedScheduler(bus, addrs, 0x70, 0x71)
+        cycle.configure_resolution(i2c._RESOLUTION)
+        return cycle, cycle.read_all()
+
+    def test_pipelined_cycle(self):
+        i2c._READY_POLLING = False
+        bus = simbus.SimulatedBus(present=0xffff, temperature=20., humidity=50.)
+        cycle, batch = self._read(bus, range(1, 17))
+        self.assertEqual(list(batch.addrs), list(range(1, 17)))
+        for epoch, addr, temp, humi in batch:
+            self.assertAlmostEqual(temp, 20., delta=2.5)
+            self.assertAlmostEqual(humi, 50., delta=5.5)
+        self.assertLess(cycle.last_cycle_time, 0.2)  # One conversion period, not 16
+        self.assertGreater(cycle.last_cycle_time, i2c._TEMPERATURE_WAIT_TIME + i2c._HUMIDITY_WAIT_TIME)
+
+    def test_ready_polling_is_faster(self):
+        i2c._READY_POLLING = False
+        fixed, _ = self._read(simbus.SimulatedBus(), range(1, 17))
+        i2c._READY_POLLING = True
+        polled, batch = self._read(simbus.SimulatedBus(), range(1, 17))
+        self.assertEqual(len(batch), 16)
+        self.assertLess(polled.last_cycle_time, fixed.last_cycle_time)
+
+    def test_faults(self):
+        i2c._READY_POLLING = True
+        bus = simbus.SimulatedBus(present=0x000f)
+        bus.inject_fault(2, 'crc', count=1)
+        bus.inject_fault(3, 'stuck')
+        bus.inject_fault(4, 'nack')
+        cycle, batch = self._read(bus, range(1, 5))
+        self.assertEqual(list(batch.addrs), [1, 2])
+        self.assertEqual(bus.sensors[2].conversions, 3)  # The corrupted temperature was measured again
+        bus.clear_faults()
+        self.assertEqual(list(cycle.read_all().addrs), [1, 2, 3, 4])
+
+    def test_circuit_breaker(self):
+        i2c._READY_POLLING = True
+        bus = simbus.SimulatedBus(present=0x0003)
+        bus.inject_fault(2, 'nack')
+        cycle, batch = self._read(bus, [1, 2])  # The failed resolution write counts too
+        self.assertEqual(list(batch.addrs), [1])
+        self.assertEqual([status for epoch, addr, status in batch.failures], [readings.STATUS_ERROR])
+        batch = cycle.read_all()
+        self.assertTrue(cycle.breakers[2].is_open())
+        self.assertEqual([status for epoch, addr, status in cycle.read_all().failures], [readings.STATUS_OPEN])
+        bus.clear_faults()
+        bus.clock.sleep(scheduler._BREAKER_BACKOFF)
+        batch = cycle.read_all()  # Probe
+        self.assertEqual(list(batch.addrs), [1, 2])
+        self.assertEqual(batch.failures, [])
+        self.assertFalse(cycle.breakers[2].is_open())
+
+    def test_breaker_backoff(self):
+        breaker = scheduler.SensorBreaker(threshold=2, backoff=10., max_backoff=30.)
+        self.assertIsNone(breaker.failure(0.))
+        self.assertEqual([breaker.failure(0.), breaker.failure(0.), breaker.failure(0.)], [10., 20., 30.])
+        self.assertFalse(breaker.allow(29.))
+        self.assertTrue(breaker.probing(30.))
+        self.assertEqual(breaker.success(), 4)
+        self.assertTrue(breaker.allow(0.))
+
+    def test_adaptive_sampling(self):
+        i2c._READY_POLLING = True
+        bus = simbus.SimulatedBus(present=0x000f)
+        cycle, batch = self._read(bus, range(1, 5))
+        cycle.sampler = scheduler.AdaptiveSampler(min_interval=10., max_interval=60., max_sensors=3)
+        counts = dict((addr, 0) for addr in range(1, 5))
+        for _ in range(60):  # Ten minutes every 10s, sensor 2 warms up by 0.5C per cycle
+            bus.sensors[2].temperature += 0.5
+            started = bus.clock.monotonic()
+            for epoch, addr, temp, humi in cycle.read_all():
+                counts[addr] += 1
+            bus.clock.sleep(10. - (bus.clock.monotonic() - started))
+        self.assertEqual(cycle.sampler.intervals[2], 10.)
+        self.assertEqual(cycle.sampler.intervals[1], 60.)
+        self.assertEqual(counts[2], 60)
+        self.assertLess(max(counts[1], counts[3], counts[4]), 20)
+        self.assertGreater(sum(cycle.sampler.deferred.values()), 0)  # Four sensors due in the first cycles
+
+    def test_multiple_buses(self):
+        i2c._READY_POLLING = True
+        schedulers = [scheduler.PipelinedScheduler(simbus.SimulatedBus(seed=index), range(1, 17), 0x70, 0x71,
+                                                   offset=16 * index) for index in range(3)]
+        cycle = scheduler.MultiBusScheduler(schedulers)
+        try:
+            cycle.configure_resolution(i2c._RESOLUTION)
+            batch = cycle.read_all()
+            single, _ = self._read(simbus.SimulatedBus(), range(1, 17))
+        finally:
+            cycle.close()
+        self.assertEqual(list(batch.addrs), list(range(1, 49)))
+        self.assertLess(cycle.last_cycle_time, single.last_cycle_time * 1.2)  # Not three times as long
+        self.assertEqual(len(set(bus.clock.monotonic() for bus in schedulers)), 1)
+
+    def test_bus_conflict(self):
+        bus = simbus.SimulatedBus(present=0x0003)
+        bus.write_byte(0x70, 0x03)
+        with self.assertRaises(IOError):
+            bus.write_byte(i2c._I2C_ADDRESS, i2c._TRIGGER_TEMPERATURE_NO_HOLD)
+
+    @unittest.skipIf(configparser is None, "configparser is not installed")
+    def test_monitor_buses(self):
+        directory = tempfile.mkdtemp()
+        try:
+            configfile = os.path.join(directory, 'sht21pi.conf')
+            with open(configfile, 'w') as fp:
+                fp.write(CONFIG.format(directory=directory) + "[BUS 3]\npresent = 0x0003\n[BUS 1]\n")
+            monitor = load_monitor().StorageHumidityMonitor(1, configfile=configfile)
+            try:
+                monitor.run()
+            finally:
+                monitor.close()
+            with open(os.path.join(directory, 'data.log')) as fp:
+                addrs = [int(line.split(',')[1]) for line in fp]
+            self.assertEqual(addrs, [7] + list(range(9, 17)) + [17, 18])
+        finally:
+            shutil.rmtree(directory)
+
+    @unittest.skipIf(configparser is None, "configparser is not installed")
+    def test_monitor_loop(self):
+        directory = tempfile.mkdtemp()
+        try:
+            configfile = os.path.join(directory, 'sht21pi.conf')
+            with open(configfile, 'w') as fp:
+                fp.write(CONFIG.format(directory=directory))
+            module = load_monitor()
+            monitor = module.StorageHumidityMonitor(1, configfile=configfile)
+            clock = i2c.bus.clock
+            try:
+                monitor.run_forever(10., cycles=3)
+            finally:
+                monitor.close()
+            self.assertGreaterEqual(clock.monotonic(), 20.)
+            with open(os.path.join(directory, 'data.log')) as fp:
+                lines = fp.read().splitlines()
+            self.assertEqual(len(lines), 27)
+            self.assertEqual(sorted(set(int(line.split(',')[1]) for line in lines)), [7] + list(range(9, 17)))
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    unittest.main()